@@ -6,8 +6,13 @@ import sys
 import pandas as pd
 from GLHE.CALCITE import events
 import GLHE.CLAY.globals
-from GLHE.CLAY import combined_data_functions, lake_extraction, helpers
-from GLHE.CLAY.data_access import data_check, ERA5_Land, CRUTS, NWM
+from GLHE.CLAY import (
+    combined_data_functions,
+    lake_extraction,
+    helpers,
+    product_scheduler,
+)
+from GLHE.CLAY.data_access import data_access_parent_class, data_check, ERA5_Land, CRUTS, NWM
 from GLHE.CALCITE import pubsub, events
 from pathlib import Path
 
@@ -19,6 +24,7 @@ class CLAY_driver:
 
     datasets_index = {"all": [], "grid": [], "slc": {}}
     pandas_dataset: pd.DataFrame
+    pandas_panel: pd.DataFrame
     root_logger: logging.Logger
     data_products = {}
     read_me_information = {"Data_Product": {}, "Output_File": {}}
@@ -33,6 +39,7 @@ class CLAY_driver:
         for key in GLHE.CLAY.globals.SLC_MAPPING_REVERSE_NAMES:
             self.datasets_index["slc"][key] = []
         self.pandas_dataset = None
+        self.pandas_panel = None
         self.root_logger = None
         self.data_products = {}
         self.read_me_information = {"Data_Product": {}, "Output_File": {}}
@@ -42,7 +49,7 @@ class CLAY_driver:
             pubsub.EventBus, "OutputFileEvent", self.output_file_listener
         )
         pubsub.EventBus.Subscribe(
-            pubsub.EventBus, "OutputFileEvent", self.read_me_data_product_run_listener
+            pubsub.EventBus, "DataProductRunEvent", self.read_me_data_product_run_listener
         )
 
     def index_datasets(self, *datasets: helpers.MVSeries):
@@ -86,8 +93,8 @@ class CLAY_driver:
         """
         # print("Data Product Message: " + str(message))
         self.read_me_information["Data_Product"][
-            message.file_name
-        ] = message.file_description
+            message.product_name
+        ] = message.product_description
 
     def output_file_listener(self, message: events.OutputFileEvent) -> None:
         """
@@ -97,7 +104,15 @@ class CLAY_driver:
         self.read_me_information["Output_File"][
             message.file_name
         ] = message.file_description
-        self.output_file_config[message.LIME_file_type] = message.file_path
+        if message.LIME_file_type == events.TypeOfFileLIME.SERIES_DATA:
+            # LIME reads the series data in the fastest format written
+            self.output_file_config[
+                message.LIME_file_type
+            ] = combined_data_functions.fastest_series_data_file(
+                message.file_path, self.output_file_config.get(message.LIME_file_type)
+            )
+        else:
+            self.output_file_config[message.LIME_file_type] = message.file_path
 
     def main(self, HYLAK_ID: int) -> str:
         """
@@ -117,10 +132,26 @@ class CLAY_driver:
 
         # Verify access to data #
         data_check.check_data_and_download_missing_data_or_files()
+        output_directory = self.run_lake(HYLAK_ID, lake_extraction.LakeExtraction())
+        logging.info(
+            '"***********************Finished Driver Function*************************"'
+        )
+        return output_directory
+
+    def run_lake(
+        self, HYLAK_ID: int, lake_extraction_object: lake_extraction.LakeExtraction
+    ) -> str:
+        """
+        Runs the products for one lake and writes its outputs, after logging is set up and the data checked.
+        The data products are loaded for the first lake and kept, so a driver running many lakes one
+        after another (like the lake_runner workers) keeps their opened datasets.
+        Returns path to output directory!
+        """
+        self.reset_lake_state()
         # Access lake information#
-        lake_extraction_object = lake_extraction.LakeExtraction()
         lake_extraction_object.extract_lake_information(HYLAK_ID)
         GLHE.CLAY.globals.config["LAKE_NAME"] = lake_extraction_object.get_lake_name()
+        GLHE.CLAY.globals.config["HYLAK_ID"] = HYLAK_ID
 
         helpers.setup_output_directory(GLHE.CLAY.globals.config["LAKE_NAME"])
 
@@ -136,33 +167,200 @@ class CLAY_driver:
         self.lake_polygon = lake_extraction_object.get_lake_polygon()
 
         # Collect the data #
-        self.data_products = self.load_data_product_list()
+        if not self.data_products:
+            self.data_products = self.load_data_product_list()
+        for key in self.data_products:
+            self.data_products[key]["output_datasets"] = []
+
+        product_results = product_scheduler.run_products_concurrently(
+            {
+                key: self.data_products[key]["object"]
+                for key in self.data_products
+                if self.data_products[key]["run_on_start"]
+            },
+            self.lake_polygon,
+            GLHE.CLAY.globals.config["DEBUG"],
+            GLHE.CLAY.globals.config["RUN_CLEANLY"],
+        )
+        # Results are in the order of data_products, so the index is the same every run
+        for key, (output_datasets, e) in product_results.items():
+            if isinstance(e, TimeoutError):
+                # The thread of the product may still be running on the object, the next lake gets a new one
+                self.data_products[key]["object"] = self.make_data_product_object(key)
+            if e is not None:
+                self.data_products[key]["loaded"] = False
+                self.root_logger.error(
+                    "Data Product: {} not available for this lake with Exception: {}".format(
+                        key, e
+                    )
+                )
+                continue
+            self.data_products[key]["loaded"] = True
+            self.data_products[key]["output_datasets"] = output_datasets
+            for ds in output_datasets:
+                self.root_logger.info(ds)
+            self.datasets_index["all"].extend(output_datasets)
+
+        self.attach_geodata_of_loaded_products()
+        self.write_lake_outputs()
+        return GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+
+    def restore_lake(
+        self, HYLAK_ID: int, lake_extraction_object: lake_extraction.LakeExtraction
+    ) -> str:
+        """
+        Sets the driver up for a lake whose outputs were written before, without running its products, so
+        products can be added with run_product(key, incremental=True).
+        Returns path to output directory!
+        """
+        self.reset_lake_state()
+        lake_extraction_object.extract_lake_information(HYLAK_ID)
+        GLHE.CLAY.globals.config["LAKE_NAME"] = lake_extraction_object.get_lake_name()
+        GLHE.CLAY.globals.config["HYLAK_ID"] = HYLAK_ID
+        helpers.setup_output_directory(GLHE.CLAY.globals.config["LAKE_NAME"])
+        helpers.setup_logging_directory(
+            os.path.join(
+                GLHE.CLAY.globals.config["DIRECTORIES"]["LAKE_OUTPUT_FOLDER"],
+                GLHE.CLAY.globals.config["LAKE_NAME"],
+            )
+        )
+        self.lake_polygon = lake_extraction_object.get_lake_polygon()
+
+        self.data_products = self.load_data_product_list(instantiate=False)
+        data_products_file = (
+            GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+            + "/"
+            + GLHE.CLAY.globals.config["LAKE_NAME"]
+            + "_data_products.json"
+        )
+        if os.path.exists(data_products_file):
+            with open(data_products_file, "r") as f:
+                written_data_products = json.load(f)
+            for key in self.data_products:
+                if key in written_data_products:
+                    self.data_products[key]["loaded"] = written_data_products[key][
+                        "loaded"
+                    ]
+        return GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+
+    def reset_lake_state(self) -> None:
+        """
+        This function clears the datasets and output information of the last lake.
+        """
+        self.datasets_index = {"all": [], "grid": [], "slc": {}}
+        for key in GLHE.CLAY.globals.SLC_MAPPING_REVERSE_NAMES:
+            self.datasets_index["slc"][key] = []
+        self.read_me_information = {"Data_Product": {}, "Output_File": {}}
+        self.output_file_config = {}
+
+    def run_many(self, hylak_ids: list[int]) -> dict[int, str]:
+        """
+        Runs the driver for many lakes, opening each data product once and processing all the lakes with it
+        before writing the same outputs as main for each lake. The data of all the lakes is also kept in
+        pandas_panel, indexed by (Hylak_id, time).
+        Lakes that can't be found or fail are logged and left out.
+        Returns Hylak_id -> path to output directory
+        """
+        self.set_up_logging()
+        self.root_logger.info(
+            "***********************Initializing Batch Driver Function*************************"
+        )
+        data_check.check_data_and_download_missing_data_or_files()
+
+        # Access lake information#
+        lake_extraction_object = lake_extraction.LakeExtraction()
+        lake_names = {}
+        lake_polygons = {}
+        for hylak_id in hylak_ids:
+            try:
+                lake_extraction_object.extract_lake_information(hylak_id)
+                lake_names[hylak_id] = lake_extraction_object.get_lake_name()
+                lake_polygons[hylak_id] = lake_extraction_object.get_lake_polygon()
+            except Exception as e:
+                self.root_logger.error(
+                    "Lake: {} not available with Exception: {}".format(hylak_id, e)
+                )
 
+        # Collect the data for every lake #
+        self.data_products = self.load_data_product_list()
+        product_outputs = {}
+        # The products run once for all the lakes, their events are sent again for each lake's README
+        product_events = {}
         for key in self.data_products:
             if self.data_products[key]["run_on_start"]:
-                self.data_products[key]["loaded"] = True
+                self.data_products[key]["object"].hold_events()
                 try:
-                    self.data_products[key]["output_datasets"] = self.data_products[
-                        key
-                    ]["object"].product_driver(
-                        self.lake_polygon,
+                    product_outputs[key] = self.data_products[key][
+                        "object"
+                    ].product_driver_many(
+                        lake_polygons,
                         GLHE.CLAY.globals.config["DEBUG"],
                         GLHE.CLAY.globals.config["RUN_CLEANLY"],
                     )
-                    for ds in self.data_products[key]["output_datasets"]:
-                        self.root_logger.info(ds)
-                    self.datasets_index["all"].extend(
-                        self.data_products[key]["output_datasets"]
-                    )
+                    product_events[key] = self.data_products[key]["object"].held_events
                 except Exception as e:
-                    self.data_products[key]["loaded"] = False
+                    product_outputs[key] = {}
                     self.root_logger.error(
-                        "Data Product: {} not available for this lake with Exception: {}".format(
+                        "Data Product: {} not available with Exception: {}".format(
                             key, e
                         )
                     )
+                self.data_products[key]["object"].drop_held_events()
+
+        # Output each lake #
+        output_directories = {}
+        lake_datasets_dicts = {}
+        for hylak_id in lake_polygons:
+            self.reset_lake_state()
+            GLHE.CLAY.globals.config["LAKE_NAME"] = lake_names[hylak_id]
+            GLHE.CLAY.globals.config["HYLAK_ID"] = hylak_id
+            helpers.setup_output_directory(GLHE.CLAY.globals.config["LAKE_NAME"])
+            helpers.setup_logging_directory(
+                os.path.join(
+                    GLHE.CLAY.globals.config["DIRECTORIES"]["LAKE_OUTPUT_FOLDER"],
+                    GLHE.CLAY.globals.config["LAKE_NAME"],
+                )
+            )
+            self.lake_polygon = lake_polygons[hylak_id]
+            for key in self.data_products:
+                self.data_products[key]["loaded"] = hylak_id in product_outputs.get(
+                    key, {}
+                )
+                self.data_products[key]["output_datasets"] = []
+                if self.data_products[key]["loaded"]:
+                    self.data_products[key]["object"].select_lake(hylak_id)
+                    for msg in product_events.get(key, []):
+                        pubsub.EventBus.Publish(pubsub.EventBus, msg)
+                    self.data_products[key]["output_datasets"] = product_outputs[key][
+                        hylak_id
+                    ]
+                    self.datasets_index["all"].extend(
+                        self.data_products[key]["output_datasets"]
+                    )
+            try:
+                self.attach_geodata_of_loaded_products()
+                self.write_lake_outputs()
+                output_directories[hylak_id] = GLHE.CLAY.globals.config[
+                    "DIRECTORIES"
+                ]["OUTPUT_DIRECTORY"]
+                lake_datasets_dicts[hylak_id] = self.datasets_index["slc"]
+            except Exception as e:
+                self.root_logger.error(
+                    "Outputs for Lake: {} failed with Exception: {}".format(hylak_id, e)
+                )
+        # Every lake's data in one (lake, time) x slc.product table
+        self.pandas_panel = combined_data_functions.merge_mv_series_into_panel(
+            lake_datasets_dicts
+        )
+        logging.info(
+            '"***********************Finished Batch Driver Function*************************"'
+        )
+        return output_directories
 
-        # Attach Geodata
+    def attach_geodata_of_loaded_products(self) -> None:
+        """
+        This function attaches the geodata of every loaded product, and indexes the gridded ones.
+        """
         for key in self.data_products:
             if self.data_products[key]["loaded"]:
                 try:
@@ -184,9 +382,11 @@ class CLAY_driver:
                         )
                     )
 
-        combined_data_functions.present_mv_series_as_geospatial_at_date_time(
-            pd.to_datetime("2002-05-01"), *self.datasets_index["grid"]
-        )
+    def write_lake_outputs(self) -> None:
+        """
+        This function writes the GeoTIFFs, plot, csv, README and configs of the current lake.
+        """
+        self.write_gridded_layers(*self.datasets_index["grid"])
 
         # Plot and Output
         self.index_datasets()  # Required for datasets_index: slc
@@ -196,23 +396,75 @@ class CLAY_driver:
             )
         )
         combined_data_functions.output_plot_of_all_data(self.pandas_dataset)
-        combined_data_functions.output_all_compiled_data_to_csv(
-            GLHE.CLAY.globals.config["LAKE_NAME"] + "_Data.csv", self.pandas_dataset
+        combined_data_functions.output_all_compiled_data(
+            GLHE.CLAY.globals.config["LAKE_NAME"] + "_Data", self.pandas_dataset
         )
 
         self.export_data_product_config()
         combined_data_functions.write_and_output_README(self.read_me_information)
         combined_data_functions.write_and_output_LIME_CONFIG(self.output_file_config)
-        logging.info(
-            '"***********************Finished Driver Function*************************"'
+
+    def write_gridded_layers(
+        self, *datasets: helpers.MVSeries, append: bool = False
+    ) -> None:
+        """
+        This function writes the gridded layers of the datasets into the lake's zip, appending to it if append.
+        """
+        if GLHE.CLAY.globals.config["GRIDDED_TIME_STACK"]:
+            combined_data_functions.present_mv_series_as_geospatial_time_stack(
+                pd.to_datetime(
+                    GLHE.CLAY.globals.config["GRIDDED_TIME_STACK_START_DATE"]
+                ),
+                pd.to_datetime(
+                    GLHE.CLAY.globals.config["GRIDDED_TIME_STACK_END_DATE"]
+                ),
+                *datasets,
+                append=append,
+            )
+        else:
+            combined_data_functions.present_mv_series_as_geospatial_at_date_time(
+                pd.to_datetime("2002-05-01"), *datasets, append=append
+            )
+
+    def write_product_outputs(self, key: str) -> None:
+        """
+        This function adds the outputs of one product to the outputs written before: only its gridded layers
+        are written into the zip, its columns are appended to the series data, and the data products,
+        README and CONFIG files are patched.
+        """
+        if not self.data_products[key]["loaded"]:
+            self.export_data_product_config()
+            return
+        output_datasets = self.data_products[key]["output_datasets"]
+        grid_datasets = [
+            ds
+            for ds in output_datasets
+            if any(ds is grid_ds for grid_ds in self.datasets_index["grid"])
+        ]
+        if grid_datasets:
+            self.write_gridded_layers(*grid_datasets, append=True)
+
+        product_dataset = combined_data_functions.merge_mv_series_into_pandas_dataframe(
+            {
+                slc: [ds for ds in output_datasets if ds.single_letter_code == slc]
+                for slc in GLHE.CLAY.globals.SLC_MAPPING_REVERSE_NAMES
+            }
         )
-        return GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+        self.pandas_dataset = combined_data_functions.append_compiled_data(
+            GLHE.CLAY.globals.config["LAKE_NAME"] + "_Data", product_dataset
+        )
+        combined_data_functions.output_plot_of_all_data(self.pandas_dataset)
+
+        self.export_data_product_config()
+        combined_data_functions.patch_README(self.read_me_information)
+        combined_data_functions.patch_LIME_CONFIG(self.output_file_config)
 
     def export_data_product_config(self) -> None:
-        data_products_temp = self.data_products.copy()
-        for key in self.data_products:
-            data_products_temp[key]["object"] = None
-            data_products_temp[key]["output_datasets"] = None
+        # Copies, so the products' objects and datasets are kept for later runs
+        data_products_temp = {
+            key: dict(value, object=None, output_datasets=None)
+            for key, value in self.data_products.items()
+        }
         output_file_name = (
             GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
             + "/"
@@ -232,19 +484,19 @@ class CLAY_driver:
             ),
         )
 
-    def run_product(self, key: str) -> None:
+    def run_product(self, key: str, incremental: bool = False) -> None:
         """
         This function runs the specified product from self.data_products
+        If incremental, only the product's outputs are added to the lake's outputs written before (see
+        write_product_outputs), otherwise all the outputs are written again. Lakes without series data
+        written before always get all the outputs.
         """
         logging.info(
             '"***********************Start Product Run*************************"'
         )
         if key is None:
             return
-        self.data_products[key]["object"] = getattr(
-            globals()[self.data_products[key]["module_name"]],
-            self.data_products[key]["class_name"],
-        )()
+        self.data_products[key]["object"] = self.make_data_product_object(key)
         self.data_products[key]["output_datasets"] = []
         try:
             self.data_products[key]["loaded"] = True
@@ -281,42 +533,37 @@ class CLAY_driver:
                 "Response from attach_geodata() must be either 'grid' or 'complete'"
             )
 
-        combined_data_functions.present_mv_series_as_geospatial_at_date_time(
-            pd.to_datetime("2002-05-01"), *self.datasets_index["grid"]
-        )
-
-        # Plot and Output
-        self.index_datasets()  # Required for datasets_index: slc
-        self.pandas_dataset = (
-            combined_data_functions.merge_mv_series_into_pandas_dataframe(
-                self.datasets_index["slc"]
-            )
-        )
-        combined_data_functions.output_plot_of_all_data(self.pandas_dataset)
-        combined_data_functions.output_all_compiled_data_to_csv(
-            GLHE.CLAY.globals.config["LAKE_NAME"] + "_Data.csv", self.pandas_dataset
-        )
-        self.export_data_product_config()
-        combined_data_functions.write_and_output_README(self.read_me_information)
-        combined_data_functions.write_and_output_LIME_CONFIG(self.output_file_config)
+        if incremental and combined_data_functions.compiled_data_files(
+            GLHE.CLAY.globals.config["LAKE_NAME"] + "_Data"
+        ):
+            self.write_product_outputs(key)
+        else:
+            self.write_lake_outputs()
 
         logging.info(
             '"***********************Finished Product Run*************************"'
         )
 
-    def load_data_product_list(self) -> dict:
+    def make_data_product_object(self, key: str) -> data_access_parent_class.DataAccess:
+        """Makes a new object of the data product from its module_name and class_name"""
+        return getattr(
+            globals()[self.data_products[key]["module_name"]],
+            self.data_products[key]["class_name"],
+        )()
+
+    def load_data_product_list(self, instantiate: bool = True) -> dict:
         """
         This function loads the data product list, and adds required fields.
+        The product objects are only made if instantiate, run_product makes the object of the product it runs.
         """
         with open(
             os.path.join(Path(__file__).parent, "config", "data_products.json"), "r"
         ) as f:
             self.data_products = json.load(f)
         for key in self.data_products:
-            self.data_products[key]["object"] = getattr(
-                globals()[self.data_products[key]["module_name"]],
-                self.data_products[key]["class_name"],
-            )()
+            self.data_products[key]["object"] = None
+            if instantiate:
+                self.data_products[key]["object"] = self.make_data_product_object(key)
             self.data_products[key]["output_datasets"] = []
 
         return self.data_products
@@ -1,22 +1,57 @@
-from pint import UnitRegistry
+import importlib
+import os
+import sys
+import threading
 
 from . import globals
 
-import os
+# The submodules are imported when they are first used (PEP 562), so importing GLHE.CLAY is cheap
+__all__ = [
+    "CLAY_driver",
+    "combined_data_functions",
+    "data_access",
+    "globals",
+    "helpers",
+    "lake_extraction",
+    "lake_runner",
+    "product_cache",
+    "product_scheduler",
+    "xarray_helpers",
+    "ureg",
+    "Q_",
+]
+
+# Units from different registries can't be mixed, so the registry is only ever built once
+unit_registry_lock = threading.Lock()
+
+
+def load_unit_registry() -> None:
+    """Builds the pint unit registry (ureg & Q_) with the GLHE unit definitions"""
+    module_variables = sys.modules[__name__].__dict__
+    with unit_registry_lock:
+        if "ureg" in module_variables:
+            return
+        from pint import UnitRegistry
+
+        registry = UnitRegistry(force_ndarray_like=True)
+        registry.load_definitions(
+            os.path.join(
+                os.path.dirname(__file__),
+                globals.config["DIRECTORIES"]["UNIT_DEFINITION_FILE_PATH"],
+            )
+        )
+        module_variables["Q_"] = registry.Quantity
+        module_variables["ureg"] = registry
+
+
+def __getattr__(name):
+    if name in ("ureg", "Q_"):
+        load_unit_registry()
+        return sys.modules[__name__].__dict__[name]
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
-ureg = UnitRegistry(force_ndarray_like=True)
-Q_ = ureg.Quantity
-ureg.load_definitions(
-    os.path.join(
-        os.path.dirname(__file__),
-        globals.config["DIRECTORIES"]["UNIT_DEFINITION_FILE_PATH"],
-    )
-)
-from . import (
-    CLAY_driver,
-    combined_data_functions,
-    globals,
-    helpers,
-    lake_extraction,
-    xarray_helpers,
-)
+def __dir__():
+    return sorted(set(sys.modules[__name__].__dict__) | set(__all__))
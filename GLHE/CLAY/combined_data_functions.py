@@ -1,8 +1,11 @@
 import zipfile
 import logging
+import os
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import rasterio
+import rasterio.io
 import snakemd
 import json
 from GLHE.CLAY.globals import SLC_MAPPING_REVERSE_UNITS, SLC_MAPPING_REVERSE_NAMES
@@ -13,40 +16,97 @@ from GLHE.CALCITE import pubsub, events
 logger = logging.getLogger(__name__)
 
 
+def mv_series_columns(datasets_dict: dict) -> list[tuple[str, pd.Series]]:
+    """The "slc.product" column name and series of every mv_series, in the order of SLC_MAPPING_REVERSE_NAMES"""
+    columns = []
+    for key in SLC_MAPPING_REVERSE_NAMES:
+        for ds in datasets_dict.get(key, []):
+            col_name = ds.single_letter_code + "." + ds.product_name
+            ds.dataset.name = col_name
+            columns.append((col_name, ds.dataset))
+    return columns
+
+
+def union_time_index(series_list: list[pd.Series]) -> pd.Index:
+    """The sorted union of the indexes of the series, computed once for all of them"""
+    indexes = [series.index for series in series_list]
+    index = indexes[0].append(indexes[1:]).unique().sort_values()
+    index.name = indexes[0].name
+    return index
+
+
 def merge_mv_series_into_pandas_dataframe(datasets_dict: dict) -> pd.DataFrame:
     """
-    Merges mv_series from all the products into a single dataframe
+    Merges mv_series from all the products into a single dataframe. The time indexes are unioned once and
+    every series is aligned to it, instead of outer merging the growing dataframe with one series at a time.
     Parameters
     ----------
-    datasets : list[mv_series]
-        List of mv_series to be merged
+    datasets_dict : dict
+        SLC -> list[mv_series] to be merged
     Returns
     -------
     pd.DataFrame
-        Merged mv_series
+        Merged mv_series, one "slc.product" column per mv_series
     """
-    precip_col_names = []
-    evap_col_names = []
-    runoff_col_names = []
-    precip = []
-    evap = []
-    runoff = []
-    df = pd.DataFrame()
-    for key in SLC_MAPPING_REVERSE_NAMES:
-        for ds in datasets_dict[key]:
-            col_name = ds.single_letter_code + "." + ds.product_name
-            ds.dataset.name = col_name
-            df = pd.merge(
-                df,
-                ds.dataset.to_frame(),
-                how="outer",
-                left_index=True,
-                right_index=True,
-            )
+    columns = mv_series_columns(datasets_dict)
+    if not columns:
+        return pd.DataFrame()
+    index = union_time_index([series for _, series in columns])
+    df = pd.concat(
+        [series.reindex(index).rename(col_name) for col_name, series in columns],
+        axis=1,
+    )
     logger.info("Merged datasets into pandas dataframe")
     return df
 
 
+def merge_mv_series_into_panel(lake_datasets_dicts: dict) -> pd.DataFrame:
+    """
+    Merges the mv_series of many lakes into one (lake, time) x slc.product panel, filling the columns
+    directly instead of building and concatenating a dataframe per lake
+    Parameters
+    ----------
+    lake_datasets_dicts : dict
+        Lake key (e.g. Hylak_id) -> SLC -> list[mv_series], like merge_mv_series_into_pandas_dataframe takes
+    Returns
+    -------
+    pd.DataFrame
+        Rows indexed by (lake, time), each lake with the union of its own times, and a column for every
+        "slc.product" of any lake, NaN where a lake doesn't have the product
+    """
+    lake_columns = {
+        lake: mv_series_columns(datasets_dict)
+        for lake, datasets_dict in lake_datasets_dicts.items()
+    }
+    lake_indexes = {
+        lake: union_time_index([series for _, series in columns])
+        for lake, columns in lake_columns.items()
+        if columns
+    }
+    if not lake_indexes:
+        return pd.DataFrame()
+    lengths = [len(index) for index in lake_indexes.values()]
+    offsets = dict(zip(lake_indexes, np.cumsum([0] + lengths[:-1])))
+    time_name = next(iter(lake_indexes.values())).name
+    panel_index = pd.MultiIndex.from_arrays(
+        [
+            np.repeat(list(lake_indexes), lengths),
+            next(iter(lake_indexes.values())).append(list(lake_indexes.values())[1:]),
+        ],
+        names=["lake", time_name if time_name is not None else "time"],
+    )
+
+    panel_columns = {}
+    for lake, columns in lake_columns.items():
+        for col_name, series in columns:
+            if col_name not in panel_columns:
+                panel_columns[col_name] = np.full(len(panel_index), np.nan)
+            rows = offsets[lake] + lake_indexes[lake].get_indexer(series.index)
+            panel_columns[col_name][rows] = series.to_numpy(dtype=float)
+    logger.info("Merged datasets of {} lakes into a panel".format(len(lake_indexes)))
+    return pd.DataFrame(panel_columns, index=panel_index)
+
+
 def output_plot_of_all_data(dataset: pd.DataFrame) -> None:
     """Plot Precip, Evap, & Runoff in a three panel plot
 
@@ -141,8 +201,309 @@ def output_all_compiled_data_to_csv(filename: str, dataset: pd.DataFrame) -> Non
     )
 
 
+# Series data formats CLAY can write, fastest for LIME to read first
+SERIES_DATA_FORMATS = {"arrow": ".arrow", "parquet": ".parquet", "csv": ".csv"}
+
+
+def output_all_compiled_data(filename: str, dataset: pd.DataFrame) -> None:
+    """Output data in every format of SERIES_DATA_FORMATS in the config
+
+    Parameters
+    ----------
+    dataset : pd.DataFrame
+        The monthly pandas Dataframe dataset
+    filename: str
+        The output file name/location, without extension
+    Returns
+    -------
+    a file per format in the location specified, the files of the other formats are deleted so they can't be
+    read in place of the new data
+    """
+    written_formats = []
+    for series_format in GLHE.CLAY.globals.config["SERIES_DATA_FORMATS"]:
+        if series_format not in SERIES_DATA_FORMATS:
+            raise ValueError("Unknown series data format: {}".format(series_format))
+        output_function = {
+            "csv": output_all_compiled_data_to_csv,
+            "parquet": output_all_compiled_data_to_parquet,
+            "arrow": output_all_compiled_data_to_arrow,
+        }[series_format]
+        try:
+            output_function(filename + SERIES_DATA_FORMATS[series_format], dataset)
+            written_formats.append(series_format)
+        except ImportError as e:
+            # Parquet & Arrow need pyarrow
+            logger.warning(
+                "Not writing {} series data, missing dependency: {}".format(
+                    series_format, e
+                )
+            )
+    for series_format in SERIES_DATA_FORMATS:
+        file_path = compiled_data_path(filename, series_format)
+        if series_format not in written_formats and os.path.exists(file_path):
+            logger.info("Deleting out of date series data: " + file_path)
+            os.remove(file_path)
+
+
+def compiled_data_path(filename: str, series_format: str) -> str:
+    """The path of the series data file of one format, filename without extension"""
+    return (
+        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+        + "/"
+        + filename
+        + SERIES_DATA_FORMATS[series_format]
+    )
+
+
+def compiled_data_files(filename: str) -> list[str]:
+    """The series data files written by output_all_compiled_data in the configured formats, fastest to read first"""
+    return [
+        compiled_data_path(filename, series_format)
+        for series_format in SERIES_DATA_FORMATS
+        if series_format in GLHE.CLAY.globals.config["SERIES_DATA_FORMATS"]
+        and os.path.exists(compiled_data_path(filename, series_format))
+    ]
+
+
+def output_all_compiled_data_to_parquet(filename: str, dataset: pd.DataFrame) -> None:
+    """Output data into zstd compressed parquet, the time index is kept as typed timestamps
+
+    Parameters
+    ----------
+    dataset : pd.DataFrame
+        The monthly pandas Dataframe dataset
+    filename: str
+        The output file name/location
+    Returns
+    -------
+    a parquet file in the location specified
+    """
+    dataset.to_parquet(
+        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"] + "/" + filename,
+        compression="zstd",
+    )
+    logger.info(
+        "Output Parquet written here: "
+        + GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+        + "/"
+        + filename
+    )
+    pubsub.EventBus.Publish(
+        pubsub.EventBus,
+        events.OutputFileEvent(
+            filename,
+            GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+            + "/"
+            + filename,
+            ".parquet",
+            "A parquet file of all data, the main product in a columnar format",
+            events.TypeOfFileLIME.SERIES_DATA,
+        ),
+    )
+
+
+def output_all_compiled_data_to_arrow(filename: str, dataset: pd.DataFrame) -> None:
+    """Output data into an lz4 compressed Arrow IPC (feather) file, the time index is written as a column
+
+    Parameters
+    ----------
+    dataset : pd.DataFrame
+        The monthly pandas Dataframe dataset
+    filename: str
+        The output file name/location
+    Returns
+    -------
+    an arrow file in the location specified
+    """
+    dataset.reset_index().to_feather(
+        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"] + "/" + filename,
+        compression="lz4",
+    )
+    logger.info(
+        "Output Arrow written here: "
+        + GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+        + "/"
+        + filename
+    )
+    pubsub.EventBus.Publish(
+        pubsub.EventBus,
+        events.OutputFileEvent(
+            filename,
+            GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+            + "/"
+            + filename,
+            ".arrow",
+            "An Arrow IPC file of all data, the main product in a columnar format",
+            events.TypeOfFileLIME.SERIES_DATA,
+        ),
+    )
+
+
+def read_compiled_data(filename: str) -> pd.DataFrame:
+    """Reads the series data written by output_all_compiled_data, from its fastest configured format. None if
+    there is none
+
+    Parameters
+    ----------
+    filename: str
+        The output file name/location, without extension
+    Returns
+    -------
+    pd.DataFrame
+        The series data, indexed by time
+    """
+    for file_path in compiled_data_files(filename):
+        extension = os.path.splitext(file_path)[1]
+        try:
+            if extension == ".parquet":
+                return pd.read_parquet(file_path)
+            if extension == ".arrow":
+                return pd.read_feather(file_path).set_index("time")
+        except ImportError:
+            continue
+        return pd.read_csv(file_path, index_col=0, parse_dates=True)
+    return None
+
+
+def append_compiled_data(filename: str, dataset: pd.DataFrame) -> pd.DataFrame:
+    """Adds the columns of dataset to the series data written before and writes it again in every format
+
+    Columns already in the series data are replaced, and the columns are kept in the order of
+    SLC_MAPPING_REVERSE_NAMES like merge_mv_series_into_pandas_dataframe makes them
+    Parameters
+    ----------
+    dataset : pd.DataFrame
+        The monthly pandas Dataframe of the new columns
+    filename: str
+        The output file name/location, without extension
+    Returns
+    -------
+    pd.DataFrame
+        The series data with the new columns
+    """
+    existing = read_compiled_data(filename)
+    if existing is not None and len(existing.columns):
+        existing = existing.drop(columns=dataset.columns, errors="ignore")
+        index = union_time_index([existing, dataset])
+        dataset = pd.concat([existing.reindex(index), dataset.reindex(index)], axis=1)
+        slc_order = list(SLC_MAPPING_REVERSE_NAMES)
+        dataset = dataset[
+            sorted(
+                dataset.columns,
+                key=lambda col: slc_order.index(col.split(".")[0])
+                if col.split(".")[0] in slc_order
+                else len(slc_order),
+            )
+        ]
+    output_all_compiled_data(filename, dataset)
+    return dataset
+
+
+def fastest_series_data_file(*file_paths: str) -> str:
+    """Of series data files of the same data, the one in the format fastest to read. None paths are ignored"""
+    read_order = list(SERIES_DATA_FORMATS.values())
+    return min(
+        (file_path for file_path in file_paths if file_path is not None),
+        key=lambda file_path: read_order.index(os.path.splitext(file_path)[1]),
+    )
+
+
+def time_dimension(variable) -> str:
+    """The name of the time dimension of a gridded product, time or valid_time"""
+    return "time" if "time" in variable.dims else "valid_time"
+
+
+def write_geotiff_into_zip(
+    zf: zipfile.ZipFile,
+    filename: str,
+    data,
+    lat,
+    lon,
+    band_descriptions: list[str] = None,
+    cloud_optimized: bool = False,
+) -> None:
+    """
+    Writes a GeoTIFF of bands x lat x lon data in memory and adds it to the zip, without temporary files
+    Parameters
+    ----------
+    zf : zipfile.ZipFile
+        The open zip to write into
+    filename : str
+        The name of the GeoTIFF in the zip
+    data : np.ndarray
+        lat x lon or bands x lat x lon values
+    lat : np.ndarray
+        The latitudes of the grid
+    lon : np.ndarray
+        The longitudes of the grid
+    band_descriptions : list[str]
+        A description per band, the dates of a time stack
+    cloud_optimized : bool
+        Write a compressed, tiled Cloud-Optimized GeoTIFF with overviews instead of a plain GeoTIFF
+    """
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    profile = {
+        "driver": "GTiff",
+        "height": len(lat),
+        "width": len(lon),
+        "count": data.shape[0],
+        "dtype": data.dtype,
+        "crs": "EPSG:4326",
+        "transform": rasterio.transform.from_bounds(
+            lon.min(), lat.min(), lon.max(), lat.max(), len(lon), len(lat)
+        ),
+    }
+    if cloud_optimized:
+        profile.update(
+            driver="COG",
+            compress="DEFLATE",
+            predictor=3 if np.issubdtype(data.dtype, np.floating) else 2,
+            overviews="AUTO",
+            bigtiff="IF_SAFER",
+        )
+        if np.issubdtype(data.dtype, np.floating):
+            profile["nodata"] = np.nan
+    with rasterio.io.MemoryFile() as memory_file:
+        with memory_file.open(**profile) as dst:
+            dst.write(data)
+            for band, description in enumerate(band_descriptions or [], start=1):
+                dst.set_band_description(band, description)
+        zf.writestr(filename, memory_file.read())
+
+
+def drop_zip_entries(zip_file: str, prefixes: list[str]) -> None:
+    """Rewrites the zip without the files starting with any of the prefixes, if it has any"""
+    if not os.path.exists(zip_file):
+        return
+    with zipfile.ZipFile(zip_file, "r") as zf:
+        names = zf.namelist()
+        kept = [name for name in names if not name.startswith(tuple(prefixes))]
+        if len(kept) == len(names):
+            return
+        with zipfile.ZipFile(zip_file + ".tmp", "w") as new_zf:
+            for name in kept:
+                new_zf.writestr(zf.getinfo(name), zf.read(name))
+    os.replace(zip_file + ".tmp", zip_file)
+
+
+def open_gridded_zip(zip_file: str, append: bool, *dss: MVSeries) -> zipfile.ZipFile:
+    """
+    Opens the zip of gridded layers to write the layers of dss. In append mode the layers of other products
+    are kept and the old layers of these products are dropped
+    """
+    if append and os.path.exists(zip_file):
+        drop_zip_entries(
+            zip_file,
+            [mvs.single_letter_code + "_" + mvs.product_name + "_" for mvs in dss],
+        )
+        return zipfile.ZipFile(zip_file, "a")
+    return zipfile.ZipFile(zip_file, "w")
+
+
 def present_mv_series_as_geospatial_at_date_time(
-    date: pd.Timestamp, *dss: MVSeries
+    date: pd.Timestamp, *dss: MVSeries, append: bool = False
 ) -> None:
     """
     present xarray datasets into some format, partially written by ChatGPT
@@ -152,57 +513,10 @@ def present_mv_series_as_geospatial_at_date_time(
         List of mv_series to be merged
     date : pd.Timestamp
         The date to be presented
-    filename : str
-        The output file name/location
+    append : bool
+        Add the layers of dss to the existing zip instead of writing a new one
     """
     logger.info("Outputting datasets on {} to GeoTIFF".format(date.strftime("%Y%m%d")))
-    input_files = []
-    input_filenames = []
-    for counter, mvs in enumerate(dss):
-        variable = mvs.xarray_dataarray
-        lat = variable["lat"].values
-        lon = variable["lon"].values
-        filename = (
-            mvs.single_letter_code
-            + "_"
-            + mvs.product_name
-            + "_"
-            + GLHE.CLAY.globals.config["LAKE_NAME"]
-            + "_"
-            + date.strftime("%Y%m%d")
-            + ".tif"
-        )
-        filepath = ".temp/TEMPORARY_GEOTIFF_" + filename
-        input_files.append(filepath)
-        input_filenames.append(filename)
-        width = len(lon)
-        height = len(lat)
-
-        try:
-            nearest_idx = list(variable.time.values).index(
-                variable.sel(time=date, method="nearest").time
-            )
-        except:
-            nearest_idx = list(variable.valid_time.values).index(
-                variable.sel(valid_time=date, method="nearest").valid_time
-            )
-
-        # Create the raster layer using rasterio
-        with rasterio.open(
-            filepath,
-            "w",
-            driver="GTiff",
-            height=len(lat),
-            width=len(lon),
-            count=1,
-            dtype=variable.dtype,
-            crs="EPSG:4326",
-            transform=rasterio.transform.from_bounds(
-                lon.min(), lat.min(), lon.max(), lat.max(), width, height
-            ),
-        ) as dst:
-            dst.write(variable[nearest_idx], 1)
-
     zip_file = (
         GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
         + "/"
@@ -221,14 +535,109 @@ def present_mv_series_as_geospatial_at_date_time(
             events.TypeOfFileLIME.GRIDDED_DATA_FOLDER,
         ),
     )
-    # Create a new ZIP file
-    with zipfile.ZipFile(zip_file, "w") as zf:
-        # Add each GeoTIFF file to the ZIP archive
-        for index, file in enumerate(input_files):
-            zf.write(file, input_filenames[index])
+    # The GeoTIFFs are written straight into the ZIP file
+    with open_gridded_zip(zip_file, append, *dss) as zf:
+        for mvs in dss:
+            variable = mvs.xarray_dataarray
+            filename = (
+                mvs.single_letter_code
+                + "_"
+                + mvs.product_name
+                + "_"
+                + GLHE.CLAY.globals.config["LAKE_NAME"]
+                + "_"
+                + date.strftime("%Y%m%d")
+                + ".tif"
+            )
+            nearest_idx = variable.indexes[time_dimension(variable)].get_indexer(
+                [date], method="nearest"
+            )[0]
+            write_geotiff_into_zip(
+                zf,
+                filename,
+                variable[nearest_idx].values,
+                variable["lat"].values,
+                variable["lon"].values,
+            )
 
     logger.info(f"GeoTIFF files zipped successfully: {zip_file}")
-    clean_up_specific_temporary_files("GEOTIFF")
+
+
+def present_mv_series_as_geospatial_time_stack(
+    start_date: pd.Timestamp, end_date: pd.Timestamp, *dss: MVSeries, append: bool = False
+) -> None:
+    """
+    Writes the time stack of each gridded product as one multi-band Cloud-Optimized GeoTIFF, a band per date
+    described by the date, so LIME can show any date without running CLAY again
+    Parameters
+    ----------
+    start_date : pd.Timestamp
+        The first date of the stack, the start of the products if None
+    end_date : pd.Timestamp
+        The last date of the stack, the end of the products if None
+    dss : MVSeries
+        The gridded mv_series
+    append : bool
+        Add the stacks of dss to the existing zip instead of writing a new one
+    """
+    date_range = (
+        ("start" if start_date is None else start_date.strftime("%Y%m%d"))
+        + "-"
+        + ("end" if end_date is None else end_date.strftime("%Y%m%d"))
+    )
+    logger.info("Outputting datasets from {} to a GeoTIFF stack".format(date_range))
+    zip_file = (
+        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+        + "/"
+        + GLHE.CLAY.globals.config["LAKE_NAME"]
+        + "_gridded_data_layers_"
+        + date_range
+        + ".zip"
+    )
+    pubsub.EventBus.Publish(
+        pubsub.EventBus,
+        events.OutputFileEvent(
+            zip_file,
+            zip_file,
+            ".zip",
+            "A zip file of Cloud-Optimized GeoTIFF time stacks of gridded products, a band per date",
+            events.TypeOfFileLIME.GRIDDED_DATA_FOLDER,
+        ),
+    )
+    with open_gridded_zip(zip_file, append, *dss) as zf:
+        for mvs in dss:
+            variable = mvs.xarray_dataarray
+            time_dim = time_dimension(variable)
+            variable = variable.sel({time_dim: slice(start_date, end_date)})
+            if variable.sizes[time_dim] == 0:
+                logger.warning(
+                    "{} has no dates from {}".format(mvs.product_name, date_range)
+                )
+                continue
+            times = pd.DatetimeIndex(variable[time_dim].values)
+            filename = (
+                mvs.single_letter_code
+                + "_"
+                + mvs.product_name
+                + "_"
+                + GLHE.CLAY.globals.config["LAKE_NAME"]
+                + "_"
+                + times[0].strftime("%Y%m%d")
+                + "-"
+                + times[-1].strftime("%Y%m%d")
+                + ".tif"
+            )
+            write_geotiff_into_zip(
+                zf,
+                filename,
+                variable.transpose(time_dim, "lat", "lon").values,
+                variable["lat"].values,
+                variable["lon"].values,
+                band_descriptions=[time.strftime("%Y-%m-%d") for time in times],
+                cloud_optimized=True,
+            )
+
+    logger.info(f"GeoTIFF stacks zipped successfully: {zip_file}")
 
 
 def write_and_output_README(read_me_information: dict) -> None:
@@ -266,6 +675,9 @@ def write_and_output_README(read_me_information: dict) -> None:
         )
     doc.add_ordered_list(Items)
     doc.dump(READ_ME_Name)
+    # Kept so later product runs can add to the README
+    with open(READ_ME_Name + ".json", "w") as f:
+        json.dump(read_me_information, f, indent=4)
     logger.info("Wrote README file to: " + READ_ME_Name)
     pubsub.EventBus.Publish(
         pubsub.EventBus,
@@ -282,6 +694,53 @@ def write_and_output_README(read_me_information: dict) -> None:
     return
 
 
+def patch_README(read_me_information: dict) -> None:
+    """
+    Adds the information of a product run to the README written before, and writes it again
+    """
+    READ_ME_Name = (
+        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
+        + "/"
+        + GLHE.CLAY.globals.config["LAKE_NAME"]
+        + "_README"
+    )
+    merged = {"Data_Product": {}, "Output_File": {}}
+    if os.path.exists(READ_ME_Name + ".json"):
+        with open(READ_ME_Name + ".json", "r") as f:
+            merged = json.load(f)
+    for key in merged:
+        merged[key].update(read_me_information.get(key, {}))
+    write_and_output_README(merged)
+
+
+LIME_CONFIG_KEYS = {
+    events.TypeOfFileLIME.READ_ME: "README",
+    events.TypeOfFileLIME.BLEEPBLEEP: "BLEEPBLEEP",
+    events.TypeOfFileLIME.OTHER: "OTHER",
+    events.TypeOfFileLIME.SERIES_DATA: "SERIES_DATA",
+    events.TypeOfFileLIME.GRIDDED_DATA_FOLDER: "GRIDDED_DATA_FOLDER",
+    events.TypeOfFileLIME.NWM_LAKE_POINT_SHAPEFILENAME: "NWM_LAKE_POINT_SHAPEFILENAME",
+}
+
+
+def patch_LIME_CONFIG(config_information: dict) -> None:
+    """
+    Updates the CONFIG file written before with the files of a product run, keeping the entries it didn't write
+    """
+    CONFIG_Name = (
+        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"] + "/CONFIG.json"
+    )
+    with open(CONFIG_Name, "r") as f:
+        ribbit = json.load(f)
+    for file_type, key in LIME_CONFIG_KEYS.items():
+        if file_type in config_information:
+            ribbit[key] = config_information[file_type]
+    ribbit["HYLAK_ID"] = GLHE.CLAY.globals.config["HYLAK_ID"]
+    with open(CONFIG_Name, "w") as fp:
+        json.dump(ribbit, fp)
+    logger.info("Patched CONFIG file: " + CONFIG_Name)
+
+
 def write_and_output_LIME_CONFIG(config_information: dict) -> None:
     """
     Create a CONFIG file that points to all exported data in LIME-readable format
@@ -301,6 +760,7 @@ def write_and_output_LIME_CONFIG(config_information: dict) -> None:
             "OUTPUT_DIRECTORY"
         ],
         "LAKE_NAME": GLHE.CLAY.globals.config["LAKE_NAME"],
+        "HYLAK_ID": GLHE.CLAY.globals.config["HYLAK_ID"],
     }
     try:
         ribbit["NWM_LAKE_POINT_SHAPEFILENAME"] = config_information[
@@ -5,11 +5,21 @@ from pathlib import Path
 from GLHE.CALCITE import events
 from GLHE.CLAY.data_access import data_access_parent_class
 from GLHE.CLAY.helpers import MVSeries
-from GLHE.CLAY import lake_extraction, helpers, xarray_helpers
+from GLHE.CLAY import lake_extraction, helpers, product_cache, xarray_helpers
+
+CRUTS_FILE_NAME = os.path.join(
+    Path(__file__).parent.parent, "LocalData/cruts_pet_pre_4.07_1901_2022.nc"
+)
+# Made by rechunk_local_data.py, read instead of the netcdf if it exists
+CRUTS_ZARR_STORE = os.path.join(
+    Path(__file__).parent.parent, "LocalData/cruts_pet_pre_4.07_1901_2022.zarr"
+)
 
 
 class CRUTS(data_access_parent_class.DataAccess):
     xarray_dataset: xr.Dataset
+    # Bump when call_CRUTS_access_and_process changes, so cached products are redone
+    PROCESSING_VERSION = 1
 
     def __init__(self):
         """Initializes the CRUTS Land Data Access class"""
@@ -41,45 +51,74 @@ class CRUTS(data_access_parent_class.DataAccess):
         xarray Dataset
             xarray Dataset format of the evap, precip, & runoff in a grid
         """
+        if self.xarray_dataset is not None:
+            return self.xarray_dataset
         self.logger.info("Reading in CRUTS data from LocalData folder")
-        self.xarray_dataset = self.xarray_dataset = xr.open_mfdataset(
-            os.path.join(
-                Path(__file__).parent.parent,
-                "LocalData/cruts_pet_pre_4.07_1901_2022.nc",
-            )
+        self.xarray_dataset = product_cache.open_source_zarr_store(
+            CRUTS_ZARR_STORE, product_cache.source_identity(CRUTS_FILE_NAME)
         )
+        if self.xarray_dataset is None:
+            self.xarray_dataset = xr.open_mfdataset(CRUTS_FILE_NAME)
         return self.xarray_dataset
 
     def product_driver(self, polygon, debug=False, run_cleanly=False) -> list[MVSeries]:
         """See parent class for description"""
+        results = self.product_driver_many({0: polygon}, debug, run_cleanly)
+        if 0 not in results:
+            raise ValueError("CRUTS could not be processed for this lake")
+        return results[0]
 
-        self.logger.info("CRUTS Driver Started: Precip & PET")
+    def product_driver_many(
+        self, polygons: dict, debug=False, run_cleanly=False
+    ) -> dict[object, list[MVSeries]]:
+        """See parent class for description, the CRUTS data is opened and read once for all the lakes"""
 
-        if not run_cleanly and not debug:
-            try:
-                self.logger.info("Trying to find pickled CRUTS data")
-                dataset = helpers.unpickle_var("CRUTS")
-            except FileNotFoundError:
-                self.logger.info(
-                    "No saved CRUTS Land data found, calling script to process data"
-                )
-                dataset = self.call_CRUTS_access_and_process(polygon)
-        else:
-            dataset = self.call_CRUTS_access_and_process(polygon)
+        self.logger.info("CRUTS Driver Started: Precip & PET")
 
-        pet_ds, precip_ds = xarray_helpers.spatially_average_xarray_dataset_and_convert(
-            dataset, "pet", "pre"
-        )
-        pet_ds, precip_ds = helpers.move_date_index_to_first_of_the_month(
-            pet_ds, precip_ds
+        source = product_cache.source_identity(CRUTS_FILE_NAME)
+        datasets = {}
+        uncached_datasets = {}
+        for key, polygon in polygons.items():
+            cache_key = product_cache.product_cache_key(
+                "CRUTS", polygon, source, self.PROCESSING_VERSION
+            )
+            if not run_cleanly and not debug:
+                self.logger.info("Trying to find cached CRUTS data")
+                datasets[key] = product_cache.read_cached_product(cache_key)
+            if datasets.get(key) is None:
+                self.logger.info("Calling script to process CRUTS data")
+                try:
+                    uncached_datasets[cache_key] = (
+                        key,
+                        self.call_CRUTS_access_and_process(polygon),
+                    )
+                except Exception as e:
+                    self.logger.error(
+                        "CRUTS failed for lake {} with Exception: {}".format(key, e)
+                    )
+                datasets.pop(key, None)
+        cached_datasets = product_cache.write_cached_products(
+            {cache_key: dataset for cache_key, (_, dataset) in uncached_datasets.items()}
         )
+        for cache_key, (key, _) in uncached_datasets.items():
+            datasets[key] = cached_datasets[cache_key]
+
+        results = {}
+        for key, dataset in datasets.items():
+            pet_ds, precip_ds = (
+                xarray_helpers.spatially_average_xarray_dataset_and_convert(
+                    dataset, "pet", "pre", **self.spatial_average_weighting(polygons[key])
+                )
+            )
+            results[key] = helpers.move_date_index_to_first_of_the_month(
+                pet_ds, precip_ds
+            )
         helpers.clean_up_specific_temporary_files("CRUTS")
-        list_of_MVSeries = [pet_ds, precip_ds]
         self.send_data_product_event(
             events.DataProductRunEvent("CRUTS", self.README_default_information)
         )
         self.logger.info("CRUTS Driver Finished")
-        return list_of_MVSeries
+        return results
 
     def call_CRUTS_access_and_process(self, polygon) -> xr.Dataset:
         """
@@ -98,10 +137,10 @@ class CRUTS(data_access_parent_class.DataAccess):
                 "CRUTS subset Polygon is too small for CRUTS, trying again with larger polygon"
             )
             dataset = lake_extraction.subset_box(dataset, polygon.buffer(0.5), 0)
+        dataset = xarray_helpers.chunk_xarray_dataset_to_memory_budget(dataset)
         dataset = xarray_helpers.convert_xarray_dataset_units(
             dataset, "mm/month", "pet", "pre"
         )
-        helpers.pickle_var(dataset, dataset.attrs["product_name"])
         return dataset
 
 
@@ -1,21 +1,28 @@
-import cdsapi
 import xarray as xr
 from GLHE.CALCITE import events
-from GLHE.CLAY import lake_extraction, helpers, xarray_helpers
+from GLHE.CLAY import lake_extraction, helpers, product_cache, xarray_helpers
 from GLHE.CLAY.data_access import data_access_parent_class
 from GLHE.CLAY.helpers import MVSeries
+import glob
 import os
 from pathlib import Path
 
+ERA5_FILE_PATTERN = os.path.join(Path(__file__).parent.parent, "LocalData/ERA5/*.nc")
+# Made by rechunk_local_data.py, read instead of the netcdf files if it exists
+ERA5_ZARR_STORE = os.path.join(Path(__file__).parent.parent, "LocalData/ERA5.zarr")
+
 
 class ERA5_Land(data_access_parent_class.DataAccess):
-    api_client: cdsapi.Client
+    api_client: "cdsapi.Client"
     xarray_dataset: xr.Dataset
+    # Bump when call_ERA5_Land_API_and_process changes, so cached products are redone
+    PROCESSING_VERSION = 1
 
     def __init__(self):
         """Initializes the ERA5 Land Data Access class"""
 
-        self.api_client = cdsapi.Client()
+        # Made when the API is first called, cdsapi is slow to import and needs a ~/.cdsapirc
+        self.api_client = None
         self.xarray_dataset = None
         self.README_default_information = (
             "Validate this data with the gridded geodata in the zip file"
@@ -54,6 +61,10 @@ class ERA5_Land(data_access_parent_class.DataAccess):
         """
         self.logger.info("Calling ERA5 Land API")
         try:
+            if self.api_client is None:
+                import cdsapi
+
+                self.api_client = cdsapi.Client()
             self.api_client.retrieve(
                 "reanalysis-era5-land-monthly-means",
                 {
@@ -174,30 +185,59 @@ class ERA5_Land(data_access_parent_class.DataAccess):
 
     def product_driver(self, polygon, debug=False, run_cleanly=False) -> list[MVSeries]:
         """See parent function for details"""
-        self.logger.info("ERA Driver Started: Precip & Evap")
+        results = self.product_driver_many({0: polygon}, debug, run_cleanly)
+        if 0 not in results:
+            raise ValueError("ERA5 Land could not be processed for this lake")
+        return results[0]
 
-        if not run_cleanly and not debug:
-            try:
-                self.logger.info("Attempting to find and read saved ERA5 Land data")
-                dataset = helpers.unpickle_var("ERA5_Land")
-            except FileNotFoundError:
-                self.logger.info("No saved ERA5 Land data found, calling API")
-                dataset = self.call_ERA5_Land_API_and_process(polygon)
-        else:
-            dataset = self.call_ERA5_Land_API_and_process(polygon)
+    def product_driver_many(
+        self, polygons: dict, debug=False, run_cleanly=False
+    ) -> dict[object, list[MVSeries]]:
+        """See parent function for details, the ERA5 Land data is opened and read once for all the lakes"""
+        self.logger.info("ERA Driver Started: Precip & Evap")
 
-        evap_ds, precip_ds = (
-            xarray_helpers.spatially_average_xarray_dataset_and_convert(
-                dataset, "e", "tp"
+        source = product_cache.source_identity(*sorted(glob.glob(ERA5_FILE_PATTERN)))
+        datasets = {}
+        uncached_datasets = {}
+        for key, polygon in polygons.items():
+            cache_key = product_cache.product_cache_key(
+                "ERA5_Land", polygon, source, self.PROCESSING_VERSION
             )
+            if not run_cleanly and not debug:
+                self.logger.info("Attempting to find and read cached ERA5 Land data")
+                datasets[key] = product_cache.read_cached_product(cache_key)
+            if datasets.get(key) is None:
+                self.logger.info("Processing ERA5 Land data")
+                try:
+                    uncached_datasets[cache_key] = (
+                        key,
+                        self.call_ERA5_Land_API_and_process(polygon),
+                    )
+                except Exception as e:
+                    self.logger.error(
+                        "ERA5 Land failed for lake {} with Exception: {}".format(key, e)
+                    )
+                datasets.pop(key, None)
+        cached_datasets = product_cache.write_cached_products(
+            {cache_key: dataset for cache_key, (_, dataset) in uncached_datasets.items()}
         )
+        for cache_key, (key, _) in uncached_datasets.items():
+            datasets[key] = cached_datasets[cache_key]
+
+        results = {}
+        for key, dataset in datasets.items():
+            evap_ds, precip_ds = (
+                xarray_helpers.spatially_average_xarray_dataset_and_convert(
+                    dataset, "e", "tp", **self.spatial_average_weighting(polygons[key])
+                )
+            )
+            results[key] = [precip_ds, evap_ds]
         helpers.clean_up_specific_temporary_files("ERA5Land")
-        list_of_MVSeries = [precip_ds, evap_ds]
         self.send_data_product_event(
             events.DataProductRunEvent("ERA5_Land", self.README_default_information)
         )
         self.logger.info("ERA Driver Finished")
-        return list_of_MVSeries
+        return results
 
     def call_ERA5_Land_API_and_process(self, polygon) -> xr.Dataset:
         """Calls the ERA5 Land API and processes the data"""
@@ -225,7 +265,10 @@ class ERA5_Land(data_access_parent_class.DataAccess):
             self.logger.error(
                 "ERA5 Land subset Failed: Polygon is too small for ERA5 Land, trying again with larger polygon"
             )
-            dataset = lake_extraction.subset_box(dataset, polygon.buffer(0.5), 0)
+            dataset = lake_extraction.subset_box(
+                dataset, polygon.buffer(0.5), 0, long_type_180=True
+            )
+        dataset = xarray_helpers.chunk_xarray_dataset_to_memory_budget(dataset)
         dataset = xarray_helpers.fix_weird_units_descriptors_in_xarray_datasets(
             dataset, "e", "m"
         )
@@ -238,7 +281,6 @@ class ERA5_Land(data_access_parent_class.DataAccess):
             dataset, "mm/month", "tp", "e"
         )
         dataset = xarray_helpers.make_sure_xarray_dataset_is_positive(dataset, "e")
-        helpers.pickle_var(dataset, dataset.attrs["product_name"])
         return dataset
 
     def get_total_dataset(self) -> xr.Dataset:
@@ -253,9 +295,17 @@ class ERA5_Land(data_access_parent_class.DataAccess):
         xarray Dataset
             xarray Dataset format of the evap, precip, & runoff in a grid
         """
+        if self.xarray_dataset is not None:
+            return self.xarray_dataset
         self.logger.info("Reading in ERA5 data from LocalData folder")
+        self.xarray_dataset = product_cache.open_source_zarr_store(
+            ERA5_ZARR_STORE,
+            product_cache.source_identity(*sorted(glob.glob(ERA5_FILE_PATTERN))),
+        )
+        if self.xarray_dataset is not None:
+            return self.xarray_dataset
         self.xarray_dataset = xr.open_mfdataset(
-            os.path.join(Path(__file__).parent.parent, "LocalData/ERA5/*.nc"),
+            ERA5_FILE_PATTERN,
             combine="by_coords",
         )
         return self.xarray_dataset
@@ -1,34 +1,243 @@
+import json
+import logging
 import os
+import pickle
 
-import fsspec
-import geopandas as gpd
+import numpy as np
 import xarray as xr
 from pyproj import CRS
+from scipy.spatial import cKDTree
 from shapely.geometry import Polygon, Point
-import boto3
 import GLHE
 from GLHE.CALCITE import events, pubsub
-from GLHE.CLAY import helpers, xarray_helpers
-from GLHE.CLAY.data_access import data_access_parent_class
+from GLHE.CLAY import helpers, product_cache, xarray_helpers
+from GLHE.CLAY.data_access import data_access_parent_class, NWM_mirror
 from GLHE.CLAY.helpers import MVSeries
 from pathlib import Path
 
+LAKEOUT_FILE_NAME = os.path.join(
+    Path(__file__).parent.parent, "LocalData/SAMPLE_NWM_LAKEOUT.nc"
+)
+CHRTOUT_FILE_NAME = os.path.join(
+    Path(__file__).parent.parent, "LocalData/SAMPLE_NWM_CHRTOUT.nc"
+)
+LAKE_INDEX_FILE_NAME = os.path.join(
+    Path(__file__).parent.parent, "LocalData/NWM_lakeout_feature_index.pickle"
+)
+HYLAK_FEATURE_TABLE_FILE_NAME = os.path.join(
+    Path(__file__).parent.parent, "LocalData/NWM_hylak_feature_table.json"
+)
+
+logger = logging.getLogger(__name__)
+
+
+def lakeout_source_stamp(lakeout_file_name: str = LAKEOUT_FILE_NAME) -> list:
+    """Size and modification time of the LAKEOUT file, the index is rebuilt when this changes"""
+    file_stat = os.stat(lakeout_file_name)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+class NWMLakeIndex:
+    """
+    A KD-tree over the (lon, lat) of every feature in the NWM LAKEOUT file, persisted next to LocalData
+    so finding a lake's feature is a tree query instead of a loop over every feature.
+    """
+
+    feature_id: np.ndarray
+    latitude: np.ndarray
+    longitude: np.ndarray
+    tree: cKDTree
+
+    def __init__(
+        self,
+        lakeout_file_name: str = LAKEOUT_FILE_NAME,
+        index_file_name: str = LAKE_INDEX_FILE_NAME,
+    ):
+        """Loads the index, building it from the LAKEOUT file if it's missing or out of date"""
+        stamp = lakeout_source_stamp(lakeout_file_name)
+        index = None
+        if os.path.exists(index_file_name):
+            try:
+                with open(index_file_name, "rb") as file:
+                    index = pickle.load(file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                logger.warning("NWM lake index is unreadable, building it again")
+            if index is not None and index["source_stamp"] != stamp:
+                index = None
+        if index is None:
+            with xr.open_dataset(lakeout_file_name) as lo_nwm:
+                index = {
+                    "source_stamp": stamp,
+                    "feature_id": lo_nwm.feature_id.values,
+                    "latitude": lo_nwm.latitude.values.astype("float64"),
+                    "longitude": lo_nwm.longitude.values.astype("float64"),
+                }
+            index["tree"] = cKDTree(
+                np.column_stack([index["longitude"], index["latitude"]])
+            )
+            with helpers.atomic_write(index_file_name, "wb") as file:
+                pickle.dump(index, file)
+        self.feature_id = index["feature_id"]
+        self.latitude = index["latitude"]
+        self.longitude = index["longitude"]
+        self.tree = index["tree"]
+
+    def query(self, longitude: float, latitude: float) -> tuple[float, int]:
+        """
+        Finds the closest NWM lake feature to a point
+        Returns
+        -------
+        tuple[float, int]
+            The distance (in degrees) and the index of the feature
+        """
+        dist, feature_index = self.tree.query([longitude, latitude])
+        return float(dist), int(feature_index)
+
+    def query_many(
+        self, longitudes: np.ndarray, latitudes: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the closest NWM lake feature to each point in one tree query
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            The distances (in degrees) and the indices of the features
+        """
+        return self.tree.query(np.column_stack([longitudes, latitudes]))
+
+    def feature_is_in_lake(self, polygon: Polygon, dist: float, feature_index: int) -> bool:
+        """The feature is the lake's if it's right on the centroid or inside the polygon"""
+        return dist <= 0.001 or polygon.contains(
+            Point(self.longitude[feature_index], self.latitude[feature_index])
+        )
+
+    def feature_record(self, feature_index: int) -> dict:
+        """What the hylak_id to feature table stores for a feature"""
+        return {
+            "feature_index": int(feature_index),
+            "feature_id": int(self.feature_id[feature_index]),
+            "lat": float(self.latitude[feature_index]),
+            "lon": float(self.longitude[feature_index]),
+        }
+
+
+def load_hylak_feature_table(
+    table_file_name: str = HYLAK_FEATURE_TABLE_FILE_NAME,
+    lakeout_file_name: str = LAKEOUT_FILE_NAME,
+) -> dict:
+    """
+    Loads the precomputed hylak_id -> NWM feature table, empty if it doesn't exist or was made from a different LAKEOUT file
+    Returns
+    -------
+    dict
+        hylak_id (as a string) -> feature record, see NWMLakeIndex.feature_record. A None record means the lake
+        has no NWM feature
+    """
+    if not os.path.exists(table_file_name):
+        return {}
+    try:
+        with open(table_file_name, "r") as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        logger.warning("NWM hylak_id to feature table is unreadable, finding the lakes again")
+        return {}
+    if table.get("source_stamp") != lakeout_source_stamp(lakeout_file_name):
+        return {}
+    return table["lakes"]
+
+
+def save_hylak_feature_table(
+    lakes: dict,
+    table_file_name: str = HYLAK_FEATURE_TABLE_FILE_NAME,
+    lakeout_file_name: str = LAKEOUT_FILE_NAME,
+) -> None:
+    """Writes the hylak_id -> NWM feature table, see load_hylak_feature_table"""
+    with helpers.atomic_write(table_file_name) as f:
+        json.dump(
+            {"source_stamp": lakeout_source_stamp(lakeout_file_name), "lakes": lakes},
+            f,
+            indent=4,
+        )
+
+
+def update_hylak_feature_table(
+    records: dict,
+    table_file_name: str = HYLAK_FEATURE_TABLE_FILE_NAME,
+    lakeout_file_name: str = LAKEOUT_FILE_NAME,
+) -> dict:
+    """
+    Adds lakes to the saved hylak_id -> NWM feature table. The table is loaded and saved under a lock file, so
+    lake workers updating it at the same time keep each other's lakes
+    Parameters
+    ----------
+    records : dict
+        hylak_id (as a string) -> feature record, see load_hylak_feature_table
+    Returns
+    -------
+    dict
+        The updated table
+    """
+    with helpers.file_lock(table_file_name + ".lock"):
+        table = load_hylak_feature_table(table_file_name, lakeout_file_name)
+        table.update(records)
+        save_hylak_feature_table(table, table_file_name, lakeout_file_name)
+    return table
+
+
+def build_hylak_feature_table(
+    lake_polygons: dict, lake_index: NWMLakeIndex = None
+) -> dict:
+    """
+    Matches many lakes to their NWM features with one batched tree query and adds them to the saved table
+    Parameters
+    ----------
+    lake_polygons : dict
+        hylak_id -> shapely Polygon of the lake
+    lake_index : NWMLakeIndex
+        The index to use, loaded if not given
+    Returns
+    -------
+    dict
+        The updated hylak_id -> feature record table
+    """
+    if lake_index is None:
+        lake_index = NWMLakeIndex()
+    records = {}
+    hylak_ids = list(lake_polygons.keys())
+    centroids = [lake_polygons[hylak_id].centroid for hylak_id in hylak_ids]
+    distances, feature_indices = lake_index.query_many(
+        np.array([c.x for c in centroids]), np.array([c.y for c in centroids])
+    )
+    for hylak_id, dist, feature_index in zip(hylak_ids, distances, feature_indices):
+        if lake_index.feature_is_in_lake(
+            lake_polygons[hylak_id], dist, feature_index
+        ):
+            records[str(hylak_id)] = lake_index.feature_record(feature_index)
+        else:
+            records[str(hylak_id)] = None
+    return update_hylak_feature_table(records)
+
 
 class NWM(data_access_parent_class.DataAccess):
     xarray_dataset: xr.Dataset
-    BUCKET_URL = "s3://noaa-nwm-retrospective-2-1-zarr-pds/lakeout.zarr"
+    BUCKET_URL = NWM_mirror.LAKEOUT_ZARR_URL
     BUCKET_NAME_NETCDF = "noaa-nwm-retrospective-2-1-pds"
     verification_lat_long = {"lat": 0, "lon": 0}
-    s3: boto3.client
+    s3: "boto3.client"
+    # Bump when call_NWM_s3_access_and_process changes, so cached products are redone
+    PROCESSING_VERSION = 1
 
     def __init__(self):
-        self.s3 = boto3.client(
-            "s3",
-            region_name="us-east-1",
-        )
+        # Made when the sample files are first downloaded, boto3 is slow to import
+        self.s3 = None
         self.README_default_information = (
             "Validate this data with the point file labeled 'NWM' in the output folder"
         )
+        # Hylak_id -> (xarray_dataset, verification_lat_long), kept by product_driver_many
+        self.lake_states = {}
+        # The lakeout store and its local mirror, opened once and kept for every lake
+        self.lakeout_dataset = None
+        self.mirror_dataset = None
         super().__init__()
 
     def verify_inputs(self) -> bool:
@@ -39,6 +248,8 @@ class NWM(data_access_parent_class.DataAccess):
     def attach_geodata(self) -> str:
         self.logger.info("Attaching Geo Data inputs: " + self.__class__.__name__)
         self.logger.warning("Unverified Output")
+        import geopandas as gpd
+
         lat = self.verification_lat_long["lat"]
         lon = self.verification_lat_long["lon"]
 
@@ -80,68 +291,100 @@ class NWM(data_access_parent_class.DataAccess):
 
         Returns
         -------
-        int,bool
-            The lake ID
+        list[int]
+            The NWM feature_id of the lake
         """
         self.logger.info("Starting Lake ID Searcher")
 
-        latitude = polygon.centroid.y
-        longitude = polygon.centroid.x
-        lo_file_name = os.path.join(
-            Path(__file__).parent.parent, "LocalData/SAMPLE_NWM_LAKEOUT.nc"
-        )
-        co_file_name = os.path.join(
-            Path(__file__).parent.parent, "LocalData/SAMPLE_NWM_CHRTOUT.nc"
+        hylak_id = GLHE.CLAY.globals.config["HYLAK_ID"]
+        if hylak_id is not None and os.path.exists(LAKEOUT_FILE_NAME):
+            table = load_hylak_feature_table()
+            if str(hylak_id) in table:
+                self.logger.info("Found Lake ID in the hylak_id to NWM feature table")
+                return self.use_feature_record(table[str(hylak_id)])
+
+        self.download_sample_files()
+        lake_index = NWMLakeIndex()
+        dist, feature_index = lake_index.query(
+            polygon.centroid.x, polygon.centroid.y
         )
-        if not os.path.exists(lo_file_name) or not os.path.exists(co_file_name):
-            with open(lo_file_name, "wb") as f:
+        record = None
+        if lake_index.feature_is_in_lake(polygon, dist, feature_index):
+            record = lake_index.feature_record(feature_index)
+        if hylak_id is not None:
+            update_hylak_feature_table({str(hylak_id): record})
+        return self.use_feature_record(record)
+
+    def download_sample_files(self) -> None:
+        """Downloads the sample LAKEOUT & CHRTOUT files the feature index is built from, if they're missing"""
+        if not os.path.exists(LAKEOUT_FILE_NAME) or not os.path.exists(
+            CHRTOUT_FILE_NAME
+        ):
+            if self.s3 is None:
+                import boto3
+
+                self.s3 = boto3.client(
+                    "s3",
+                    region_name="us-east-1",
+                )
+            with open(LAKEOUT_FILE_NAME, "wb") as f:
                 self.s3.download_fileobj(
                     self.BUCKET_NAME_NETCDF,
                     "model_output/1979/197902010100.LAKEOUT_DOMAIN1.comp",
                     f,
                 )
-            with open(co_file_name, "wb") as f:
+            with open(CHRTOUT_FILE_NAME, "wb") as f:
                 self.s3.download_fileobj(
                     self.BUCKET_NAME_NETCDF,
                     "model_output/1979/197902010100.CHRTOUT_DOMAIN1.comp",
                     f,
                 )
 
-        lo_nwm = xr.open_dataset(lo_file_name)
-        # Select the data corresponding to a specific value
-        closest = None
-
-        crs = CRS("EPSG:4326")
-        for i, val in enumerate(lo_nwm.feature_id):
-            dist = (
-                (longitude - lo_nwm.longitude[i].values) ** 2
-                + (latitude - lo_nwm.latitude[i].values) ** 2
-            ) ** 0.5
-            if closest is None or dist < closest[0]:
-                closest = (
-                    dist,
-                    i,
-                    lo_nwm.longitude[i].values,
-                    lo_nwm.latitude[i].values,
-                )
-        feature_id_index = closest[1]
+    def find_lake_records(self, polygons: dict) -> dict:
+        """
+        Finds the NWM features of many lakes, lakes not in the hylak_id to NWM feature table are matched
+        with one batched tree query
+        Parameters
+        ----------
+        polygons : dict
+            Hylak_id -> shapely.geometry.Polygon of the lake
+        Returns
+        -------
+        dict
+            Hylak_id -> feature record (see NWMLakeIndex.feature_record), None if the lake has no NWM feature
+        """
+        self.download_sample_files()
+        table = load_hylak_feature_table()
+        unknown_polygons = {
+            hylak_id: polygon
+            for hylak_id, polygon in polygons.items()
+            if str(hylak_id) not in table
+        }
+        if unknown_polygons:
+            self.logger.info(
+                "Matching {} lakes to NWM features".format(len(unknown_polygons))
+            )
+            table = build_hylak_feature_table(unknown_polygons)
+        return {hylak_id: table[str(hylak_id)] for hylak_id in polygons}
+
+    def use_feature_record(self, record: dict) -> list[int]:
+        """
+        Points the verification point at the feature from the hylak_id to feature table, or raises if there isn't one
+        """
+        if record is None:
+            self.logger.error("The lake is not in the NWM domain")
+            raise Exception("NWM Lake not found, and no alternate NWM source exists")
         self.logger.info(
             "Found Lake ID Verify Correct Placement (Lat, Long): ("
-            + str(lo_nwm.latitude[feature_id_index].item())
+            + str(record["lat"])
             + ", "
-            + str(lo_nwm.longitude[feature_id_index].item())
+            + str(record["lon"])
             + ")"
         )
-        self.verification_lat_long["lat"] = lo_nwm.latitude[feature_id_index].item()
-        self.verification_lat_long["lon"] = lo_nwm.longitude[feature_id_index].item()
-        if closest[0] > 0.001 and not polygon.contains(
-            Point(self.verification_lat_long["lon"], self.verification_lat_long["lat"])
-        ):
-            self.logger.error("The lake is not in the NWM domain")
-            raise Exception("NWM Lake not found, and no alternate NWM source exists")
-        else:
-            self.logger.info("Found Lake ID")
-            return [feature_id_index]
+        self.verification_lat_long["lat"] = record["lat"]
+        self.verification_lat_long["lon"] = record["lon"]
+        self.logger.info("Found Lake ID")
+        return [record["feature_id"]]
 
     def product_driver(self, polygon, debug=False, run_cleanly=False) -> list[MVSeries]:
         """
@@ -157,17 +400,22 @@ class NWM(data_access_parent_class.DataAccess):
             The monthly runoff data
         """
         self.logger.info("NWM Driver Started: Inflow & Outflow")
+        cache_key = product_cache.product_cache_key(
+            "NWM",
+            polygon,
+            product_cache.source_identity(self.BUCKET_URL, LAKEOUT_FILE_NAME),
+            self.PROCESSING_VERSION,
+        )
+        self.xarray_dataset = None
         if not run_cleanly and not debug:
-            try:
-                self.logger.info("Attempting to find and read saved NWM Land data")
-                self.xarray_dataset = helpers.unpickle_var("NWM")
-            except FileNotFoundError:
-                self.logger.info(
-                    "No saved NWM Land data found, calling access functions"
-                )
-                self.xarray_dataset = self.call_NWM_s3_access_and_process(polygon)
-        else:
+            self.logger.info("Attempting to find and read cached NWM data")
+            self.xarray_dataset = product_cache.read_cached_product(cache_key)
+        if self.xarray_dataset is None:
+            self.logger.info("Calling NWM access functions")
             self.xarray_dataset = self.call_NWM_s3_access_and_process(polygon)
+            self.xarray_dataset = product_cache.write_cached_product(
+                cache_key, self.xarray_dataset
+            )
         self.verification_lat_long["lat"] = self.xarray_dataset.lat.values.item()
         self.verification_lat_long["lon"] = self.xarray_dataset.lon.values.item()
         list_of_MVSeries = xarray_helpers.convert_xarray_dataset_to_mvseries(
@@ -182,35 +430,134 @@ class NWM(data_access_parent_class.DataAccess):
         self.logger.info("NWM Driver Finished")
         return list_of_MVSeries
 
+    def product_driver_many(
+        self, polygons: dict, debug=False, run_cleanly=False
+    ) -> dict[object, list[MVSeries]]:
+        """
+        See parent class for description. The lake keys are Hylak_ids, the lakes' features are read, grouped
+        by month and converted together, and each lake's dataset and lake point are kept for select_lake
+        """
+        self.logger.info("NWM Driver Started: Inflow & Outflow")
+        source = product_cache.source_identity(self.BUCKET_URL, LAKEOUT_FILE_NAME)
+        cache_keys = {
+            key: product_cache.product_cache_key(
+                "NWM", polygon, source, self.PROCESSING_VERSION
+            )
+            for key, polygon in polygons.items()
+        }
+        datasets = {}
+        if not run_cleanly and not debug:
+            self.logger.info("Attempting to find and read cached NWM data")
+            for key in polygons:
+                dataset = product_cache.read_cached_product(cache_keys[key])
+                if dataset is not None:
+                    datasets[key] = dataset
+        uncached_polygons = {
+            key: polygon for key, polygon in polygons.items() if key not in datasets
+        }
+        if uncached_polygons:
+            self.logger.info("Calling NWM access functions")
+            records = self.find_lake_records(uncached_polygons)
+            feature_ids = {}
+            for key, record in records.items():
+                if record is None:
+                    self.logger.error("Lake {} is not in the NWM domain".format(key))
+                else:
+                    feature_ids[key] = record["feature_id"]
+            if feature_ids:
+                dataset = self.process_lakeout_features(
+                    list(dict.fromkeys(feature_ids.values()))
+                )
+                cached_datasets = product_cache.write_cached_products(
+                    {
+                        cache_keys[key]: dataset.sel(feature_id=feature_id)
+                        for key, feature_id in feature_ids.items()
+                    }
+                )
+                for key in feature_ids:
+                    datasets[key] = cached_datasets[cache_keys[key]]
+
+        results = {}
+        self.lake_states = {}
+        for key, dataset in datasets.items():
+            list_of_MVSeries = xarray_helpers.convert_xarray_dataset_to_mvseries(
+                dataset, "inflow", "outflow"
+            )
+            results[key] = helpers.move_date_index_to_first_of_the_month(
+                *list_of_MVSeries
+            )
+            self.lake_states[key] = (
+                dataset,
+                {"lat": dataset.lat.values.item(), "lon": dataset.lon.values.item()},
+            )
+        self.send_data_product_event(
+            events.DataProductRunEvent("NWM", self.README_default_information)
+        )
+        self.logger.info("NWM Driver Finished")
+        return results
+
+    def select_lake(self, key) -> None:
+        """See parent class for description"""
+        if key in self.lake_states:
+            self.xarray_dataset, verification_lat_long = self.lake_states[key]
+            self.verification_lat_long = dict(verification_lat_long)
+
     def call_NWM_s3_access_and_process(self, polygon) -> xr.Dataset:
         """Just moving some product driver functions here"""
         list_of_feature_ids = self.find_lake_id(polygon)
-        self.xarray_dataset = self.zarr_lakeout_process(list_of_feature_ids)
-        self.xarray_dataset = xarray_helpers.label_xarray_dataset_with_product_name(
-            self.xarray_dataset, "NWM"
+        self.xarray_dataset = self.process_lakeout_features(list_of_feature_ids).isel(
+            feature_id=0
         )
-        self.xarray_dataset = xarray_helpers.fix_lat_long_names_in_xarray_dataset(
-            self.xarray_dataset
-        )
-        self.xarray_dataset = xarray_helpers.group_xarray_dataset_by_month(
-            self.xarray_dataset
-        )
-        self.xarray_dataset = xarray_helpers.rename_xarray_units(
-            self.xarray_dataset, "m3/s", "inflow", "outflow"
+        return self.xarray_dataset
+
+    def process_lakeout_features(self, feature_ids: list[int]) -> xr.Dataset:
+        """
+        Reads the inflow & outflow of many NWM features at once, and groups them by month and converts their
+        units across the whole feature dimension
+        Parameters
+        ----------
+        feature_ids : list[int]
+            NWM feature_ids, without repeats
+        Returns
+        -------
+        xr.Dataset
+            Monthly inflow & outflow in m3/month, with a feature_id dimension in the order of feature_ids
+        """
+        dataset = self.zarr_lakeout_process(feature_ids)
+        dataset = xarray_helpers.label_xarray_dataset_with_product_name(dataset, "NWM")
+        dataset = xarray_helpers.fix_lat_long_names_in_xarray_dataset(dataset)
+        dataset = xarray_helpers.group_xarray_dataset_by_month(dataset)
+        dataset = xarray_helpers.rename_xarray_units(
+            dataset, "m3/s", "inflow", "outflow"
         )
-        self.xarray_dataset = xarray_helpers.convert_xarray_dataset_units(
-            self.xarray_dataset, "m3/month", "inflow", "outflow"
+        dataset = xarray_helpers.convert_xarray_dataset_units(
+            dataset, "m3/month", "inflow", "outflow"
         )
-        helpers.pickle_var(self.xarray_dataset, "NWM")
-        return self.xarray_dataset
+        return dataset
+
+    def get_lakeout_dataset(self, feature_ids: list[int]) -> xr.Dataset:
+        """
+        Opens the NWM lakeout zarr store lazily, once per NWM object. The local mirror made by
+        NWM_mirror.sync_nwm_mirror is used instead when it has all the features.
+        """
+        if self.mirror_dataset is None and os.path.exists(NWM_mirror.NWM_MIRROR_STORE):
+            self.mirror_dataset = xr.open_zarr(NWM_mirror.NWM_MIRROR_STORE)
+        if (
+            self.mirror_dataset is not None
+            and np.isin(feature_ids, self.mirror_dataset.feature_id.values).all()
+        ):
+            self.logger.info("Reading NWM data from the local mirror")
+            return self.mirror_dataset
+        if self.lakeout_dataset is None:
+            self.lakeout_dataset = NWM_mirror.open_lakeout_store(self.BUCKET_URL)
+        return self.lakeout_dataset
 
-    def zarr_lakeout_process(self, feature_id_index) -> xr.Dataset:
+    def zarr_lakeout_process(self, feature_ids: list[int]) -> xr.Dataset:
         """If we are using zarr files, this code can quickly and efficiently give us the"""
         self.logger.info("Accessing NWM Retrospective Data")
-        s3_path = self.BUCKET_URL
-        ds = xr.open_zarr(fsspec.get_mapper(s3_path, anon=True), consolidated=True)
-        dataset = ds.sel(feature_id=ds.feature_id[feature_id_index].item())
-        dataset = dataset.drop_vars(["crs", "water_sfc_elev"])
+        ds = self.get_lakeout_dataset(feature_ids)
+        dataset = ds.sel(feature_id=list(feature_ids))
+        dataset = dataset.drop_vars(["crs", "water_sfc_elev"], errors="ignore")
 
         self.logger.warning(
             "No verification for if this is the correct lake has been implemented yet. Please implement!"
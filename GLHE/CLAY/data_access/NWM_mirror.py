@@ -0,0 +1,114 @@
+import logging
+import os
+import shutil
+import sys
+
+import numpy as np
+import xarray as xr
+from GLHE.CLAY import xarray_helpers
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+LAKEOUT_ZARR_URL = "s3://noaa-nwm-retrospective-2-1-zarr-pds/lakeout.zarr"
+# Made by sync_nwm_mirror, NWM reads the features it has from here instead of S3
+NWM_MIRROR_STORE = os.path.join(
+    Path(__file__).parent.parent, "LocalData/NWM_lakeout_mirror.zarr"
+)
+MIRROR_VARIABLES = ["inflow", "outflow"]
+
+
+def open_lakeout_store(source: str = LAKEOUT_ZARR_URL) -> xr.Dataset:
+    """Opens the NWM lakeout zarr store lazily, from S3 or a local path"""
+    if source.startswith("s3://"):
+        import fsspec
+
+        return xr.open_zarr(fsspec.get_mapper(source, anon=True), consolidated=True)
+    return xr.open_zarr(source)
+
+
+def sync_nwm_mirror(
+    feature_ids: list[int], source: str = LAKEOUT_ZARR_URL, mirror_path: str = None
+) -> list[int]:
+    """
+    Copies the inflow & outflow of NWM lake features into a local zarr store chunked by feature, so reading
+    one lake's 40 years of hourly data is one chunk per variable instead of every time chunk of the source.
+    Features already in the mirror are skipped, new ones are appended. If the source's time axis changed,
+    the mirror is rebuilt with all its features.
+    Parameters
+    ----------
+    feature_ids: list[int]
+        NWM feature_ids (not indices) to have in the mirror
+    source: str
+        The lakeout zarr store, S3 url or local path
+    mirror_path: str
+        The mirror zarr store, NWM_MIRROR_STORE if None
+    Returns
+    -------
+    list[int]
+        The feature_ids that were copied
+    """
+    if mirror_path is None:
+        mirror_path = NWM_MIRROR_STORE
+    source_dataset = open_lakeout_store(source)[MIRROR_VARIABLES]
+    feature_ids = [int(feature_id) for feature_id in dict.fromkeys(feature_ids)]
+    in_source = np.isin(feature_ids, source_dataset.feature_id.values)
+    if not in_source.all():
+        logger.warning(
+            "Features not in the NWM lakeout store, skipping: {}".format(
+                [f for f, found in zip(feature_ids, in_source) if not found]
+            )
+        )
+    feature_ids = [f for f, found in zip(feature_ids, in_source) if found]
+
+    append = False
+    if os.path.exists(mirror_path):
+        with xr.open_zarr(mirror_path) as mirror:
+            mirrored_ids = [int(f) for f in mirror.feature_id.values]
+            same_times = mirror.time.size == source_dataset.time.size and bool(
+                (mirror.time.values == source_dataset.time.values).all()
+            )
+        if same_times:
+            append = True
+            feature_ids = [f for f in feature_ids if f not in set(mirrored_ids)]
+        else:
+            logger.info("NWM lakeout times changed, rebuilding the mirror")
+            feature_ids = list(dict.fromkeys(mirrored_ids + feature_ids))
+    if not feature_ids:
+        logger.info("NWM mirror is up to date")
+        return []
+
+    logger.info("Copying {} NWM features to the mirror".format(len(feature_ids)))
+    subset = source_dataset.sel(feature_id=feature_ids).chunk(
+        {"feature_id": 1, "time": -1}
+    )
+    for variable in subset.variables.values():
+        variable.encoding.pop("chunks", None)
+        variable.encoding.pop("preferred_chunks", None)
+    with xarray_helpers.dask_compute_settings():
+        if append:
+            subset.to_zarr(mirror_path, append_dim="feature_id")
+        else:
+            temp_mirror_path = mirror_path + ".building"
+            shutil.rmtree(temp_mirror_path, ignore_errors=True)
+            subset.to_zarr(temp_mirror_path, mode="w")
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            os.replace(temp_mirror_path, mirror_path)
+    return feature_ids
+
+
+if __name__ == "__main__":
+    # python -m GLHE.CLAY.data_access.NWM_mirror [feature_id ...]
+    # Without feature_ids, the features of the lakes in the hylak_id to NWM feature table are synced
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1:
+        ids = [int(arg) for arg in sys.argv[1:]]
+    else:
+        from GLHE.CLAY.data_access import NWM
+
+        ids = [
+            record["feature_id"]
+            for record in NWM.load_hylak_feature_table().values()
+            if record is not None
+        ]
+    sync_nwm_mirror(ids)
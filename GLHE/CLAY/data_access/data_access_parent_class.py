@@ -52,12 +52,46 @@ class DataAccess(ABC):
         self.logger.info("Verifying inputs: " + self.__class__.__name__)
         pass
 
+    def spatial_average_weighting(self, polygon) -> dict:
+        """
+        Gets the keyword arguments for xarray_helpers.spatially_average_xarray_dataset_and_convert from the config,
+        so gridded products average over the lake polygon when POLYGON_WEIGHTED_AVERAGE is on
+        """
+        if not GLHE.CLAY.globals.config["POLYGON_WEIGHTED_AVERAGE"]:
+            return {}
+        return {
+            "polygon": polygon,
+            "cos_latitude": GLHE.CLAY.globals.config["COS_LATITUDE_WEIGHTS"],
+        }
+
+    held_events: list = None
+
     def send_data_product_event(self, msg) -> None:
         """
-        Sends data product event to event bus
+        Sends data product event to event bus, or holds it if hold_events was called
         """
+        if self.held_events is not None:
+            self.held_events.append(msg)
+            return
         pubsub.EventBus.Publish(pubsub.EventBus, msg)
 
+    def hold_events(self) -> None:
+        """
+        Holds the events of this product until release_events, so products running at the same time
+        send their events in a set order
+        """
+        self.held_events = []
+
+    def release_events(self) -> None:
+        """Sends the held events in the order they came, and stops holding events"""
+        held_events, self.held_events = self.held_events or [], None
+        for msg in held_events:
+            pubsub.EventBus.Publish(pubsub.EventBus, msg)
+
+    def drop_held_events(self) -> None:
+        """Drops the held events of a failed run, and stops holding events"""
+        self.held_events = None
+
     @abstractmethod
     def attach_geodata(self) -> str:
         """
@@ -90,3 +124,45 @@ class DataAccess(ABC):
         """
         pubsub.EventBus.Publish(events.topics["data_product_run_event"])
         pass
+
+    def product_driver_many(
+        self, polygons: dict, debug=False, run_cleanly=False
+    ) -> dict[object, list[MVSeries]]:
+        """
+        Returns data for many lakes at once. Products that read a shared source should override this so the
+        source is only opened and read once for all the lakes; by default product_driver is run per lake.
+        Parameters
+        ----------
+        polygons : dict
+            lake key (the Hylak_id) -> shapely.geometry.Polygon of the lake
+        debug : bool
+            See product_driver
+        run_cleanly : bool
+            See product_driver
+        Returns
+        -------
+        dict[object, list[MVSeries]]
+            lake key -> List of MVSeries objects containing the data, lakes that failed are left out
+        """
+        results = {}
+        for key, polygon in polygons.items():
+            try:
+                results[key] = self.product_driver(
+                    polygon, debug=debug, run_cleanly=run_cleanly
+                )
+            except Exception as e:
+                self.logger.error(
+                    "Product failed for lake {} with Exception: {}".format(key, e)
+                )
+        return results
+
+    def select_lake(self, key) -> None:
+        """
+        Restores any per lake state (like the lake's gridded dataset) kept by product_driver_many, so
+        attach_geodata and the grid export see the lake that is being written out
+        Parameters
+        ----------
+        key : object
+            lake key given to product_driver_many
+        """
+        pass
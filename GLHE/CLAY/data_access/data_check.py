@@ -1,18 +1,30 @@
+import hashlib
 import json
 import logging
 import os
 import json
-import requests
-from zipfile import ZipFile
 import pkgutil
+import sys
 from pathlib import Path
+from GLHE.CLAY.data_access import downloader
 
 logger = logging.getLogger(__name__)
 
+LOCAL_DATA_DIRECTORY = os.path.join(Path(__file__).parents[1], "LocalData")
+INPUT_DATA_CONFIG = os.path.join(
+    Path(__file__).parent, "data_access_config", "input_data.json"
+)
+# What was found in LocalData at the last check, so unchanged data isn't checked again
+MANIFEST_PATH = os.path.join(LOCAL_DATA_DIRECTORY, "manifest.json")
+
 
 # THIS MODULE CHECKS FOR DATA BY FILENAME!!!!! IF YOU CHANGE THE FILENAME, YOU MUST CHANGE THE FILENAME IN THE CONFIGURATION FILE
 def download_data_from_dropbox(
-    dropbox_link: str, filename: str, is_folder: bool
+    dropbox_link: str,
+    filename: str,
+    is_folder: bool,
+    size_bytes: int = None,
+    sha256: str = None,
 ) -> None:
     """
     This function downloads data from dropbox. It is used to download data from dropbox that is too large to be shipped with the project.
@@ -24,35 +36,182 @@ def download_data_from_dropbox(
         The filename of the data
     is_folder : bool
         If the data is a folder or not
+    size_bytes : int
+        The expected size of the download, from input_data.json
+    sha256 : str
+        The expected sha256 checksum of the download, from input_data.json
     Returns
     -------
     None
     """
     logger.info("** Checking Data **")
-    headers = {"user-agent": "Wget/1.16 (linux-gnu)"}
-    r = requests.get(dropbox_link, stream=True, headers=headers)
     filepath = os.path.join(Path(__file__).parents[1], "LocalData", filename)
     logger.info(filepath)
     if is_folder:
-        filepath += ".zip"
-    with open(filepath, "wb") as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-    if is_folder:
-        with ZipFile(filepath, "r") as zip_file:
-            # Extract the files
-            zip_file.extractall(
-                os.path.join(Path(__file__).parents[1], "LocalData", filename)
-            )
-        os.remove(filepath)
-    logger.info("Finished downloading " + filename + " from dropbox")
+        stats = downloader.download_file(
+            dropbox_link, filepath + ".zip", size_bytes, sha256, extract_to=filepath
+        )
+    else:
+        stats = downloader.download_file(dropbox_link, filepath, size_bytes, sha256)
+    logger.info(
+        "Finished downloading {} from dropbox: {:.1f}MB in {:.0f}s ({:.1f}MB/s)".format(
+            filename, stats["bytes"] / 2**20, stats["seconds"], stats["mb_per_s"]
+        )
+    )
     return
 
 
-def check_data_and_download_missing_data_or_files() -> None:
+def stat_local_data(path: str) -> dict:
+    """
+    The size & latest modification time of a LocalData file, or of all the files in a LocalData folder
+    """
+    if os.path.isfile(path):
+        file_stat = os.stat(path)
+        return {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns, "files": 1}
+    size, mtime_ns, files = 0, 0, 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_stat = os.stat(os.path.join(root, filename))
+            size += file_stat.st_size
+            mtime_ns = max(mtime_ns, file_stat.st_mtime_ns)
+            files += 1
+    return {"size": size, "mtime_ns": mtime_ns, "files": files}
+
+
+def checksum_local_data(path: str) -> str:
+    """The sha256 of a LocalData file, or of the names & sha256s of all the files in a LocalData folder"""
+    if os.path.isfile(path):
+        return downloader.file_sha256(path)
+    digest = hashlib.sha256()
+    for root, _, filenames in sorted(os.walk(path)):
+        for filename in sorted(filenames):
+            file_path = os.path.join(root, filename)
+            digest.update(
+                "{}:{}\n".format(
+                    os.path.relpath(file_path, path).replace(os.sep, "/"),
+                    downloader.file_sha256(file_path),
+                ).encode()
+            )
+    return digest.hexdigest()
+
+
+def load_manifest() -> dict:
+    """Loads the LocalData manifest, empty if there isn't one"""
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    try:
+        with open(MANIFEST_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logger.warning("LocalData manifest is unreadable, checking all the data")
+        return {}
+
+
+def save_manifest(manifest: dict) -> None:
+    """Writes the LocalData manifest"""
+    with open(MANIFEST_PATH + ".writing", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(MANIFEST_PATH + ".writing", MANIFEST_PATH)
+
+
+def manifest_is_current(manifest: dict) -> bool:
+    """
+    Checks that input_data.json and every LocalData entry in the manifest are unchanged since they were
+    checked, with one stat per file entry and one stat per file in a folder entry (see stat_local_data), so
+    nothing is read
+    """
+    if not manifest or manifest.get("input_data_stamp") != stat_local_data(
+        INPUT_DATA_CONFIG
+    ):
+        return False
+    for entry in manifest["entries"].values():
+        path = os.path.join(LOCAL_DATA_DIRECTORY, entry["filename"])
+        if not os.path.exists(path) or stat_local_data(path) != entry["stat"]:
+            return False
+    return True
+
+
+def check_local_data(product: dict, entry: dict, verify: bool) -> dict:
+    """
+    Checks a LocalData file or folder against its manifest entry and the size & checksum in input_data.json.
+    Unchanged data is only checksummed again if verify is True.
+    Returns
+    -------
+    dict
+        The manifest entry of the data, None if it is out of date, truncated or corrupt
+    """
+    name = product["name"]
+    filename = product["local_remote_storage_filename"].rstrip("/")
+    path = os.path.join(LOCAL_DATA_DIRECTORY, filename)
+    stat = stat_local_data(path)
+    if entry is not None and entry.get("version") != product.get("version"):
+        logger.warning("{} data is out of date".format(name))
+        return None
+    is_folder = product["local_remote_storage_filename"].endswith("/")
+    # Sizes & checksums in input_data.json are of the download, which for folders is the zip
+    if not is_folder and product.get("size_bytes") is not None:
+        if stat["size"] != product["size_bytes"]:
+            logger.warning(
+                "{} data is {} bytes, {} bytes were expected. It is probably a truncated download".format(
+                    name, stat["size"], product["size_bytes"]
+                )
+            )
+            return None
+    sha256 = entry.get("sha256") if entry is not None else None
+    unchanged = entry is not None and entry["stat"] == stat
+    if verify or not unchanged:
+        if verify or (not is_folder and product.get("sha256") is not None):
+            logger.info("Verifying " + name + " data")
+            sha256 = checksum_local_data(path)
+        else:
+            sha256 = None
+    if (
+        sha256 is not None
+        and not is_folder
+        and product.get("sha256") is not None
+        and sha256 != product["sha256"].lower()
+    ):
+        logger.warning("{} data failed its sha256 check".format(name))
+        return None
+    if (
+        verify
+        and unchanged
+        and entry.get("sha256") is not None
+        and sha256 != entry["sha256"]
+    ):
+        logger.warning("{} data changed since it was last checked".format(name))
+    return {
+        "filename": filename,
+        "stat": stat,
+        "sha256": sha256,
+        "version": product.get("version"),
+    }
+
+
+def download_local_data(product: dict) -> None:
+    """Downloads a LocalData file or folder from its dropbox link"""
+    logger.info("Downloading " + product["name"] + " data. It will take some time!")
+    filename = product["local_remote_storage_filename"]
+    is_folder = filename.endswith("/")
+    download_data_from_dropbox(
+        product["dropbox_download_link"],
+        filename.rstrip("/"),
+        is_folder,
+        product.get("size_bytes"),
+        product.get("sha256"),
+    )
+
+
+def check_data_and_download_missing_data_or_files(verify: bool = False) -> None:
     """
     This function checks if data files (listed in configuration file) exists in the LocalData folder.
+    When nothing changed since the last check, this is one read of the LocalData manifest and a stat per
+    data file. Otherwise, changed data is checked against input_data.json, and missing, out of date,
+    truncated or corrupt data is downloaded again.
+    Parameters
+    ----------
+    verify : bool
+        If True, all the data is checksummed even if it didn't change
     Returns
     -------
     list[str]
@@ -60,39 +219,40 @@ def check_data_and_download_missing_data_or_files() -> None:
     """
 
     # Check if Local Data Folder Exists #
-    if not os.path.exists(os.path.join(Path(__file__).parents[1], "LocalData")):
-        os.mkdir(os.path.join(Path(__file__).parents[1], "LocalData"))
+    if not os.path.exists(LOCAL_DATA_DIRECTORY):
+        os.mkdir(LOCAL_DATA_DIRECTORY)
+
+    manifest = load_manifest()
+    if not verify and manifest_is_current(manifest):
+        logger.info("LocalData matches its manifest")
+        return None
 
     # Read in local data files list #
-    with open(
-        os.path.join(Path(__file__).parent, "data_access_config", "input_data.json")
-    ) as f:
+    with open(INPUT_DATA_CONFIG) as f:
         input_data_config = json.load(f)
 
     data_products = input_data_config["data_products"]
+    entries = manifest.get("entries", {})
+    new_entries = {}
 
     for product in data_products:
         name = product["name"]
         code = product["access_code"]
         if code == "local":
             filename = product["local_remote_storage_filename"]
-            is_folder = False
-            if not os.path.exists(
-                os.path.join(Path(__file__).parents[1], "LocalData", filename)
-            ):
-                logger.info("Downloading " + name + " data. It will take some time!")
-                if filename[-1] == "/":
-                    is_folder = True
-                    # os.mkdir("LocalData/" + filename[:-1])
-                    download_data_from_dropbox(
-                        product["dropbox_download_link"], filename[:-1], is_folder
-                    )
-                else:
-                    download_data_from_dropbox(
-                        product["dropbox_download_link"], filename, is_folder
+            entry = None
+            if os.path.exists(os.path.join(LOCAL_DATA_DIRECTORY, filename.rstrip("/"))):
+                entry = check_local_data(product, entries.get(name), verify)
+                if entry is not None:
+                    logger.info("Found " + name + " data")
+            if entry is None:
+                download_local_data(product)
+                entry = check_local_data(product, None, verify)
+                if entry is None:
+                    raise ValueError(
+                        "Downloaded " + name + " data does not match input_data.json"
                     )
-            else:
-                logger.info("Found " + name + " data")
+            new_entries[name] = entry
         elif code == "api":
             if not os.path.exists(
                 os.path.join(
@@ -110,11 +270,22 @@ def check_data_and_download_missing_data_or_files() -> None:
                 )
             else:
                 logger.info("Found " + name + " api access script")
+    save_manifest(
+        {
+            "input_data_stamp": stat_local_data(INPUT_DATA_CONFIG),
+            "entries": new_entries,
+        }
+    )
     logger.info("Finished checking and/or downloading required data & files")
     return None
 
 
 if __name__ == "__main__":
+    # python -m GLHE.CLAY.data_access.data_check --verify checksums all the data
+    if "--verify" in sys.argv:
+        logging.basicConfig(level=logging.INFO)
+        check_data_and_download_missing_data_or_files(verify=True)
+        sys.exit()
     print(
         "This is the download data module. It downloads all the general local data that can't really be accessed "
         "through API's. These are massive files (4-5 GB)"
@@ -0,0 +1,484 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile
+
+import requests
+import GLHE.CLAY.globals
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_HEADERS = {"user-agent": "Wget/1.16 (linux-gnu)"}
+# Bytes read from the connection at a time
+DOWNLOAD_BUFFER_BYTES = 1024 * 1024
+# Bytes per range request, also how much is redone when resuming
+DOWNLOAD_SEGMENT_BYTES = 64 * 1024 * 1024
+PROGRESS_LOG_SECONDS = 10
+REQUEST_TIMEOUT_SECONDS = 60
+
+LOCAL_FILE_HEADER_SIGNATURE = b"PK\x03\x04"
+CENTRAL_DIRECTORY_SIGNATURES = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+
+
+class DownloadProgress:
+    """Counts downloaded bytes from many threads, and logs the progress and throughput every so often"""
+
+    def __init__(self, name: str, total_bytes: int = None, done_bytes: int = 0):
+        self.name = name
+        self.total_bytes = total_bytes
+        self.done_bytes = done_bytes
+        self.session_bytes = 0
+        self.start = time.monotonic()
+        self.last_log = self.start
+        self.lock = threading.Lock()
+
+    def add(self, num_bytes: int) -> None:
+        """Adds downloaded bytes"""
+        with self.lock:
+            self.done_bytes += num_bytes
+            self.session_bytes += num_bytes
+            if time.monotonic() - self.last_log >= PROGRESS_LOG_SECONDS:
+                self.last_log = time.monotonic()
+                self.log()
+
+    def throughput(self) -> float:
+        """MB/s downloaded this session"""
+        return self.session_bytes / 2**20 / max(time.monotonic() - self.start, 1e-9)
+
+    def log(self) -> None:
+        """Logs the progress"""
+        if self.total_bytes:
+            logger.info(
+                "{}: {:.1f} of {:.1f}MB ({:.0%}) at {:.1f}MB/s".format(
+                    self.name,
+                    self.done_bytes / 2**20,
+                    self.total_bytes / 2**20,
+                    self.done_bytes / self.total_bytes,
+                    self.throughput(),
+                )
+            )
+        else:
+            logger.info(
+                "{}: {:.1f}MB at {:.1f}MB/s".format(
+                    self.name, self.done_bytes / 2**20, self.throughput()
+                )
+            )
+
+
+class ZipStreamExtractor:
+    """
+    Extracts a zip archive from its bytes as they download by following the local file headers, so a folder
+    is extracted by the time its download finishes. If the archive has something it can't follow (like
+    encryption, or stored files of unknown size) it stops, and the archive is extracted from the downloaded
+    file instead.
+    """
+
+    def __init__(self, destination: str):
+        self.destination = destination
+        self.temp_destination = destination + ".extracting"
+        shutil.rmtree(self.temp_destination, ignore_errors=True)
+        os.makedirs(self.temp_destination)
+        self.buffer = bytearray()
+        self.entry = None
+        self.supported = True
+        self.complete = False
+
+    def feed(self, data: bytes) -> None:
+        """Extracts what it can with the next downloaded bytes"""
+        if not self.supported or self.complete:
+            return
+        self.buffer += data
+        try:
+            self.process()
+        except Exception as e:
+            logger.warning(
+                "Can't extract {} while downloading, extracting it afterwards: {}".format(
+                    self.destination, e
+                )
+            )
+            self.supported = False
+            self.close_entry()
+            self.buffer = bytearray()
+
+    def process(self) -> None:
+        """Works through the buffer until it needs more bytes"""
+        while True:
+            if self.entry is None:
+                if not self.start_entry():
+                    return
+            elif not self.continue_entry():
+                return
+
+    def start_entry(self) -> bool:
+        """Reads the next local file header, False if more bytes are needed"""
+        if len(self.buffer) < 4:
+            return False
+        signature = bytes(self.buffer[:4])
+        if signature in CENTRAL_DIRECTORY_SIGNATURES:
+            # The files are done, the rest is the central directory
+            self.complete = True
+            self.buffer = bytearray()
+            return False
+        if signature != LOCAL_FILE_HEADER_SIGNATURE:
+            raise ValueError("Unexpected zip signature {}".format(signature))
+        if len(self.buffer) < 30:
+            return False
+        (
+            flags,
+            method,
+            crc,
+            compressed_size,
+            size,
+            name_length,
+            extra_length,
+        ) = struct.unpack("<6xHH4xIIIHH", self.buffer[:30])
+        header_length = 30 + name_length + extra_length
+        if len(self.buffer) < header_length:
+            return False
+        name = bytes(self.buffer[30 : 30 + name_length]).decode(
+            "utf-8" if flags & 0x800 else "cp437"
+        )
+        extra = bytes(self.buffer[30 + name_length : header_length])
+        del self.buffer[:header_length]
+        zip64 = False
+        if compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            zip64 = True
+            size, compressed_size = zip64_sizes(extra)
+        if flags & 0x1:
+            raise ValueError("{} is encrypted".format(name))
+        has_descriptor = bool(flags & 0x8)
+        if method not in (0, 8) or (method == 0 and has_descriptor):
+            raise ValueError("{} can't be read from a stream".format(name))
+
+        path = os.path.normpath(os.path.join(self.temp_destination, name))
+        if not path.startswith(os.path.normpath(self.temp_destination) + os.sep):
+            raise ValueError("{} is outside of the archive folder".format(name))
+        if name.endswith("/"):
+            os.makedirs(path, exist_ok=True)
+            file = None
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = open(path, "wb")
+        self.entry = {
+            "name": name,
+            "file": file,
+            "method": method,
+            "crc": crc,
+            "remaining": compressed_size,
+            "has_descriptor": has_descriptor,
+            "zip64": zip64,
+            "decompressor": zlib.decompressobj(-15) if method == 8 else None,
+            "running_crc": 0,
+            "data_done": False,
+        }
+        return True
+
+    def continue_entry(self) -> bool:
+        """Extracts the current file from the buffer, False if more bytes are needed"""
+        entry = self.entry
+        if not entry["data_done"]:
+            if entry["method"] == 0:
+                data = bytes(self.buffer[: entry["remaining"]])
+                del self.buffer[: len(data)]
+                entry["remaining"] -= len(data)
+                entry["data_done"] = entry["remaining"] == 0
+            else:
+                data = entry["decompressor"].decompress(bytes(self.buffer))
+                self.buffer = bytearray(entry["decompressor"].unused_data)
+                entry["data_done"] = entry["decompressor"].eof
+            if data:
+                entry["running_crc"] = zlib.crc32(data, entry["running_crc"])
+                entry["file"].write(data)
+            if not entry["data_done"]:
+                return False
+        if entry["has_descriptor"]:
+            if len(self.buffer) < 4:
+                return False
+            offset = 4 if bytes(self.buffer[:4]) == DATA_DESCRIPTOR_SIGNATURE else 0
+            descriptor_length = offset + (20 if entry["zip64"] else 12)
+            if len(self.buffer) < descriptor_length:
+                return False
+            (entry["crc"],) = struct.unpack("<I", self.buffer[offset : offset + 4])
+            del self.buffer[:descriptor_length]
+        if entry["running_crc"] != entry["crc"]:
+            raise ValueError("{} failed its CRC check".format(entry["name"]))
+        self.close_entry()
+        return True
+
+    def close_entry(self) -> None:
+        """Closes the file being extracted"""
+        if self.entry is not None and self.entry["file"] is not None:
+            self.entry["file"].close()
+        self.entry = None
+
+    def finish(self) -> None:
+        """Moves the extracted folder into place"""
+        shutil.rmtree(self.destination, ignore_errors=True)
+        os.replace(self.temp_destination, self.destination)
+
+    def discard(self) -> None:
+        """Removes what was extracted"""
+        self.close_entry()
+        shutil.rmtree(self.temp_destination, ignore_errors=True)
+
+
+def zip64_sizes(extra: bytes) -> tuple[int, int]:
+    """The (size, compressed size) from the zip64 extra field of a local file header"""
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, data_size = struct.unpack("<HH", extra[position : position + 4])
+        if header_id == 0x0001 and data_size >= 16:
+            return struct.unpack("<QQ", extra[position + 4 : position + 20])
+        position += 4 + data_size
+    raise ValueError("zip64 sizes missing")
+
+
+def extract_zip(archive_path: str, destination: str) -> None:
+    """Extracts a downloaded zip archive, replacing the destination folder once it's done"""
+    temp_destination = destination + ".extracting"
+    shutil.rmtree(temp_destination, ignore_errors=True)
+    try:
+        with ZipFile(archive_path, "r") as zip_file:
+            zip_file.extractall(temp_destination)
+        shutil.rmtree(destination, ignore_errors=True)
+        os.replace(temp_destination, destination)
+    finally:
+        shutil.rmtree(temp_destination, ignore_errors=True)
+
+
+def probe_download(url: str) -> tuple[int, bool, str]:
+    """
+    Asks the server for the size of the download, if it takes range requests and the version of the file
+    Returns
+    -------
+    tuple[int, bool, str]
+        The size in bytes (None if unknown), True if range requests work, and the ETag (None if the server
+        has none)
+    """
+    try:
+        r = requests.head(
+            url,
+            headers=DOWNLOAD_HEADERS,
+            allow_redirects=True,
+            timeout=REQUEST_TIMEOUT_SECONDS,
+        )
+        r.raise_for_status()
+    except requests.RequestException as e:
+        logger.info("Could not probe {}: {}".format(url, e))
+        return None, False, None
+    size = r.headers.get("Content-Length")
+    # A compressed transfer's length isn't the file's
+    if size is None or r.headers.get("Content-Encoding"):
+        return None, False, None
+    return (
+        int(size),
+        r.headers.get("Accept-Ranges", "").lower() == "bytes",
+        r.headers.get("ETag"),
+    )
+
+
+def download_segments(
+    url: str, part_path: str, size: int, progress: DownloadProgress, etag: str = None
+) -> None:
+    """
+    Downloads a file with parallel range requests into part_path. Finished segments are recorded next to it
+    with the size and ETag of the file, so an interrupted download only redoes the unfinished ones, unless the
+    file changed on the server since.
+    """
+    state_path = part_path + ".json"
+    state = None
+    if os.path.exists(state_path) and os.path.exists(part_path):
+        with open(state_path, "r") as f:
+            state = json.load(f)
+        if (
+            state.get("size") != size
+            or state.get("etag") != etag
+            or os.path.getsize(part_path) != size
+        ):
+            logger.info("{} changed on the server, downloading it again".format(progress.name))
+            state = None
+    if state is None:
+        state = {"size": size, "etag": etag, "done": []}
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+    done = set(state["done"])
+    segments = [
+        (start, min(start + DOWNLOAD_SEGMENT_BYTES, size) - 1)
+        for start in range(0, size, DOWNLOAD_SEGMENT_BYTES)
+        if start not in done
+    ]
+    progress.done_bytes = size - sum(end - start + 1 for start, end in segments)
+    if progress.done_bytes:
+        logger.info(
+            "Resuming {} from {:.1f}MB".format(progress.name, progress.done_bytes / 2**20)
+        )
+    state_lock = threading.Lock()
+
+    def download_segment(segment: tuple[int, int]) -> None:
+        start, end = segment
+        headers = dict(DOWNLOAD_HEADERS, Range="bytes={}-{}".format(start, end))
+        if etag is not None and not etag.startswith("W/"):
+            # The server sends the whole file instead of the range if it changed during the download
+            headers["If-Range"] = etag
+        written = 0
+        with requests.get(
+            url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT_SECONDS
+        ) as r:
+            if r.status_code != 206:
+                raise ValueError(
+                    "Range request for {} returned {}".format(url, r.status_code)
+                )
+            with open(part_path, "r+b") as f:
+                f.seek(start)
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_BUFFER_BYTES):
+                    f.write(chunk)
+                    written += len(chunk)
+                    progress.add(len(chunk))
+        if written != end - start + 1:
+            raise ValueError("Segment {}-{} of {} is incomplete".format(start, end, url))
+        with state_lock:
+            state["done"].append(start)
+            with open(state_path, "w") as f:
+                json.dump(state, f)
+
+    with ThreadPoolExecutor(
+        max_workers=GLHE.CLAY.globals.config["DOWNLOAD_CONNECTIONS"]
+    ) as executor:
+        list(executor.map(download_segment, segments))
+    os.remove(state_path)
+
+
+def download_stream(
+    url: str,
+    part_path: str,
+    progress: DownloadProgress,
+    extractor: ZipStreamExtractor = None,
+) -> str:
+    """
+    Downloads a file in one request into part_path, for servers that don't take range requests, feeding the
+    bytes to the extractor as they come.
+    Returns
+    -------
+    str
+        The sha256 of the file
+    """
+    digest = hashlib.sha256()
+    with requests.get(
+        url, headers=DOWNLOAD_HEADERS, stream=True, timeout=REQUEST_TIMEOUT_SECONDS
+    ) as r:
+        r.raise_for_status()
+        with open(part_path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_BUFFER_BYTES):
+                f.write(chunk)
+                digest.update(chunk)
+                progress.add(len(chunk))
+                if extractor is not None:
+                    extractor.feed(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(filepath: str) -> str:
+    """The sha256 of a file, read in large blocks"""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BUFFER_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def download_file(
+    url: str,
+    filepath: str,
+    size_bytes: int = None,
+    sha256: str = None,
+    extract_to: str = None,
+) -> dict:
+    """
+    Downloads a file with parallel range requests when the server takes them (resuming a partial download),
+    or in one stream when it doesn't. A stream can't be resumed, so what it leaves behind when it fails is
+    deleted. The download is checked against the expected size & checksum before it replaces filepath.
+    Parameters
+    ----------
+    url: str
+        The link to download
+    filepath: str
+        Where the file goes, the download is kept in filepath + ".part" until it's done
+    size_bytes: int
+        The expected size, not checked if None
+    sha256: str
+        The expected sha256 checksum, not checked if None
+    extract_to: str
+        If given, the download is a zip archive that is extracted into this folder (while streaming when
+        possible) instead of kept
+    Returns
+    -------
+    dict
+        "bytes" downloaded this time, "seconds" it took and the throughput in "mb_per_s"
+    """
+    name = os.path.basename(extract_to or filepath)
+    part_path = filepath + ".part"
+    size, takes_ranges, etag = probe_download(url)
+    if size is not None and size_bytes is not None and size != size_bytes:
+        raise ValueError(
+            "{} is {} bytes on the server, but {} bytes were expected".format(
+                name, size, size_bytes
+            )
+        )
+    progress = DownloadProgress(name, size or size_bytes)
+    resumable = bool(takes_ranges and size)
+    extractor = None
+    try:
+        if resumable:
+            download_segments(url, part_path, size, progress, etag)
+            digest = None
+        else:
+            if extract_to is not None:
+                extractor = ZipStreamExtractor(extract_to)
+            digest = download_stream(url, part_path, progress, extractor)
+        progress.log()
+
+        try:
+            if size_bytes is not None and os.path.getsize(part_path) != size_bytes:
+                raise ValueError(
+                    "{} downloaded {} bytes, but {} bytes were expected".format(
+                        name, os.path.getsize(part_path), size_bytes
+                    )
+                )
+            if sha256 is not None:
+                if digest is None:
+                    digest = file_sha256(part_path)
+                if digest != sha256.lower():
+                    raise ValueError("{} failed its sha256 check".format(name))
+        except ValueError:
+            os.remove(part_path)
+            raise
+
+        if extract_to is not None:
+            if extractor is not None and extractor.complete:
+                extractor.finish()
+            else:
+                extract_zip(part_path, extract_to)
+            os.remove(part_path)
+        else:
+            os.replace(part_path, filepath)
+    except BaseException:
+        if not resumable and os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        # Nothing if it was moved into place
+        if extractor is not None:
+            extractor.discard()
+    return {
+        "bytes": progress.session_bytes,
+        "seconds": time.monotonic() - progress.start,
+        "mb_per_s": progress.throughput(),
+    }
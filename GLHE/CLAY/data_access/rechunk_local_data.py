@@ -0,0 +1,59 @@
+import glob
+import logging
+import os
+
+import xarray as xr
+from GLHE.CLAY import product_cache, xarray_helpers
+from GLHE.CLAY.data_access.CRUTS import CRUTS_FILE_NAME, CRUTS_ZARR_STORE
+from GLHE.CLAY.data_access.ERA5_Land import ERA5_FILE_PATTERN, ERA5_ZARR_STORE
+
+logger = logging.getLogger(__name__)
+
+
+def rechunk_local_data(spatial_chunk_size: int = 16) -> list[str]:
+    """
+    Converts the CRUTS & ERA5 LocalData netcdf files into zarr stores chunked for reading one lake's
+    time series. The products read these stores instead of the netcdf files while the netcdf files are the
+    ones the stores were made from.
+    Parameters
+    ----------
+    spatial_chunk_size: int
+        the number of lat & lon cells in a chunk
+    Returns
+    -------
+    list[str]
+        the zarr stores that were written
+    """
+    stores = []
+    if os.path.exists(CRUTS_FILE_NAME):
+        with xr.open_dataset(CRUTS_FILE_NAME) as dataset:
+            stores.append(
+                xarray_helpers.rechunk_xarray_dataset_to_zarr(
+                    dataset,
+                    CRUTS_ZARR_STORE,
+                    spatial_chunk_size,
+                    product_cache.source_identity(CRUTS_FILE_NAME),
+                )
+            )
+    else:
+        logger.warning("No CRUTS netcdf file found, skipping it")
+    try:
+        dataset = xr.open_mfdataset(ERA5_FILE_PATTERN, combine="by_coords")
+    except OSError:
+        logger.warning("No ERA5 netcdf files found, skipping them")
+    else:
+        with dataset:
+            stores.append(
+                xarray_helpers.rechunk_xarray_dataset_to_zarr(
+                    dataset,
+                    ERA5_ZARR_STORE,
+                    spatial_chunk_size,
+                    product_cache.source_identity(*sorted(glob.glob(ERA5_FILE_PATTERN))),
+                )
+            )
+    return stores
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    rechunk_local_data()
@@ -2,13 +2,30 @@ config = {
     "DEBUG": False,
     "RUN_CLEANLY": False,
     "LAKE_NAME": None,
+    "HYLAK_ID": None,
+    "POLYGON_WEIGHTED_AVERAGE": False,
+    "COS_LATITUDE_WEIGHTS": False,
+    "PRODUCT_CACHE_FORMAT": "netcdf",
+    "PRODUCT_CACHE_SIZE_LIMIT_MB": 10240,
+    "DASK_MEMORY_BUDGET_MB": 2048,
+    "DASK_NUM_WORKERS": 4,
+    "PRODUCT_WORKERS": 3,
+    "PRODUCT_TIMEOUT_SECONDS": 3600,
+    "LAKE_RUNNER_WORKERS": 2,
+    "LAKE_RUNNER_MIN_AVAILABLE_MEMORY_MB": 4096,
+    "DOWNLOAD_CONNECTIONS": 4,
+    "SERIES_DATA_FORMATS": ["csv", "parquet"],
+    "GRIDDED_TIME_STACK": False,
+    "GRIDDED_TIME_STACK_START_DATE": None,
+    "GRIDDED_TIME_STACK_END_DATE": None,
     "DIRECTORIES": {
         "LAKE_OUTPUT_FOLDER": r'LakeOutputDirectory',
         "UNIT_DEFINITION_FILE_PATH": 'config/pint_unit_registry.txt',
         "LOGGING_DIRECTORY": "",
         "OUTPUT_DIRECTORY_SAVE_FILES": "",
         "OUTPUT_DIRECTORY": "",
-        "TEMP_DIRECTORY": ".temp"
+        "TEMP_DIRECTORY": ".temp",
+        "CACHE_DIRECTORY": ".cache"
     }
 }
 
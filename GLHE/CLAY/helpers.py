@@ -1,8 +1,10 @@
 import logging
 import os
-import pickle
-from calendar import monthrange
+import threading
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import lru_cache
 from . import ureg
 import pandas as pd
 import xarray as xr
@@ -11,6 +13,9 @@ import GLHE.CLAY.globals
 
 logger = logging.getLogger(__name__)
 
+# How often a thread waiting on a lock file checks it again
+LOCK_POLL_SECONDS = 0.05
+
 
 @dataclass
 class MVSeries:
@@ -76,46 +81,6 @@ class MVSeries:
         self.unit = unit
 
 
-def pickle_var(variable: object, identification_string: str) -> None:
-    """
-    Pickle a variable to disk
-    """
-    if (
-        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"] is None
-        or GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"] == ""
-    ):
-        raise Exception(
-            'GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"] is not set, need to have a directory to place pickle files'
-        )
-    pickle_file_name = (
-        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
-        + "/save_files/"
-        + GLHE.CLAY.globals.config["LAKE_NAME"]
-        + "_"
-        + identification_string
-        + ".pickle"
-    )
-    with open(pickle_file_name, "wb") as file:
-        pickle.dump(variable, file)
-
-
-def unpickle_var(identification_string: str) -> object:
-    """
-    Load a variable from disk, used in conjuction with pickle_var
-    """
-    pickle_file_name = (
-        GLHE.CLAY.globals.config["DIRECTORIES"]["OUTPUT_DIRECTORY"]
-        + "/save_files/"
-        + GLHE.CLAY.globals.config["LAKE_NAME"]
-        + "_"
-        + identification_string
-        + ".pickle"
-    )
-    with open(pickle_file_name, "rb") as file:
-        variable = pickle.load(file)
-    return variable
-
-
 def convert_dicts_to_MVSeries(
     date_column_name: str, units_key_name: str, product_name_key_name: str, *dicts: dict
 ) -> list[MVSeries]:
@@ -185,6 +150,46 @@ def group_MVSeries_by_month(list_of_datasets: list[MVSeries]) -> list[MVSeries]:
     return list_of_datasets
 
 
+@lru_cache(maxsize=None)
+def get_unit_conversion_plan(input_unit: str, output_unit: str) -> tuple[float, bool]:
+    """
+    Works out how to convert input_unit to output_unit once, so each conversion after is just array math.
+    Rates converted to a per month output are calendar aware, they go to per day and are multiplied by the
+    number of days in each month.
+    Parameters
+    ----------
+    input_unit: str
+        The unit of the data
+    output_unit: str
+        The unit to convert to
+    Returns
+    -------
+    tuple[float, bool]
+        The factor to multiply by, and if the data should also be multiplied by the days in each month
+    """
+    input_units = ureg.parse_units(input_unit)
+    output_units = ureg.parse_units(output_unit)
+    input_is_rate = input_units.dimensionality.get("[time]", 0) < 0
+    output_is_rate = output_units.dimensionality.get("[time]", 0) < 0
+    if input_is_rate and not output_is_rate:
+        raise ValueError(
+            "The output unit {} is not a rate, but the input unit {} is a rate".format(
+                output_unit, input_unit
+            )
+        )
+
+    def is_per_month(units) -> bool:
+        return (
+            "month" in str(units)
+            and (units * ureg.month).dimensionality.get("[time]", 0) == 0
+        )
+
+    if input_is_rate and is_per_month(output_units) and not is_per_month(input_units):
+        per_day_units = output_units * ureg.month / ureg.day
+        return ureg.Quantity(1, input_units).to(per_day_units).magnitude, True
+    return ureg.Quantity(1, input_units).to(output_units).magnitude, False
+
+
 def convert_MVSeries_units(list_of_MVSeries, output_unit: Unit) -> list[MVSeries]:
     """
     Converts the units of the MVSeries to output_unit, mostly to mm/month or cubic meters/month,
@@ -200,50 +205,15 @@ def convert_MVSeries_units(list_of_MVSeries, output_unit: Unit) -> list[MVSeries
         The list of MVSeries with the units converted
     """
     for var in list_of_MVSeries:
-        string_input_units = str(var.unit)
-        string_output_units = str(output_unit)
-        if "/" in string_input_units:
-            if not "/" in string_output_units:
-                raise ValueError(
-                    "The output unit {} is not a rate, but the input unit {} is a rate".format(
-                        output_unit, var.unit
-                    )
-                )
-            else:
-                numer_input_unit, denom_input_unit = str(string_input_units).split("/")
-                numer_output_unit, denom_output_unit = str(string_output_units).split(
-                    "/"
-                )
-                denom_output_unit.replace(" ", "")
-                denom_input_unit.replace(" ", "")
-                numer_output_unit.replace(" ", "")
-                numer_input_unit.replace(" ", "")
-                conversion_factor_numerator = (
-                    ureg.Quantity(1, numer_input_unit).to(numer_output_unit).magnitude
-                )
-                if denom_output_unit == "month":
-                    for i in range(len(var.dataset)):
-                        days_in_month = monthrange(
-                            var.dataset.index[i].year, var.dataset.index[i].month
-                        )[1]
-                        conversion_factor_to_days = (
-                            ureg.Quantity(1, var.unit)
-                            .to(ureg(numer_output_unit + "/days"))
-                            .magnitude
-                        )
-                        var.dataset[i] *= conversion_factor_to_days * days_in_month
-                else:
-                    conversion_factor = (
-                        ureg.Quantity(1, var.unit).to(output_unit).magnitude
-                    )
-                    var.dataset *= conversion_factor
-                var.unit = output_unit
-        else:
-            conversion_factor = (
-                ureg.Quantity(1, string_input_units).to(string_output_units).magnitude
-            )
-            var.dataset *= conversion_factor
-            var.unit = output_unit
+        conversion_factor, per_month = get_unit_conversion_plan(
+            str(var.unit), str(output_unit)
+        )
+        if per_month:
+            days_in_month = pd.DatetimeIndex(var.dataset.index).days_in_month
+            var.dataset = var.dataset * (conversion_factor * days_in_month.values)
+        elif conversion_factor != 1:
+            var.dataset = var.dataset * conversion_factor
+        var.unit = output_unit
     return list_of_MVSeries
 
 
@@ -349,3 +319,68 @@ def clean_up_specific_temporary_files(key: str) -> list:
         )
     )
     return deleted_files
+
+
+@contextmanager
+def file_lock(lock_path: str, timeout: float = 600, stale_seconds: float = 600):
+    """
+    Holds a lock file while the with block runs, so one thread or process at a time does what's inside.
+    The lock file is made with O_EXCL, which works between processes on every platform. A lock file older than
+    stale_seconds was left by a process that stopped, and is taken over.
+    Parameters
+    ----------
+    lock_path: str
+        the lock file
+    timeout: float
+        seconds to wait for the lock before raising a TimeoutError
+    stale_seconds: float
+        seconds after which a lock file is taken over
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            lock_file = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(lock_path) > stale_seconds:
+                logger.warning("Taking over the stale lock file {}".format(lock_path))
+                os.remove(lock_path)
+                continue
+        except FileNotFoundError:
+            continue
+        if time.monotonic() > deadline:
+            raise TimeoutError("Could not take the lock file {}".format(lock_path))
+        time.sleep(LOCK_POLL_SECONDS)
+    os.write(lock_file, str(os.getpid()).encode())
+    os.close(lock_file)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    """
+    Opens a temporary file next to path to write, and replaces path with it once the with block is done, so
+    other threads and processes never read half of a file
+    Parameters
+    ----------
+    path: str
+        the file to write
+    mode: str
+        the open mode, "w" or "wb"
+    """
+    temp_path = "{}.{}.{}.writing".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp_path, mode) as f:
+            yield f
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -1,15 +1,27 @@
 import logging
 import os
-from json import loads
+import sqlite3
+from json import loads, dumps
 
+import numpy as np
 import xarray as xr
-from osgeo.gdal import OpenEx, OF_VECTOR, UseExceptions
-from shapely.geometry import shape, Polygon
+from shapely import wkb
+from shapely.geometry import shape, mapping, Polygon
 import GLHE.CLAY.globals
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+HYDROLAKES_SHAPEFILE_PATH = os.path.join(
+    Path(__file__).parent,
+    "LocalData/HydroLAKES_polys_v10_shp/HydroLAKES_polys_v10.shp",
+)
+HYDROLAKES_INDEX_PATH = os.path.join(
+    Path(__file__).parent, "LocalData/HydroLAKES_polys_v10_index.sqlite"
+)
+# Bump this if the layout of the index changes, old indexes are then rebuilt
+HYDROLAKES_INDEX_VERSION = 1
+
 
 class LakeExtraction:
     """Lake extraction class, mainly to hold the geojson file."""
@@ -21,6 +33,7 @@ class LakeExtraction:
 
     def __init__(self):
         """Initializes the data access class"""
+        self.index_connection = None
         self.create_logger()
         if not self.verify_inputs():
             raise ValueError("Invalid inputs")
@@ -47,7 +60,7 @@ class LakeExtraction:
         self.logger.addHandler(fh)
 
     def extract_lake_information(self, hylak_id: int) -> None:
-        """Extracts lake from shapefile
+        """Extracts lake from the HydroLAKES index, or the shapefile if the index is missing or stale
 
          Parameters
          __________
@@ -61,14 +74,51 @@ class LakeExtraction:
         shapely Polygon
                 polygon of specified lake
         """
+        if self.index_connection is None and hydrolakes_index_is_current():
+            # Kept open, so looking up more lakes doesn't reopen the index
+            self.index_connection = sqlite3.connect(
+                "file:{}?mode=ro".format(HYDROLAKES_INDEX_PATH),
+                uri=True,
+                check_same_thread=False,
+            )
+        if self.index_connection is not None:
+            self.lake_information = read_lake_from_hydrolakes_index(
+                hylak_id, connection=self.index_connection
+            )
+        else:
+            self.logger.info(
+                "No current HydroLAKES index, scanning the shapefile. Run build_hydrolakes_index() once to speed this up"
+            )
+            self.lake_information = self.scan_hydrolakes_shapefile(hylak_id)
+        if self.lake_information is None:
+            raise ValueError("Lake {} not found in HydroLAKES".format(hylak_id))
+        ln = self.lake_information["properties"]["Lake_name"]
+        if ln is None:
+            ln = str(hylak_id)
+        self.lake_name = ln.replace(" ", "_")
+        logger.info("Extracted Lake: {}".format(self.lake_name))
+        self.polygon = shape(self.lake_information["geometry"])
+        self.logger.info("Extracted Polygon")
+
+    def scan_hydrolakes_shapefile(self, hylak_id: int) -> dict:
+        """Queries the HydroLAKES shapefile for one lake, this is a full attribute scan so it is slow
+
+        Parameters
+        ----------
+        hylak_id : int
+            ID of the lake
+        Returns
+        -------
+        dict
+            The lake as a GeoJSON feature, None if the lake isn't in the shapefile
+        """
+        # GDAL is only imported when the shapefile is read, most runs use the index
+        from osgeo.gdal import OpenEx, OF_VECTOR, UseExceptions
+
         UseExceptions()
 
         # Read in the shapefile and open it with gdal.OpenEx
-        hydro_lakes_shapefile_location = os.path.join(
-            Path(__file__).parent,
-            "LocalData/HydroLAKES_polys_v10_shp/HydroLAKES_polys_v10.shp",
-        )
-        hydro_lakes = OpenEx(hydro_lakes_shapefile_location, OF_VECTOR)
+        hydro_lakes = OpenEx(HYDROLAKES_SHAPEFILE_PATH, OF_VECTOR)
 
         # Access the data layer and access the lake from the lake ID passed in (It's in SQL)
         layer = hydro_lakes.GetLayer()
@@ -79,16 +129,12 @@ class LakeExtraction:
 
         # Get the lake polygon and export as a geoJSON
         feature = result.GetNextFeature()
-        self.lake_information = loads(feature.ExportToJson())
-        ln = self.lake_information["properties"]["Lake_name"]
-        if ln is None:
-            ln = str(hylak_id)
-        self.lake_name = ln.replace(" ", "_")
-        logger.info("Extracted Lake: {}".format(self.lake_name))
-        self.polygon = shape(self.lake_information["geometry"])
-        self.logger.info("Extracted Polygon")
-        feature.Destroy()
+        lake_information = None
+        if feature is not None:
+            lake_information = loads(feature.ExportToJson())
+            feature.Destroy()
         hydro_lakes.ReleaseResultSet(result)
+        return lake_information
 
     def get_lake_polygon(self) -> Polygon:
         """Reads in the geojson and gets the lake polygon"""
@@ -110,6 +156,181 @@ class LakeExtraction:
         return self.lake_name
 
 
+def hydrolakes_source_stamp(shapefile_path: str = HYDROLAKES_SHAPEFILE_PATH) -> str:
+    """
+    Describes the HydroLAKES shapefile by the size and modification time of its .shp and .dbf files
+    Parameters
+    ----------
+    shapefile_path : str
+        Path to the .shp file
+    Returns
+    -------
+    str
+        A string that changes whenever the shapefile changes
+    """
+    stamp = {"version": HYDROLAKES_INDEX_VERSION}
+    for extension in [".shp", ".dbf"]:
+        file_stat = os.stat(os.path.splitext(shapefile_path)[0] + extension)
+        stamp[extension] = [file_stat.st_size, file_stat.st_mtime_ns]
+    return dumps(stamp, sort_keys=True)
+
+
+def write_hydrolakes_index(index_path: str, lakes, source_stamp: str) -> None:
+    """
+    Writes lakes to a HydroLAKES index, replacing any index already at index_path
+    Parameters
+    ----------
+    index_path : str
+        Where the sqlite index is written
+    lakes : iterable of (dict, bytes)
+        The properties and the WKB geometry of each lake
+    source_stamp : str
+        The stamp of the shapefile the lakes came from, see hydrolakes_source_stamp
+    """
+    temp_index_path = index_path + ".building"
+    if os.path.exists(temp_index_path):
+        os.remove(temp_index_path)
+    connection = sqlite3.connect(temp_index_path)
+    try:
+        connection.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+        connection.execute(
+            "CREATE TABLE lakes (hylak_id INTEGER PRIMARY KEY, lake_name TEXT, lake_area REAL, "
+            "depth_avg REAL, properties TEXT, geometry BLOB)"
+        )
+        batch = []
+        for properties, geometry in lakes:
+            batch.append(
+                (
+                    properties["Hylak_id"],
+                    properties.get("Lake_name"),
+                    properties.get("Lake_area"),
+                    properties.get("Depth_avg"),
+                    dumps(properties),
+                    geometry,
+                )
+            )
+            if len(batch) >= 10000:
+                connection.executemany(
+                    "INSERT INTO lakes VALUES (?, ?, ?, ?, ?, ?)", batch
+                )
+                batch = []
+        connection.executemany("INSERT INTO lakes VALUES (?, ?, ?, ?, ?, ?)", batch)
+        connection.execute(
+            "INSERT INTO metadata VALUES ('source_stamp', ?)", (source_stamp,)
+        )
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temp_index_path, index_path)
+
+
+def build_hydrolakes_index(
+    shapefile_path: str = HYDROLAKES_SHAPEFILE_PATH,
+    index_path: str = HYDROLAKES_INDEX_PATH,
+) -> str:
+    """
+    One-time conversion of the HydroLAKES shapefile into a sqlite index keyed on hylak_id, so
+    LakeExtraction doesn't have to scan the shapefile for every lake
+    Parameters
+    ----------
+    shapefile_path : str
+        Path to the HydroLAKES .shp file
+    index_path : str
+        Where the index is written
+    Returns
+    -------
+    str
+        The path of the index
+    """
+    from osgeo.gdal import OpenEx, OF_VECTOR, UseExceptions
+
+    UseExceptions()
+    logger.info("Building HydroLAKES index at {}".format(index_path))
+    hydro_lakes = OpenEx(shapefile_path, OF_VECTOR)
+    layer = hydro_lakes.GetLayer()
+    layer_definition = layer.GetLayerDefn()
+    field_names = [
+        layer_definition.GetFieldDefn(i).GetName()
+        for i in range(layer_definition.GetFieldCount())
+    ]
+
+    def lakes():
+        for feature in layer:
+            properties = {name: feature.GetField(name) for name in field_names}
+            yield properties, bytes(feature.GetGeometryRef().ExportToWkb())
+
+    write_hydrolakes_index(index_path, lakes(), hydrolakes_source_stamp(shapefile_path))
+    hydro_lakes = None
+    logger.info("Finished building HydroLAKES index")
+    return index_path
+
+
+def hydrolakes_index_is_current(
+    shapefile_path: str = HYDROLAKES_SHAPEFILE_PATH,
+    index_path: str = HYDROLAKES_INDEX_PATH,
+) -> bool:
+    """
+    Checks that the HydroLAKES index exists and was built from the current shapefile. If the shapefile
+    isn't around anymore, the index is all we have, so it counts as current.
+    """
+    if not os.path.exists(index_path):
+        return False
+    connection = sqlite3.connect("file:{}?mode=ro".format(index_path), uri=True)
+    try:
+        row = connection.execute(
+            "SELECT value FROM metadata WHERE key = 'source_stamp'"
+        ).fetchone()
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        connection.close()
+    if row is None:
+        return False
+    if not os.path.exists(shapefile_path):
+        return True
+    return row[0] == hydrolakes_source_stamp(shapefile_path)
+
+
+def read_lake_from_hydrolakes_index(
+    hylak_id: int,
+    index_path: str = HYDROLAKES_INDEX_PATH,
+    connection: sqlite3.Connection = None,
+) -> dict:
+    """
+    Looks up a lake in the HydroLAKES index
+    Parameters
+    ----------
+    hylak_id : int
+        ID of the lake
+    index_path : str
+        Path to the index built by build_hydrolakes_index
+    connection : sqlite3.Connection
+        An open connection to the index to use instead of index_path, it is left open
+    Returns
+    -------
+    dict
+        The lake as a GeoJSON feature (like the shapefile export), None if the lake isn't in the index
+    """
+    close_connection = connection is None
+    if close_connection:
+        connection = sqlite3.connect("file:{}?mode=ro".format(index_path), uri=True)
+    try:
+        row = connection.execute(
+            "SELECT properties, geometry FROM lakes WHERE hylak_id = ?",
+            (int(hylak_id),),
+        ).fetchone()
+    finally:
+        if close_connection:
+            connection.close()
+    if row is None:
+        return None
+    return {
+        "type": "Feature",
+        "properties": loads(row[0]),
+        "geometry": mapping(wkb.loads(row[1])),
+    }
+
+
 def extract_watershed_of_lake(polygon: Polygon) -> Polygon:
     """
     Extract lake watershed polygon using HydroSheds dataset
@@ -126,11 +347,117 @@ def extract_watershed_of_lake(polygon: Polygon) -> Polygon:
     return None
 
 
+def coordinate_index_bounds(values: np.ndarray, low: float, high: float) -> tuple:
+    """
+    Finds the index range of a sorted 1-D coordinate that falls within [low, high] with a binary search
+    Parameters
+    ----------
+    values : np.ndarray
+        The coordinate values, ascending or descending
+    low : float
+        The lower bound
+    high : float
+        The upper bound
+    Returns
+    -------
+    tuple
+        (start, stop) so that values[start:stop] are the values within the bounds
+    """
+    if values[0] <= values[-1]:
+        return (
+            int(np.searchsorted(values, low, "left")),
+            int(np.searchsorted(values, high, "right")),
+        )
+    reversed_values = values[::-1]
+    return (
+        len(values) - int(np.searchsorted(reversed_values, high, "right")),
+        len(values) - int(np.searchsorted(reversed_values, low, "left")),
+    )
+
+
 def subset_box(da: xr.Dataset, poly: Polygon, pad=1, long_type_180=False) -> xr.Dataset:
+    """Subset an xarray object to the smallest box including the polygon.
+    Assuming the polygon is defined as lon/lat and that those are variables in da.
+    The grid cells with centers falling within the bounds of the polygon are found with a binary search
+    on the lat/lon coordinates, then a padding of {pad} cells is added around them to be sure all points
+    are included. The result is a lazy isel view, so only the lake's box is ever read. When the polygon crosses
+    the 0/360 seam the longitudes before the seam are returned below 0, so they stay continuous.
+
+    Parameters
+    ----------
+    da : xr.Dataset
+        The dataset to subset
+    poly : Polygon
+        The polygon to use for subsetting
+    pad : int
+        The number of cells to add around the polygon
+    long_type_180 : bool
+        Should we convert from [-180,180] to [0,360]
+    Returns
+    -------
+    xr.Dataset
+        The subsetted dataset
+    """
+    if len(da.lon.dims) != 1 or len(da.lat.dims) != 1:
+        return subset_box_with_mask(da, poly, pad, long_type_180)
+
+    if hasattr(poly, "total_bounds"):
+        min_lon, min_lat, max_lon, max_lat = poly.total_bounds
+    else:
+        min_lon, min_lat, max_lon, max_lat = poly.bounds
+
+    lat_values = da.lat.values
+    lon_values = da.lon.values
+    lat_start, lat_stop = coordinate_index_bounds(lat_values, min_lat, max_lat)
+    lat_indexer = slice(max(lat_start - pad, 0), min(lat_stop + pad, len(lat_values)))
+
+    ## Change from [-180,180] to [0,360] ##
+    if long_type_180:
+        min_lon = min_lon % 360
+        max_lon = max_lon % 360
+    if min_lon <= max_lon:
+        lon_start, lon_stop = coordinate_index_bounds(lon_values, min_lon, max_lon)
+        lon_is_empty = lon_start >= lon_stop
+        lon_indexer = slice(
+            max(lon_start - pad, 0), min(lon_stop + pad, len(lon_values))
+        )
+    else:
+        # The polygon crosses the 0/360 seam, take the cells on both ends and wrap the padding around
+        lon_start = coordinate_index_bounds(lon_values, min_lon, 360)[0]
+        lon_stop = coordinate_index_bounds(lon_values, 0, max_lon)[1]
+        lon_is_empty = lon_start == len(lon_values) and lon_stop == 0
+        lon_positions = np.arange(lon_start - pad, len(lon_values) + lon_stop + pad)
+        lon_indexer = lon_positions % len(lon_values)
+
+    if lat_start >= lat_stop or lon_is_empty:
+        raise ValueError(
+            (
+                "The returned mask is empty. Either the polygons do not overlap with "
+                "the grid or they are too small. In the latter case, try adding a "
+                "buffer: subset_box(da, poly.buffer(0.5))."
+            )
+        )
+
+    logger.info(
+        "Subsetted the dataset {} to lake area".format(da.attrs["product_name"])
+    )
+    subset = da.isel({da.lat.dims[0]: lat_indexer, da.lon.dims[0]: lon_indexer})
+    if min_lon > max_lon:
+        # The cells before the seam are taken a turn back, so the longitudes stay continuous for the cell edges
+        subset = subset.assign_coords(
+            lon=subset.lon - 360 * (lon_positions < len(lon_values))
+        )
+    return subset
+
+
+def subset_box_with_mask(
+    da: xr.Dataset, poly: Polygon, pad=1, long_type_180=False
+) -> xr.Dataset:
     """FROM ONLINE SOURCE!!!!! Subset an xarray object to the smallest box including the polygon.
     Assuming the polygon is defined as lon/lat and that those are variables in da.
     A mask if first constructed for all grid centers falling within the bounds of the polygon,
     then a padding of {pad} cells is added around it to be sure all points are included.
+    This builds a mask over the whole grid, so subset_box only uses it for 2-D lat/lon coordinates.
 
     Parameters
     ----------
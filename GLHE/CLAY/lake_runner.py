@@ -0,0 +1,208 @@
+import copy
+import logging
+import multiprocessing
+import queue
+import time
+import traceback
+
+import psutil
+import GLHE.CLAY.globals
+from GLHE.CLAY import CLAY_driver, lake_extraction
+from GLHE.CLAY.data_access import data_check
+
+logger = logging.getLogger(__name__)
+
+# How long the runner waits on the workers before checking that they are still alive
+WORKER_POLL_SECONDS = 5
+
+
+def lake_worker(
+    task_queue: multiprocessing.Queue,
+    result_queue: multiprocessing.Queue,
+    config: dict,
+    driver_class: type = CLAY_driver.CLAY_driver,
+) -> None:
+    """
+    Runs lakes from the task queue until it gets None. The imports, pint registry, HydroLAKES index and
+    the data products (with their opened datasets) are set up once and kept for every lake the worker runs.
+    Parameters
+    ----------
+    task_queue: multiprocessing.Queue
+        Hylak_ids to run, None to stop. Each worker has its own, so the runner knows which worker has a lake
+    result_queue: multiprocessing.Queue
+        ("started", Hylak_id, pid) when a lake starts, ("finished", Hylak_id, result) when it's done
+    config: dict
+        GLHE.CLAY.globals.config of the runner
+    driver_class: type
+        The driver running the lakes, with set_up_logging() and run_lake(hylak_id, lake_extraction_object)
+    """
+    GLHE.CLAY.globals.config.update(config)
+    driver = driver_class()
+    driver.set_up_logging()
+    lake_extraction_object = lake_extraction.LakeExtraction()
+    process = psutil.Process()
+    while True:
+        hylak_id = task_queue.get()
+        if hylak_id is None:
+            break
+        result_queue.put(("started", hylak_id, process.pid))
+        result = {"output_directory": None, "error": None, "worker": process.pid}
+        start = time.perf_counter()
+        try:
+            result["output_directory"] = driver.run_lake(
+                hylak_id, lake_extraction_object
+            )
+        except Exception:
+            result["error"] = traceback.format_exc()
+        result["seconds"] = time.perf_counter() - start
+        result["memory_mb"] = process.memory_info().rss / 2**20
+        result_queue.put(("finished", hylak_id, result))
+
+
+def available_memory_mb() -> float:
+    """The memory available to start more lakes, in MB"""
+    return psutil.virtual_memory().available / 2**20
+
+
+def lake_failure(error: str, worker: int = None) -> dict:
+    """The result of a lake that didn't run"""
+    return {
+        "output_directory": None,
+        "error": error,
+        "seconds": None,
+        "worker": worker,
+        "memory_mb": None,
+    }
+
+
+def run_lakes_in_process_pool(
+    hylak_ids: list[int],
+    num_workers: int = None,
+    driver_class: type = CLAY_driver.CLAY_driver,
+) -> dict:
+    """
+    Runs many lakes on a pool of worker processes that are started once and kept warm across lakes.
+    A lake is handed to a worker only once the worker is idle, and only while there is at least
+    LAKE_RUNNER_MIN_AVAILABLE_MEMORY_MB of memory available, unless nothing is running. The lakes of a
+    worker that stops fail, whether or not they had started.
+    The workers are spawned, so scripts calling this need an if __name__ == "__main__": guard.
+    Parameters
+    ----------
+    hylak_ids: list[int]
+        The lakes to run
+    num_workers: int
+        Number of worker processes, LAKE_RUNNER_WORKERS if None
+    driver_class: type
+        See lake_worker, importable by the spawned workers
+    Returns
+    -------
+    dict
+        Hylak_id -> {"output_directory", "error", "seconds", "worker", "memory_mb"}, in the order of hylak_ids.
+        error is None if the lake ran, otherwise the traceback.
+    """
+    if num_workers is None:
+        num_workers = GLHE.CLAY.globals.config["LAKE_RUNNER_WORKERS"]
+    num_workers = max(1, min(num_workers, len(hylak_ids)))
+    min_available_memory_mb = GLHE.CLAY.globals.config[
+        "LAKE_RUNNER_MIN_AVAILABLE_MEMORY_MB"
+    ]
+    # Checked once here, instead of by every worker
+    data_check.check_data_and_download_missing_data_or_files()
+
+    # Spawned, so workers don't inherit the runner's threads and open files
+    context = multiprocessing.get_context("spawn")
+    task_queues = [context.Queue() for _ in range(num_workers)]
+    result_queue = context.Queue()
+    workers = [
+        context.Process(
+            target=lake_worker,
+            args=(
+                task_queue,
+                result_queue,
+                copy.deepcopy(GLHE.CLAY.globals.config),
+                driver_class,
+            ),
+            name="GLHE_lake_worker_{}".format(i),
+        )
+        for i, task_queue in enumerate(task_queues)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info("Started {} lake workers".format(num_workers))
+
+    waiting = list(hylak_ids)
+    # Hylak_id -> the worker that was handed the lake, until it finishes
+    assigned = {}
+    started = set()
+    results = {}
+    start = time.perf_counter()
+    try:
+        while waiting or assigned:
+            # Lakes of workers that stopped won't finish, even the ones whose start message was lost
+            for hylak_id, worker in list(assigned.items()):
+                if not worker.is_alive():
+                    del assigned[hylak_id]
+                    results[hylak_id] = lake_failure(
+                        "Worker {} stopped {} the lake".format(
+                            worker.pid,
+                            "while running" if hylak_id in started else "before starting",
+                        ),
+                        worker.pid,
+                    )
+                    logger.error("Lake {} failed: {}".format(hylak_id, results[hylak_id]["error"]))
+            alive_workers = [worker for worker in workers if worker.is_alive()]
+            if not alive_workers:
+                for hylak_id in waiting:
+                    results[hylak_id] = lake_failure("No lake workers left to run the lake")
+                break
+            # Admit lakes while there are idle workers and enough memory
+            for worker, task_queue in zip(workers, task_queues):
+                if not waiting:
+                    break
+                if not worker.is_alive() or worker in assigned.values():
+                    continue
+                if assigned and available_memory_mb() < min_available_memory_mb:
+                    logger.info(
+                        "Waiting for memory to start more lakes, {:.0f}MB available".format(
+                            available_memory_mb()
+                        )
+                    )
+                    break
+                hylak_id = waiting.pop(0)
+                task_queue.put(hylak_id)
+                assigned[hylak_id] = worker
+            try:
+                message, hylak_id, content = result_queue.get(
+                    timeout=WORKER_POLL_SECONDS
+                )
+            except queue.Empty:
+                continue
+            if message == "started":
+                started.add(hylak_id)
+            elif assigned.pop(hylak_id, None) is not None:
+                results[hylak_id] = content
+                if content["error"] is None:
+                    logger.info(
+                        "Lake {} finished in {:.1f}s".format(hylak_id, content["seconds"])
+                    )
+                else:
+                    logger.error(
+                        "Lake {} failed with Exception: {}".format(
+                            hylak_id, content["error"]
+                        )
+                    )
+    finally:
+        for task_queue in task_queues:
+            task_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=WORKER_POLL_SECONDS)
+            if worker.is_alive():
+                worker.terminate()
+    logger.info(
+        "Ran {} lakes in {:.1f}s, {} failed".format(
+            len(results),
+            time.perf_counter() - start,
+            sum(result["error"] is not None for result in results.values()),
+        )
+    )
+    return {hylak_id: results[hylak_id] for hylak_id in hylak_ids if hylak_id in results}
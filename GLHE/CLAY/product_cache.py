@@ -0,0 +1,361 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import weakref
+
+import dask
+import xarray as xr
+from shapely.geometry import Polygon
+import GLHE.CLAY.globals
+from GLHE.CLAY import helpers, xarray_helpers
+
+logger = logging.getLogger(__name__)
+
+# Entries used this recently may still be read lazily by another thread or process, so they aren't evicted
+EVICTION_MIN_AGE_SECONDS = 60
+
+# Counted by this process only, see get_cache_statistics
+cache_statistics = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+statistics_lock = threading.Lock()
+# The threads of a process write & open entries one at a time, netCDF/HDF5 isn't thread safe
+write_lock = threading.RLock()
+# Entry path -> how many datasets of this process have it open
+open_entries = {}
+open_entries_lock = threading.Lock()
+
+
+def get_cache_directory() -> str:
+    """The folder processed products are cached in, under the CACHE_DIRECTORY"""
+    return os.path.join(
+        GLHE.CLAY.globals.config["DIRECTORIES"]["CACHE_DIRECTORY"], "products"
+    )
+
+
+def source_identity(*sources: str) -> list:
+    """
+    Describes the source data of a product so the cache key changes when the source data changes
+    Parameters
+    ----------
+    sources: str
+        local file paths (identified by path, size, & modification time) or remote urls (identified by the url)
+    Returns
+    -------
+    list
+        the identity of each source
+    """
+    identity = []
+    for source in sources:
+        if os.path.exists(source):
+            file_stat = os.stat(source)
+            identity.append([source, file_stat.st_size, file_stat.st_mtime_ns])
+        else:
+            identity.append([source])
+    return identity
+
+
+def open_source_zarr_store(store_path: str, sources: list) -> xr.Dataset:
+    """
+    Opens a zarr store rechunked from the source data (see xarray_helpers.rechunk_xarray_dataset_to_zarr), if
+    it was made from the source data as it is now
+    Parameters
+    ----------
+    store_path: str
+        the zarr store
+    sources: list
+        the source identity, see source_identity
+    Returns
+    -------
+    xr.Dataset
+        the store, None if there is no store or it was made from other source data
+    """
+    if not os.path.exists(store_path):
+        return None
+    dataset = xr.open_zarr(store_path)
+    if dataset.attrs.get(xarray_helpers.ZARR_SOURCE_ATTRIBUTE) != json.dumps(sources):
+        logger.warning(
+            "Ignoring the zarr store {}, it wasn't made from the current source data".format(store_path)
+        )
+        dataset.close()
+        return None
+    return dataset
+
+
+def product_cache_key(
+    product_name: str, polygon: Polygon, sources: list, processing_version: int
+) -> str:
+    """
+    Makes the cache key of a processed product for one lake
+    Parameters
+    ----------
+    product_name: str
+        the product, like "CRUTS"
+    polygon: Polygon
+        the lake polygon the product was subset to
+    sources: list
+        the source identity, see source_identity
+    processing_version: int
+        the product's processing version, bump it when the processing code changes
+    Returns
+    -------
+    str
+        the key, the product name and a hash of everything else
+    """
+    hash_object = hashlib.sha256(polygon.wkb)
+    hash_object.update(json.dumps([sources, processing_version]).encode())
+    return product_name + "_" + hash_object.hexdigest()
+
+
+def count_statistic(name: str) -> None:
+    with statistics_lock:
+        cache_statistics[name] += 1
+
+
+def cache_lock():
+    """
+    The lock file the threads and processes sharing the cache take to add or evict entries, see helpers.file_lock
+    """
+    cache_directory = GLHE.CLAY.globals.config["DIRECTORIES"]["CACHE_DIRECTORY"]
+    os.makedirs(cache_directory, exist_ok=True)
+    return helpers.file_lock(os.path.join(cache_directory, "products.lock"))
+
+
+def get_entry_path(key: str) -> str:
+    """The path of a cache entry, the format comes from PRODUCT_CACHE_FORMAT"""
+    if GLHE.CLAY.globals.config["PRODUCT_CACHE_FORMAT"] == "zarr":
+        return os.path.join(get_cache_directory(), key + ".zarr")
+    return os.path.join(get_cache_directory(), key + ".nc")
+
+
+def open_entry(entry_path: str) -> xr.Dataset:
+    """Opens a cache entry lazily, it isn't evicted by this process until the dataset is garbage collected"""
+    with write_lock:
+        if entry_path.endswith(".zarr"):
+            dataset = xr.open_zarr(entry_path)
+        else:
+            dataset = xr.open_dataset(entry_path)
+    with open_entries_lock:
+        open_entries[entry_path] = open_entries.get(entry_path, 0) + 1
+    weakref.finalize(dataset, release_entry, entry_path)
+    return dataset
+
+
+def release_entry(entry_path: str) -> None:
+    """Called when a dataset from open_entry is garbage collected"""
+    with open_entries_lock:
+        open_entries[entry_path] -= 1
+        if open_entries[entry_path] == 0:
+            del open_entries[entry_path]
+
+
+def entry_in_use(entry_path: str) -> bool:
+    """An entry is in use if this process has it open, or it was used in the last EVICTION_MIN_AGE_SECONDS"""
+    with open_entries_lock:
+        if entry_path in open_entries:
+            return True
+    try:
+        return time.time() - os.path.getmtime(entry_path) < EVICTION_MIN_AGE_SECONDS
+    except FileNotFoundError:
+        return False
+
+
+def read_cached_product(key: str) -> xr.Dataset:
+    """
+    Opens a cached product lazily, so only the parts that get used are read
+    Parameters
+    ----------
+    key: str
+        the key from product_cache_key
+    Returns
+    -------
+    xr.Dataset
+        the cached dataset, None if it isn't cached
+    """
+    entry_path = get_entry_path(key)
+    try:
+        # The modification time is the last use, for the LRU eviction
+        os.utime(entry_path)
+        dataset = open_entry(entry_path)
+    except FileNotFoundError:
+        count_statistic("misses")
+        logger.info("Product cache miss: {}".format(key))
+        return None
+    count_statistic("hits")
+    logger.info("Product cache hit: {}".format(key))
+    return dataset
+
+
+def write_cached_product(key: str, dataset: xr.Dataset) -> xr.Dataset:
+    """
+    Writes a processed product to the cache, and evicts the least recently used entries if the cache is too big.
+    Writing computes the (lazy) dataset's task graph, so the cached copy is returned for everything after
+    to read from instead of computing it again.
+    Parameters
+    ----------
+    key: str
+        the key from product_cache_key
+    dataset: xr.Dataset
+        the processed product
+    Returns
+    -------
+    xr.Dataset
+        the cached product, or the dataset itself if it couldn't be cached
+    """
+    return write_cached_products({key: dataset})[key]
+
+
+def write_cached_products(datasets: dict) -> dict:
+    """
+    Writes many processed products to the cache in one compute, so the source chunks they share (like
+    neighbouring lakes in the same file) are only read once. See write_cached_product.
+    The threads of a process write one at a time (see write_lock), and the processes sharing the cache add
+    & evict entries one at a time (see cache_lock).
+    Parameters
+    ----------
+    datasets: dict
+        key from product_cache_key -> processed product
+    Returns
+    -------
+    dict
+        key -> the cached product, or the dataset itself if it couldn't be cached
+    """
+    with write_lock:
+        os.makedirs(get_cache_directory(), exist_ok=True)
+        # Each writer has its own temporary entries, threads & processes may be writing the same key
+        temp_entry_paths = {
+            key: "{}.{}.{}.writing".format(get_entry_path(key), os.getpid(), threading.get_ident())
+            for key in datasets
+        }
+        writes = []
+        for key, dataset in datasets.items():
+            temp_entry_path = temp_entry_paths[key]
+            remove_entry(temp_entry_path)
+            if get_entry_path(key).endswith(".zarr"):
+                writes.append(dataset.to_zarr(temp_entry_path, mode="w", compute=False))
+            else:
+                writes.append(dataset.to_netcdf(temp_entry_path, compute=False))
+        try:
+            with xarray_helpers.dask_compute_settings():
+                dask.compute(*writes)
+        except Exception as e:
+            logger.warning(
+                "Could not cache products {} with Exception: {}".format(
+                    list(datasets.keys()), e
+                )
+            )
+            for key in datasets:
+                remove_entry(temp_entry_paths[key])
+            return datasets
+        with cache_lock():
+            for key in datasets:
+                entry_path = get_entry_path(key)
+                if entry_in_use(entry_path):
+                    # Written by another writer and maybe being read, it holds the same product
+                    remove_entry(temp_entry_paths[key])
+                    continue
+                remove_entry(entry_path)
+                os.replace(temp_entry_paths[key], entry_path)
+                count_statistic("writes")
+        enforce_cache_size_limit()
+        cached_datasets = {}
+        for key, dataset in datasets.items():
+            try:
+                cached_datasets[key] = open_entry(get_entry_path(key))
+            except FileNotFoundError:
+                cached_datasets[key] = dataset
+        return cached_datasets
+
+
+def remove_entry(entry_path: str) -> None:
+    """Deletes a cache entry, a file or a zarr folder, if it's there"""
+    try:
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path)
+        elif os.path.exists(entry_path):
+            os.remove(entry_path)
+    except FileNotFoundError:
+        pass
+
+
+def get_entry_size(entry_path: str) -> int:
+    """Size of a cache entry in bytes"""
+    if not os.path.isdir(entry_path):
+        return os.path.getsize(entry_path)
+    size = 0
+    for folder, _, files in os.walk(entry_path):
+        for file in files:
+            size += os.path.getsize(os.path.join(folder, file))
+    return size
+
+
+def list_cache_entries() -> list:
+    """
+    Lists the cache entries, least recently used first. The cached cell weights of the lakes are entries too
+    (see xarray_helpers.get_lake_cell_weights). Entries removed by another writer while listing are left out
+    Returns
+    -------
+    list
+        (path, size in bytes, last use time) of each entry
+    """
+    entry_paths = []
+    for directory in [get_cache_directory(), xarray_helpers.get_cell_weight_directory()]:
+        if os.path.exists(directory):
+            entry_paths += [
+                os.path.join(directory, name)
+                for name in os.listdir(directory)
+                if not name.endswith(".writing")
+            ]
+    entries = []
+    for entry_path in entry_paths:
+        try:
+            entries.append(
+                (entry_path, get_entry_size(entry_path), os.path.getmtime(entry_path))
+            )
+        except FileNotFoundError:
+            continue
+    return sorted(entries, key=lambda entry: entry[2])
+
+
+def enforce_cache_size_limit() -> list:
+    """
+    Evicts the least recently used entries until the cache fits in PRODUCT_CACHE_SIZE_LIMIT_MB, skipping the
+    entries in use (see entry_in_use)
+    Returns
+    -------
+    list
+        paths of the evicted entries
+    """
+    size_limit = GLHE.CLAY.globals.config["PRODUCT_CACHE_SIZE_LIMIT_MB"] * 1024**2
+    evicted = []
+    with cache_lock():
+        entries = list_cache_entries()
+        total_size = sum(entry[1] for entry in entries)
+        for entry_path, size, _ in entries:
+            if total_size <= size_limit:
+                break
+            if entry_in_use(entry_path):
+                continue
+            remove_entry(entry_path)
+            total_size -= size
+            evicted.append(entry_path)
+            count_statistic("evictions")
+            logger.info("Evicted {} from the product cache".format(entry_path))
+    return evicted
+
+
+def get_cache_statistics() -> dict:
+    """
+    The hits, misses, writes, & evictions of this process, and the current size of the cache. Each process
+    sharing the cache counts its own
+    """
+    entries = list_cache_entries()
+    with statistics_lock:
+        statistics = dict(cache_statistics)
+    statistics["entries"] = len(entries)
+    statistics["size_mb"] = sum(entry[1] for entry in entries) / 1024**2
+    lookups = statistics["hits"] + statistics["misses"]
+    statistics["hit_rate"] = statistics["hits"] / lookups if lookups > 0 else None
+    return statistics
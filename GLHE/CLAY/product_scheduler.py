@@ -0,0 +1,126 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+
+import GLHE.CLAY.globals
+from GLHE.CLAY.data_access import data_access_parent_class
+
+logger = logging.getLogger(__name__)
+
+# How often the timers are checked while products wait for a worker, their timers start when a worker is free
+QUEUED_POLL_SECONDS = 0.1
+
+
+def run_product(
+    product: data_access_parent_class.DataAccess, polygon, debug: bool, run_cleanly: bool
+) -> tuple[list, float]:
+    """Runs one product's driver, and times it"""
+    start = time.perf_counter()
+    output_datasets = product.product_driver(polygon, debug, run_cleanly)
+    return output_datasets, time.perf_counter() - start
+
+
+def run_started_product(
+    started: dict, key: str, product: data_access_parent_class.DataAccess, polygon, debug: bool, run_cleanly: bool
+) -> tuple[list, float]:
+    """Records when a product's worker picked it up, its timeout counts from then, then runs it"""
+    started[key] = time.monotonic()
+    return run_product(product, polygon, debug, run_cleanly)
+
+
+def run_products_concurrently(
+    products: dict, polygon, debug=False, run_cleanly=False
+) -> dict:
+    """
+    Runs the product drivers of a lake at the same time, since they are independent and mostly wait on reads.
+    The events the products send are held while they run, then sent in the order of products so the README and
+    LIME config come out the same as a run one product at a time.
+    Each product times out PRODUCT_TIMEOUT_SECONDS after its worker started it. The thread of a product that
+    timed out can't be stopped and keeps using the product object, so the caller should replace the object of
+    every product that timed out before running it again.
+    The products share the product cache, the cell weight cache, and the NWM feature table, which are written
+    under their own locks (see product_cache.write_lock), so a product that timed out and is still writing can't
+    break them for the next lake.
+    Parameters
+    ----------
+    products: dict
+        key -> DataAccess object to run
+    polygon: shapely.geometry.Polygon
+        The polygon of the lake
+    debug: bool
+        See DataAccess.product_driver
+    run_cleanly: bool
+        See DataAccess.product_driver
+    Returns
+    -------
+    dict
+        key -> (list[MVSeries], None) if the product ran, or (None, Exception) if it failed or timed out
+        (a TimeoutError), in the order of products
+    """
+    max_workers = GLHE.CLAY.globals.config["PRODUCT_WORKERS"]
+    timeout = GLHE.CLAY.globals.config["PRODUCT_TIMEOUT_SECONDS"]
+    results = {}
+    if not products:
+        return results
+    workers = max(1, min(max_workers, len(products)))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="GLHE_product")
+    started = {}
+    futures = {}
+    for key, product in products.items():
+        product.hold_events()
+        futures[key] = executor.submit(
+            run_started_product, started, key, product, polygon, debug, run_cleanly
+        )
+    pending = dict(futures)
+    timed_out = []
+    try:
+        while pending:
+            deadlines = [started[key] + timeout for key in pending if key in started]
+            if len(deadlines) < len(pending):
+                deadlines.append(time.monotonic() + QUEUED_POLL_SECONDS)
+            wait(
+                pending.values(),
+                timeout=max(0.0, min(deadlines) - time.monotonic()),
+                return_when=FIRST_COMPLETED,
+            )
+            # Products still queued when every worker is held by a product that timed out would never start
+            workers_stuck = sum(not future.done() for future in timed_out) >= workers
+            for key, future in list(pending.items()):
+                if future.done():
+                    try:
+                        output_datasets, seconds = future.result()
+                        logger.info("Data Product: {} took {:.1f}s".format(key, seconds))
+                        results[key] = (output_datasets, None)
+                    except Exception as e:
+                        results[key] = (None, e)
+                elif key in started and time.monotonic() - started[key] >= timeout:
+                    timed_out.append(future)
+                    results[key] = (
+                        None,
+                        TimeoutError(
+                            "Data Product: {} timed out after {}s".format(key, timeout)
+                        ),
+                    )
+                elif key not in started and workers_stuck and future.cancel():
+                    results[key] = (
+                        None,
+                        TimeoutError(
+                            "Data Product: {} never started, every worker is held by a product that timed "
+                            "out".format(key)
+                        ),
+                    )
+                else:
+                    continue
+                del pending[key]
+    finally:
+        # Don't wait on products that timed out, their threads finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    results = {key: results[key] for key in products}
+    for key, product in products.items():
+        if results[key][1] is None:
+            product.release_events()
+        elif futures[key].done():
+            product.drop_held_events()
+        # Products still running after timing out keep holding, so their late events are never sent
+    return results
@@ -1,17 +1,82 @@
+import hashlib
+import json
 import logging
-
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import dask
+import numpy as np
+import shapely
 import xarray as xr
-import pint_xarray
+from shapely.geometry import Polygon
+import GLHE.CLAY.globals
 from GLHE.CLAY.globals import SLC_MAPPING
-from GLHE.CLAY.helpers import MVSeries
+from GLHE.CLAY.helpers import MVSeries, atomic_write, get_unit_conversion_plan
 from . import ureg
 
 logger = logging.getLogger(__name__)
 
+# How many lakes' cell weights are kept in memory, the least recently used are dropped
+CELL_WEIGHT_CACHE_SIZE = 256
+# In-memory copy of the cell weights, keyed the same as the files in the cache directory
+cell_weight_cache = OrderedDict()
+cell_weight_cache_lock = threading.Lock()
+
+
+def dask_compute_settings():
+    """
+    The dask settings everything in CLAY is computed with, use as a context manager around .compute()/.to_netcdf().
+    With chunk_xarray_dataset_to_memory_budget, the peak memory stays around DASK_MEMORY_BUDGET_MB.
+    """
+    return dask.config.set(
+        scheduler="threads", num_workers=GLHE.CLAY.globals.config["DASK_NUM_WORKERS"]
+    )
+
+
+def chunk_xarray_dataset_to_memory_budget(dataset: xr.Dataset) -> xr.Dataset:
+    """
+    Rechunks the (lazy) dataset along time so that every worker can hold a few chunks of every variable
+    within DASK_MEMORY_BUDGET_MB, no matter how long the time axis is
+    Parameters
+    ----------
+    dataset: xr.Dataset
+        the dataset, usually already subset to the lake
+    Returns
+    -------
+    xr.Dataset
+        the rechunked dataset
+    """
+    time_name = "time" if "time" in dataset.dims else "valid_time"
+    if time_name not in dataset.dims:
+        return dataset
+    bytes_per_time_step = 0
+    for var in dataset.data_vars.values():
+        if time_name in var.dims:
+            bytes_per_time_step += var.dtype.itemsize * int(
+                np.prod([var.sizes[dim] for dim in var.dims if dim != time_name])
+            )
+    chunk_budget = (
+        GLHE.CLAY.globals.config["DASK_MEMORY_BUDGET_MB"]
+        * 1024**2
+        // (GLHE.CLAY.globals.config["DASK_NUM_WORKERS"] * 4)
+    )
+    time_chunk = max(1, int(chunk_budget // max(bytes_per_time_step, 1)))
+    return dataset.chunk({time_name: time_chunk})
+
+
+def compute_xarray_dataset(dataset: xr.Dataset) -> xr.Dataset:
+    """Computes the dataset's task graph once, with the dask settings from dask_compute_settings"""
+    with dask_compute_settings():
+        return dataset.compute()
+
 
 def make_sure_xarray_dataset_is_positive(dataset: xr.Dataset, *vars: str) -> xr.Dataset:
     """
-    This function makes sure that the dataset is positive, if not it makes it positive
+    This function makes sure that the dataset is positive, if not it makes it positive. A dataset without
+    negative values is its own abs, so the abs is taken chunk by chunk without first reducing the whole
+    variable to its minimum, and it stays lazy.
     Parameters
     ----------
     dataset: xr.Dataset
@@ -23,14 +88,16 @@ def make_sure_xarray_dataset_is_positive(dataset: xr.Dataset, *vars: str) -> xr.
     xr.Dataset
         the dataset with all positive values
     """
+    dataset = dataset.copy()
     for variable_name in vars:
-        if dataset[variable_name].values.min() < 0:
-            logger.info(
-                "The dataset ({} {}) has negative values, making it positive".format(
-                    dataset.attrs["product_name"], variable_name
-                )
+        logger.info(
+            "Making the dataset ({} {}) positive if it has negative values".format(
+                dataset.attrs["product_name"], variable_name
             )
-            dataset[variable_name].values = abs(dataset[variable_name].values)
+        )
+        attrs = dataset[variable_name].attrs
+        dataset[variable_name] = abs(dataset[variable_name])
+        dataset[variable_name].attrs = attrs
     return dataset
 
 
@@ -54,8 +121,9 @@ def convert_xarray_dataset_to_mvseries(
         "Converted the dataset {} to MVSeries".format(dataset.attrs["product_name"])
     )
     series_list = []
+    computed_dataset = compute_xarray_dataset(dataset[list(vars)])
     for var in vars:
-        pandas_dataset = dataset.get(var).to_series()
+        pandas_dataset = computed_dataset.get(var).to_series()
         metadata_series = MVSeries(
             pandas_dataset,
             ureg.parse_expression(dataset.variables[var].attrs["units"]).units,
@@ -68,8 +136,150 @@ def convert_xarray_dataset_to_mvseries(
     return series_list
 
 
+def cell_edges(centers: np.ndarray) -> np.ndarray:
+    """
+    Gets the cell edges of a 1-D coordinate from the cell centers, assuming the edges are halfway between centers
+    Parameters
+    ----------
+    centers: np.ndarray
+        the cell centers, ascending or descending
+    Returns
+    -------
+    np.ndarray
+        the len(centers) + 1 cell edges
+    """
+    midpoints = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate(
+        [
+            [centers[0] - (midpoints[0] - centers[0])],
+            midpoints,
+            [centers[-1] + (centers[-1] - midpoints[-1])],
+        ]
+    )
+
+
+def compute_lake_cell_weights(
+    lat: np.ndarray, lon: np.ndarray, polygon: Polygon, cos_latitude: bool = False
+) -> np.ndarray:
+    """
+    Computes the fraction of each grid cell covered by the lake, with shapely 2 vectorized operations
+    Parameters
+    ----------
+    lat: np.ndarray
+        the 1-D latitude cell centers
+    lon: np.ndarray
+        the 1-D longitude cell centers, either [-180,180] or [0,360]
+    polygon: Polygon
+        the lake polygon in [-180,180] lon/lat
+    cos_latitude: bool
+        multiply the coverage by cos(latitude) so each cell counts by its area
+    Returns
+    -------
+    np.ndarray
+        (lat, lon) array of weights
+    """
+    if len(lat) < 2 or len(lon) < 2:
+        return np.ones((len(lat), len(lon)))
+    # The edges come from the longitudes made continuous across the seam, then each cell is moved by whole
+    # turns to the side of the seam the lake is on, so a lake crossing 0 or 180 meets cells on both sides
+    lon = np.unwrap(np.asarray(lon, dtype=float), period=360)
+    polygon_center = (polygon.bounds[0] + polygon.bounds[2]) / 2
+    lon_shift = ((lon - polygon_center + 180) % 360 - 180 + polygon_center) - lon
+    lon_edges = cell_edges(lon)
+    lat_edges = cell_edges(lat)
+    west, south = np.meshgrid(
+        np.minimum(lon_edges[:-1], lon_edges[1:]) + lon_shift,
+        np.minimum(lat_edges[:-1], lat_edges[1:]),
+    )
+    east, north = np.meshgrid(
+        np.maximum(lon_edges[:-1], lon_edges[1:]) + lon_shift,
+        np.maximum(lat_edges[:-1], lat_edges[1:]),
+    )
+    cells = shapely.box(west, south, east, north)
+    shapely.prepare(polygon)
+    hits = shapely.intersects(polygon, cells)
+    weights = np.zeros(cells.shape)
+    weights[hits] = shapely.area(
+        shapely.intersection(cells[hits], polygon)
+    ) / shapely.area(cells[hits])
+    if cos_latitude:
+        weights *= np.cos(np.deg2rad(lat))[:, np.newaxis]
+    return weights
+
+
+def get_cell_weight_directory() -> str:
+    """
+    The folder the cell weights are cached in, under the CACHE_DIRECTORY. The files count towards
+    PRODUCT_CACHE_SIZE_LIMIT_MB, see product_cache.list_cache_entries
+    """
+    return os.path.join(
+        GLHE.CLAY.globals.config["DIRECTORIES"]["CACHE_DIRECTORY"], "cell_weights"
+    )
+
+
+def get_lake_cell_weights(
+    dataset: xr.Dataset, polygon: Polygon, cos_latitude: bool = False
+) -> xr.DataArray:
+    """
+    Gets the lake cell weights for the dataset grid, from memory or the cache directory if they were
+    computed before for this grid and polygon, otherwise computes and caches them
+    Parameters
+    ----------
+    dataset: xr.Dataset
+        the dataset with 1-D lat & lon coordinates
+    polygon: Polygon
+        the lake polygon
+    cos_latitude: bool
+        see compute_lake_cell_weights
+    Returns
+    -------
+    xr.DataArray
+        (lat, lon) weights
+    """
+    lat = np.asarray(dataset["lat"].values, dtype="float64")
+    lon = np.asarray(dataset["lon"].values, dtype="float64")
+    hash_object = hashlib.sha1(lat.tobytes())
+    hash_object.update(lon.tobytes())
+    hash_object.update(polygon.wkb)
+    hash_object.update(str(cos_latitude).encode())
+    key = dataset.attrs["product_name"] + "_" + hash_object.hexdigest()
+
+    with cell_weight_cache_lock:
+        weights = cell_weight_cache.get(key)
+        if weights is not None:
+            cell_weight_cache.move_to_end(key)
+    if weights is None:
+        cache_file = os.path.join(get_cell_weight_directory(), key + ".npy")
+        try:
+            weights = np.load(cache_file)
+            # The modification time is the last use, for the product cache's LRU eviction
+            os.utime(cache_file)
+        except (OSError, EOFError, ValueError):
+            logger.info(
+                "Computing lake cell weights for the dataset {}".format(
+                    dataset.attrs["product_name"]
+                )
+            )
+            weights = compute_lake_cell_weights(lat, lon, polygon, cos_latitude)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with atomic_write(cache_file, "wb") as f:
+                np.save(f, weights)
+        with cell_weight_cache_lock:
+            cell_weight_cache[key] = weights
+            while len(cell_weight_cache) > CELL_WEIGHT_CACHE_SIZE:
+                cell_weight_cache.popitem(last=False)
+    return xr.DataArray(
+        weights,
+        coords={"lat": dataset["lat"].values, "lon": dataset["lon"].values},
+        dims=["lat", "lon"],
+    )
+
+
 def spatially_average_xarray_dataset_and_convert(
-    dataset: xr.Dataset, *vars: str
+    dataset: xr.Dataset,
+    *vars: str,
+    polygon: Polygon = None,
+    cos_latitude: bool = False,
 ) -> tuple[MVSeries]:
     """Spatially average xarray data to one value over entire grid
 
@@ -79,6 +289,10 @@ def spatially_average_xarray_dataset_and_convert(
         The daily xarray dataset to group
     vars: str
         The variable names to average over
+    polygon: Polygon
+        If given, each cell is weighted by how much of it the lake covers instead of a plain mean
+    cos_latitude: bool
+        If weighting by the polygon, also weight each cell by cos(latitude)
     Returns
     -------
     tuple of MVSeries
@@ -89,9 +303,25 @@ def spatially_average_xarray_dataset_and_convert(
     logger.info(
         "Spatially Averaged the dataset {}".format(dataset.attrs["product_name"])
     )
+    averaged_dataset = None
+    if polygon is not None:
+        weights = get_lake_cell_weights(dataset, polygon, cos_latitude)
+        if weights.sum() > 0:
+            averaged_dataset = dataset[list(vars)].weighted(weights).mean(
+                dim=[lat_name, lon_name]
+            )
+        else:
+            logger.warning(
+                "The lake doesn't cover any cell of {}, using a plain mean".format(
+                    dataset.attrs["product_name"]
+                )
+            )
+    if averaged_dataset is None:
+        averaged_dataset = dataset[list(vars)].mean(dim=[lat_name, lon_name])
+    averaged_dataset = compute_xarray_dataset(averaged_dataset)
     series_list = []
     for var in vars:
-        pandas_dataset = dataset.mean(dim=[lat_name, lon_name]).get(var).to_series()
+        pandas_dataset = averaged_dataset.get(var).to_series()
         metadata_series = MVSeries(
             pandas_dataset,
             ureg.parse_expression(dataset.variables[var].attrs["units"]).units,
@@ -104,6 +334,65 @@ def spatially_average_xarray_dataset_and_convert(
     return tuple(series_list)
 
 
+# The store attribute holding the source identity of a rechunked store, see product_cache.source_identity
+ZARR_SOURCE_ATTRIBUTE = "GLHE_source_identity"
+
+
+def rechunk_xarray_dataset_to_zarr(
+    dataset: xr.Dataset, store_path: str, spatial_chunk_size: int = 16, source: list = None
+) -> str:
+    """
+    Writes the dataset to a zarr store chunked for time series reads: small spatial chunks that each hold the
+    whole time axis, so reading a lake's box only reads a few small chunks. It's written one band of latitude
+    at a time, so only a band is ever in memory.
+    Parameters
+    ----------
+    dataset: xr.Dataset
+        the dataset to rechunk, like a multi-file dataset of whole maps
+    store_path: str
+        where the zarr store is written
+    spatial_chunk_size: int
+        the number of lat & lon cells in a chunk
+    source: list
+        the source identity of the dataset, stamped on the store so readers can tell it's out of date
+    Returns
+    -------
+    str
+        the store path
+    """
+    spatial_names = ["lat", "latitude", "lon", "longitude"]
+    lat_name = next(dim for dim in dataset.dims if dim in ["lat", "latitude"])
+    chunks = {
+        dim: spatial_chunk_size if dim in spatial_names else -1 for dim in dataset.dims
+    }
+    dataset = dataset.chunk(chunks)
+    for var in dataset.variables:
+        dataset[var].encoding = {}
+    if source is not None:
+        dataset.attrs[ZARR_SOURCE_ATTRIBUTE] = json.dumps(source)
+
+    temp_store_path = store_path + ".building"
+    if os.path.exists(temp_store_path):
+        shutil.rmtree(temp_store_path)
+    logger.info("Rechunking dataset into zarr store {}".format(store_path))
+    dataset.to_zarr(temp_store_path, mode="w", compute=False)
+    # The metadata pass leaves the dask variables unwritten, the ones without latitude (like time_bnds) are small
+    # and written whole
+    other_vars = [var for var in dataset.variables if lat_name not in dataset[var].dims]
+    dataset[other_vars].to_zarr(temp_store_path, mode="r+")
+    band_dataset = dataset.drop_vars(other_vars)
+    for start in range(0, dataset.sizes[lat_name], spatial_chunk_size):
+        band = slice(start, start + spatial_chunk_size)
+        band_dataset.isel({lat_name: band}).to_zarr(
+            temp_store_path, region={lat_name: band}
+        )
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(temp_store_path, store_path)
+    logger.info("Finished rechunking into zarr store {}".format(store_path))
+    return store_path
+
+
 def fix_lat_long_names_in_xarray_dataset(dataset: xr.Dataset) -> xr.Dataset:
     """
     This function fixes the lat/lon names in the dataset, written by ChatGPT
@@ -247,6 +536,7 @@ def convert_xarray_dataset_units(
 ) -> xr.Dataset:
     """
     Converts the units of the dataset to output_unit, mostly to mm/month or cubic meters/month,
+    calendar aware for per month outputs (see helpers.get_unit_conversion_plan)
     Parameters
     ----------
     dataset: xr.Dataset
@@ -266,12 +556,18 @@ def convert_xarray_dataset_units(
         )
     )
 
-    dataset = dataset.pint.quantify(
-        {"lat": None, "lon": None, "time": None}, unit_registry=ureg
-    )
+    dataset = dataset.copy()
+    time_name = "time" if "time" in dataset.coords else "valid_time"
     for var in variable:
-        if dataset[var].pint.units == ureg.parse_units(output_unit):
-            continue
-        dataset = dataset.pint.to({var: output_unit})
-    dataset = dataset.pint.dequantify()
+        conversion_factor, per_month = get_unit_conversion_plan(
+            dataset[var].attrs["units"], output_unit
+        )
+        attrs = dict(dataset[var].attrs, units=output_unit)
+        if per_month:
+            dataset[var] = dataset[var] * (
+                conversion_factor * dataset[time_name].dt.days_in_month
+            )
+        elif conversion_factor != 1:
+            dataset[var] = dataset[var] * conversion_factor
+        dataset[var].attrs = attrs
     return dataset
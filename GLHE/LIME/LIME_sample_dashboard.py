@@ -1,19 +1,15 @@
+import dash
 import dash_bootstrap_components as dbc
-import holoviews as hv
-import plotly.express as px
 from dash import Dash, html, dcc, Input, Output, State
+from dash.exceptions import PreventUpdate
 
 from flask import Flask
-from holoviews import opts
-from holoviews.plotting.plotly.dash import to_dash
 import os
 from pathlib import Path
 import json
-import GLHE.LIME.gridded_data_validation as gridded_data_validation
-import GLHE.LIME.lake_point_validation as lake_point_validation
-import GLHE.LIME.series_data_display as series_data_display
+import GLHE.LIME.lake_output_cache as lake_output_cache
+import GLHE.LIME.product_jobs as product_jobs
 import warnings
-import reverse_geocode
 import threading
 
 warnings.filterwarnings("ignore", category=FutureWarning)
@@ -21,10 +17,134 @@ warnings.filterwarnings("ignore", category=FutureWarning)
 app = Dash(
     __name__,
     external_stylesheets=[dbc.themes.FLATLY],
+    # The lake components of the multi-lake dashboard are made by its route callback, and the route components
+    # aren't in the single lake dashboard
+    suppress_callback_exceptions=True,
 )
 
 
+JOB_POLL_MILLISECONDS = 2000
+COMPONENT_LABELS = {
+    "p": "Precipitation (mm/month)",
+    "e": "Evaporation (mm/month)",
+    "i": "Inflow (m^3/month)",
+    "o": "Outflow (m^3/month)",
+}
+# Builds a component's chart from the series data store when its checklist changes, without the server
+COMPONENT_FIGURE_JS = """
+function(plotColumns, seriesData) {
+    const traces = (plotColumns || [])
+        .filter((col) => seriesData && col in seriesData)
+        .map((col) => ({
+            type: "scattergl",
+            mode: "lines",
+            name: col,
+            x: seriesData[col].x,
+            y: seriesData[col].y,
+        }));
+    return {
+        data: traces,
+        layout: {
+            xaxis: {title: {text: "Date"}},
+            yaxis: {title: {text: Y_LABEL}},
+            legend: {title: {text: "Dataset"}},
+            uirevision: "COMPONENT",
+        },
+    };
+}
+"""
+
+for component, label in COMPONENT_LABELS.items():
+    app.clientside_callback(
+        COMPONENT_FIGURE_JS.replace("Y_LABEL", json.dumps(label)).replace(
+            "COMPONENT", component
+        ),
+        Output(component + "_graph", "figure"),
+        Input(component + "_checklist", "value"),
+        State("series_data_store", "data"),
+    )
+
+
+# The lakes LIME has loaded, one in the single lake dashboard
+lake_outputs = lake_output_cache.LakeOutputCache()
+# Lake name -> output folder of the lakes this server serves, the lake keys sent by the browser must be one of them
+lake_folders = {}
+
+
+def check_lake_key(lake_key: str) -> None:
+    """Stops a callback asked about a folder this server doesn't serve"""
+    if lake_key not in lake_folders.values():
+        raise PreventUpdate
+
+
+def lake_layout(lake: lake_output_cache.LakeOutputs) -> list:
+    """
+    The rows of the dashboard of one lake, made from its outputs as they are now so a reloaded lake shows the
+    products merged in by a job
+    """
+    options_list = []
+    for key in lake.data_products.keys():
+        if not lake.data_products[key]["loaded"]:
+            options_list.append(key)
+    component_rows = [
+        dbc.Row(
+            [
+                dbc.Col(dcc.Graph(id=component + "_graph"), width=11),
+                dbc.Col(
+                    lake.series_data.generate_graph_checklist_by_component(component),
+                    width=1,
+                    align="center",
+                ),
+            ]
+        )
+        for component in COMPONENT_LABELS
+    ]
+    return [
+        dcc.Store(id="lake_key", data=lake.output_file_dir),
+        dbc.Row(
+            dbc.Col(
+                html.H1(
+                    "Lake "
+                    + lake.config["LAKE_NAME"].replace("_", " ")
+                    + ", "
+                    + lake.address[0]["country"],
+                    style={"textAlign": "center"},
+                )
+            )
+        ),
+        *component_rows,
+        dbc.Row([dbc.Col(lake.series_data.generate_series_data_table())]),
+        dbc.Row([dbc.Col(lake.series_data.generate_series_data_download())]),
+        # Sent once, the charts are drawn from it in the browser
+        dcc.Store(id="series_data_store", data=lake.columnar_series_data),
+        dbc.Row(
+            [
+                dbc.Col(
+                    lake.gridded_data.generate_points_figure(lake_output_cache.GRIDDED_KEYS)
+                ),
+                dbc.Col(lake.nwm_figure),
+            ]
+        ),
+        dbc.Row(
+            dbc.Col(
+                [
+                    html.P("Some Products are Slow! Load them here:"),
+                    dcc.Dropdown(options_list, id="demo-dropdown"),
+                    html.Button("Run Product", id="button"),
+                    html.Div(id="dd-output-container"),
+                    # Product jobs run in the background, their state is polled
+                    html.Div(id="product_jobs_status"),
+                    dcc.Interval(id="product_jobs_poll", interval=JOB_POLL_MILLISECONDS),
+                    dcc.Store(id="lake_loaded_at", data=lake.loaded_at),
+                    dcc.Location(id="lake_reload", refresh=True),
+                ]
+            )
+        ),
+    ]
+
+
 def prep_work(output_file_dir: str):
+    global lake_folders
     if output_file_dir is None:
         with open(
             os.path.join(Path(__file__).parent, "config", "config.json"), "r"
@@ -32,161 +152,135 @@ def prep_work(output_file_dir: str):
             config_pointer = json.load(f)
     else:
         config_pointer = {"CLAY_OUTPUT_FOLDER_LOCATION": output_file_dir}
-    with open(
-        os.path.join(config_pointer["CLAY_OUTPUT_FOLDER_LOCATION"], "config.json"), "r"
-    ) as f:
-        config = json.load(f)
-    with open(config["BLEEPBLEEP"], "r") as f:
-        data_products = json.load(f)
-    Series_Data_Obj = series_data_display.SeriesDataDisplay(config)
-    series_data_table = Series_Data_Obj.generate_series_data_table()
-    global series_data_df
-    series_data_df = Series_Data_Obj.get_df()
-    LakePointDisplay_Obj = lake_point_validation.LakePointDisplay(config)
-    NWM_fig = LakePointDisplay_Obj.generate_nwm_point_figure()
-    tiles = hv.element.tiles.CartoLight()
-    Gridded_Data_Obj = gridded_data_validation.GriddedDataDisplay(config)
-    if not LakePointDisplay_Obj.no_data:
-        address = reverse_geocode.search(LakePointDisplay_Obj.center_point)
-    else:
-        address = [{"country": "Unknown Country"}]
-    points = Gridded_Data_Obj.get_points("p.CRUTS")
-    overlay = tiles * points
-
-    try:
-        points2 = Gridded_Data_Obj.get_points("p.ERA5-Land")
-        overlay *= points2
-    except Exception as e:
-        print("No ERA5 Found. Exception:", e)
-    overlay.opts(title="Gridded Data Validation")
-    components = to_dash(app, [overlay])
-    options_list = []
-    for key in data_products.keys():
-        if not data_products[key]["loaded"]:
-            options_list.append(key)
+    lake_folders = {
+        Path(config_pointer["CLAY_OUTPUT_FOLDER_LOCATION"]).name: config_pointer[
+            "CLAY_OUTPUT_FOLDER_LOCATION"
+        ]
+    }
+    lake_outputs.get(config_pointer["CLAY_OUTPUT_FOLDER_LOCATION"])
+
+    def single_lake_layout():
+        # Made on every page load, so products merged in by a job show up when the page reloads
+        return html.Div(
+            lake_layout(lake_outputs.get(config_pointer["CLAY_OUTPUT_FOLDER_LOCATION"]))
+        )
+
+    app.layout = single_lake_layout
+
+
+def prep_multi_lake_work(lake_output_folder: str, max_lakes: int = None):
+    """
+    Serves every lake in lake_output_folder, each on its own route (/<lake name>). A lake is loaded on its
+    first request and kept in the lake_outputs LRU cache of max_lakes lakes.
+    """
+    global lake_outputs, lake_folders
+    lake_outputs = lake_output_cache.LakeOutputCache(
+        max_lakes or lake_output_cache.DEFAULT_MAX_LAKES
+    )
+    lake_folders = lake_output_cache.find_lake_output_folders(lake_output_folder)
     app.layout = html.Div(
         [
-            dbc.Row(
-                dbc.Col(
-                    html.H1(
-                        "Lake "
-                        + config["LAKE_NAME"].replace("_", " ")
-                        + ", "
-                        + address[0]["country"],
-                        style={"textAlign": "center"},
-                    )
-                )
-            ),
-            dbc.Row(
-                [
-                    dbc.Col(dcc.Graph(id="p_graph"), width=11),
-                    dbc.Col(
-                        Series_Data_Obj.generate_graph_checklist_by_component("p"),
-                        width=1,
-                        align="center",
-                    ),
-                ]
-            ),
-            dbc.Row(
+            dcc.Location(id="url", refresh=False),
+            dbc.Nav(
                 [
-                    dbc.Col(dcc.Graph(id="e_graph"), width=11),
-                    dbc.Col(
-                        Series_Data_Obj.generate_graph_checklist_by_component("e"),
-                        width=1,
-                        align="center",
-                    ),
-                ]
-            ),
-            dbc.Row(
-                [
-                    dbc.Col(dcc.Graph(id="i_graph"), width=11),
-                    dbc.Col(
-                        Series_Data_Obj.generate_graph_checklist_by_component("i"),
-                        width=1,
-                        align="center",
-                    ),
-                ]
-            ),
-            dbc.Row(
-                [
-                    dbc.Col(dcc.Graph(id="o_graph"), width=11),
-                    dbc.Col(
-                        Series_Data_Obj.generate_graph_checklist_by_component("o"),
-                        width=1,
-                        align="center",
-                    ),
-                ]
-            ),
-            dbc.Row([dbc.Col(series_data_table)]),
-            dbc.Row([dbc.Col(components.children), dbc.Col(NWM_fig)]),
-            dbc.Row(
-                dbc.Col(
-                    [
-                        html.P("Some Products are Slow! Load them here:"),
-                        dcc.Dropdown(options_list, id="demo-dropdown"),
-                        html.Button("Run Product", id="button"),
-                        html.Div(id="dd-output-container"),
-                    ]
-                )
+                    dbc.NavLink(
+                        lake_name.replace("_", " "),
+                        href="/" + lake_name,
+                        active="exact",
+                    )
+                    for lake_name in lake_folders
+                ],
+                pills=True,
             ),
+            html.Div(id="lake_content"),
         ]
     )
 
 
-@app.callback(Output("p_graph", "figure"), Input("p_checklist", "value"))
-def update_line_chart(plot_columns):
-    y_cols = plot_columns
-    fig = px.line(
-        series_data_df,
-        x="Date",
-        y=y_cols,
-        labels={
-            "Date": "Date",
-            "value": "Precipitation (mm/month)",
-            "variable": "Dataset",
-        },
-    )
-    return fig
-
-
-@app.callback(Output("e_graph", "figure"), Input("e_checklist", "value"))
-def update_line_chart(plot_columns):
-    y_cols = plot_columns
-    fig = px.line(
-        series_data_df,
-        x="Date",
-        y=y_cols,
-        labels={
-            "Date": "Date",
-            "value": "Evaporation (mm/month)",
-            "variable": "Dataset",
-        },
-    )
-    return fig
+@app.callback(Output("lake_content", "children"), Input("url", "pathname"))
+def display_lake(pathname):
+    """
+    The dashboard of the lake of the route, loaded from lake_outputs
+    """
+    lake_name = (pathname or "/").strip("/")
+    if lake_name not in lake_folders:
+        return html.P("Pick a lake above.")
+    return lake_layout(lake_outputs.get(lake_folders[lake_name]))
 
 
-@app.callback(Output("i_graph", "figure"), Input("i_checklist", "value"))
-def update_line_chart(plot_columns):
-    y_cols = plot_columns
-    fig = px.line(
-        series_data_df,
-        x="Date",
-        y=y_cols,
-        labels={"Date": "Date", "value": "Inflow (m^3/month)", "variable": "Dataset"},
+@app.callback(
+    Output("series_data_table", "data"),
+    Input("series_data_table", "page_current"),
+    Input("series_data_table", "page_size"),
+    Input("series_data_table", "sort_by"),
+    State("lake_key", "data"),
+)
+def update_series_data_table(page_current, page_size, sort_by, lake_key):
+    check_lake_key(lake_key)
+    return lake_outputs.get(lake_key).series_data.get_series_data_page(
+        page_current, page_size, sort_by
     )
-    return fig
 
 
-@app.callback(Output("o_graph", "figure"), Input("o_checklist", "value"))
-def update_line_chart(plot_columns):
-    y_cols = plot_columns
-    fig = px.line(
-        series_data_df,
-        x="Date",
-        y=y_cols,
-        labels={"Date": "Date", "value": "Outflow (m^3/month)", "variable": "Dataset"},
+@app.callback(
+    Output("series_data_download", "data"),
+    Input("series_data_download_button", "n_clicks"),
+    State("lake_key", "data"),
+    prevent_initial_call=True,
+)
+def download_series_data(n_clicks, lake_key):
+    check_lake_key(lake_key)
+    lake = lake_outputs.get(lake_key)
+    return lake.series_data.get_series_data_download(
+        lake.config["LAKE_NAME"] + "_series_data.csv"
     )
-    return fig
+
+
+@app.callback(
+    Output("dd-output-container", "children"),
+    Input("button", "n_clicks"),
+    State("demo-dropdown", "value"),
+    State("lake_key", "data"),
+    prevent_initial_call=True,
+)
+def run_product(n_clicks, product, lake_key):
+    """Queues the product as a background job, the button returns right away"""
+    if product is None:
+        return "Pick a product to run."
+    check_lake_key(lake_key)
+    lake = lake_outputs.get(lake_key)
+    if "HYLAK_ID" not in lake.config:
+        return "This lake's outputs are too old to add products to, run CLAY on it again."
+    product_jobs.submit_product_job(lake_key, lake.config["HYLAK_ID"], product)
+    return "Running {} in the background.".format(product)
+
+
+@app.callback(
+    Output("product_jobs_status", "children"),
+    Output("lake_reload", "href"),
+    Input("product_jobs_poll", "n_intervals"),
+    State("lake_key", "data"),
+    State("lake_loaded_at", "data"),
+    State("lake_reload", "pathname"),
+)
+def poll_product_jobs(n_intervals, lake_key, lake_loaded_at, pathname):
+    """Shows the lake's jobs, and reloads the page with the outputs of jobs that finished after the lake was loaded"""
+    check_lake_key(lake_key)
+    jobs = product_jobs.list_jobs(lake_key)
+    status = [
+        html.P("{}: {}".format(job["product"], job["status"]))
+        for job in jobs
+        if job["status"] != "finished" or job["finished"] > lake_loaded_at
+    ]
+    newly_finished = [
+        job["finished"]
+        for job in jobs
+        if job["status"] == "finished" and job["finished"] > lake_loaded_at
+    ]
+    if not newly_finished:
+        return status, dash.no_update
+    lake_outputs.invalidate(lake_key, older_than=max(newly_finished))
+    return status, pathname
 
 
 def LIME_driver(output_file_dir: str):
@@ -194,5 +288,10 @@ def LIME_driver(output_file_dir: str):
     app.run()
 
 
+def LIME_multi_lake_driver(lake_output_folder: str, max_lakes: int = None):
+    prep_multi_lake_work(lake_output_folder, max_lakes)
+    app.run(threaded=True)
+
+
 if __name__ == "__main__":
     driver()
@@ -1,9 +1,22 @@
-import plotly.express as px
-import os
-from pathlib import Path
+import importlib
 
-px.set_mapbox_access_token(
-    open(os.path.join(Path(__file__).parent, "LocalData", ".mapbox_token")).read()
-)
+# The submodules are imported when they are first used (PEP 562), dash, holoviews & plotly are slow to import
+__all__ = [
+    "LIME_sample_dashboard",
+    "data_check_LIME",
+    "gridded_data_validation",
+    "lake_output_cache",
+    "lake_point_validation",
+    "product_jobs",
+    "series_data_display",
+]
 
-from . import LIME_sample_dashboard
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,11 +1,19 @@
 import os
+import logging
 import zipfile
 import json
+from functools import lru_cache
 import holoviews as hv
-from raster2xyz.raster2xyz import Raster2xyz
+import plotly.graph_objects as go
+from dash import dcc
+import numpy as np
 import pandas as pd
+import rasterio
+import rasterio.io
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 
 def check_or_create_directory(dir: str) -> None:
     if not os.path.exists(dir):
@@ -13,34 +21,90 @@ def check_or_create_directory(dir: str) -> None:
     return
 
 
+def read_points_frame(zip_path: str, zip_modified_time: float, filename: str, date: str = None) -> pd.DataFrame:
+    """
+    Reads a GeoTIFF in the zip straight into NumPy and returns a frame of its cell centers (x, y, z, easting,
+    northing), without cells that have no data. Memoized, zip_modified_time is part of the key so a zip
+    rewritten by CLAY is read again. Each call gets its own copy, the memoized frame is shared.
+    date picks the band of a time stack described by the nearest date, the first band if None.
+    """
+    return cached_points_frame(zip_path, zip_modified_time, filename, date).copy()
+
+
+@lru_cache(maxsize=32)
+def cached_points_frame(zip_path: str, zip_modified_time: float, filename: str, date: str = None) -> pd.DataFrame:
+    """The memoized frame of read_points_frame, shared by every caller so it must not be changed"""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        tif = zip_ref.read(filename)
+    with rasterio.io.MemoryFile(tif) as memory_file, memory_file.open() as src:
+        band = 1
+        if date is not None and all(src.descriptions):
+            band_dates = pd.DatetimeIndex(src.descriptions)
+            band = int(band_dates.get_indexer([pd.Timestamp(date)], method="nearest")[0]) + 1
+        z = src.read(band, masked=True)
+        has_data = ~np.ma.getmaskarray(z)
+        if np.issubdtype(z.dtype, np.floating):
+            has_data &= ~np.isnan(z.data)
+        rows, cols = np.nonzero(has_data)
+        x, y = rasterio.transform.xy(src.transform, rows, cols, offset="center")
+    grid_df = pd.DataFrame({"x": np.asarray(x), "y": np.asarray(y), "z": z.data[rows, cols]})
+    grid_df["easting"], grid_df["northing"] = hv.Tiles.lon_lat_to_easting_northing(
+        grid_df["x"].values, grid_df["y"].values
+    )
+    return grid_df
+
+
 class GriddedDataDisplay:
     config: dict
     tif_file_paths = {}
-    dest_dir = os.path.join(".temp", "tifs")
 
     def __init__(self, config: dict):
         """Initializes the data access class"""
-        check_or_create_directory(".temp")
-        check_or_create_directory(".temp/tifs")
-        with zipfile.ZipFile(os.path.join(config["GRIDDED_DATA_FOLDER"]),
-                             'r') as zip_ref:
+        self.zip_path = os.path.join(config["GRIDDED_DATA_FOLDER"])
+        self.tif_file_paths = {}
+        with zipfile.ZipFile(self.zip_path, 'r') as zip_ref:
             for filename in zip_ref.namelist():
                 split_list = filename.split("_")
                 metadata = {"var": split_list[0], "product": split_list[1], "date": split_list[-1].split(".")[0]}
+                self.tif_file_paths[metadata["var"] + "." + metadata["product"]] = filename
 
-                file_path = os.path.join(self.dest_dir)
-                zip_ref.extract(filename, file_path)
-                self.tif_file_paths[metadata["var"] + "." + metadata["product"]] = os.path.join(file_path, filename)
-
-    def get_points(self, key: str) -> hv.Points:
-        input_raster = self.tif_file_paths[key]
-        out_csv = os.path.join(self.dest_dir, self.tif_file_paths[key].split("\\")[-1].split(".")[0] + ".csv")
-        if not os.path.exists(out_csv):
-            rtxyz = Raster2xyz()
-            rtxyz.translate(input_raster, out_csv)
-        grid_df = pd.read_csv(out_csv)
-        grid_df["easting"], grid_df["northing"] = hv.Tiles.lon_lat_to_easting_northing(
-            grid_df["x"], grid_df["y"]
+    def get_points_frame(self, key: str, date: str = None) -> pd.DataFrame:
+        return read_points_frame(
+            self.zip_path, os.path.getmtime(self.zip_path), self.tif_file_paths[key], date
         )
+
+    def get_available_points_frames(self, keys: list) -> dict:
+        """
+        Key -> points frame of the products in keys that are in the zip. A layer that can't be read, like one a
+        job is rewriting, is logged and left out
+        """
+        frames = {}
+        for key in keys:
+            if key not in self.tif_file_paths:
+                continue
+            try:
+                frames[key] = self.get_points_frame(key)
+            except (KeyError, FileNotFoundError) as e:
+                logger.warning("No {} layer in {}: {}".format(key, self.zip_path, e))
+        return frames
+
+    def get_points(self, key: str, date: str = None) -> hv.Points:
+        grid_df = self.get_points_frame(key, date)
         points = hv.Points(grid_df, ["easting", "northing"], 'z')
         return points
+
+    def generate_points_figure(self, keys: list) -> dcc.Graph:
+        """
+        A plotly map of the cells of the products in keys that are in the zip, made on every page load so it shows
+        the layers of products a job added
+        """
+        fig = go.Figure()
+        for key, grid_df in self.get_available_points_frames(keys).items():
+            fig.add_trace(go.Scattermapbox(lat=grid_df["y"], lon=grid_df["x"], mode="markers", name=key,
+                                           marker=dict(color=grid_df["z"], size=10),
+                                           text=grid_df["z"]))
+        fig.update_layout(title="Gridded Data Validation", mapbox_style="open-street-map",
+                          mapbox_zoom=6,
+                          mapbox_center=dict(lat=float(grid_df["y"].mean()), lon=float(grid_df["x"].mean()))
+                          if len(fig.data) else None)
+        return dcc.Graph(id="gridded_points_graph", figure=fig)
@@ -0,0 +1,112 @@
+import os
+import json
+import threading
+import time
+from collections import OrderedDict
+import reverse_geocode
+import GLHE.LIME.gridded_data_validation as gridded_data_validation
+import GLHE.LIME.lake_point_validation as lake_point_validation
+import GLHE.LIME.series_data_display as series_data_display
+
+# How many lakes a multi-lake LIME server keeps loaded
+DEFAULT_MAX_LAKES = 8
+# WebGL draws long lines quickly, they are only downsampled to keep the data sent to the browser small
+MAX_POINTS_PER_LINE = 20000
+GRIDDED_KEYS = ["p.CRUTS", "p.ERA5-Land"]
+
+
+def read_lake_config(output_file_dir: str) -> dict:
+    """
+    Reads the CONFIG.json CLAY wrote in a lake's output folder
+    """
+    for name in ["config.json", "CONFIG.json"]:
+        if os.path.exists(os.path.join(output_file_dir, name)):
+            with open(os.path.join(output_file_dir, name), "r") as f:
+                return json.load(f)
+    raise FileNotFoundError("No CLAY config.json in {}".format(output_file_dir))
+
+
+def find_lake_output_folders(lake_output_folder: str) -> dict:
+    """
+    Lake name -> output folder of every CLAY output in lake_output_folder
+    """
+    lakes = {}
+    for name in sorted(os.listdir(lake_output_folder)):
+        folder = os.path.join(lake_output_folder, name)
+        if os.path.isdir(folder) and any(
+            os.path.exists(os.path.join(folder, config_name))
+            for config_name in ["config.json", "CONFIG.json"]
+        ):
+            lakes[name] = folder
+    return lakes
+
+
+class LakeOutputs:
+    """
+    Everything LIME shows of one CLAY output folder, parsed once: the config, data products, series data (and
+    its columnar form for the charts), gridded points and NWM point
+    """
+    config: dict
+    data_products: dict
+
+    def __init__(self, output_file_dir: str):
+        self.output_file_dir = output_file_dir
+        self.loaded_at = time.time()
+        self.config = read_lake_config(output_file_dir)
+        with open(self.config["BLEEPBLEEP"], "r") as f:
+            self.data_products = json.load(f)
+        self.series_data = series_data_display.SeriesDataDisplay(self.config)
+        self.columnar_series_data = self.series_data.get_columnar_series_data(MAX_POINTS_PER_LINE)
+        self.gridded_data = gridded_data_validation.GriddedDataDisplay(self.config)
+        self.gridded_data.get_available_points_frames(GRIDDED_KEYS)
+        self.lake_points = lake_point_validation.LakePointDisplay(self.config)
+        self.nwm_figure = self.lake_points.generate_nwm_point_figure()
+        if not self.lake_points.no_data:
+            self.address = reverse_geocode.search(self.lake_points.center_point)
+        else:
+            self.address = [{"country": "Unknown Country"}]
+
+
+class LakeOutputCache:
+    """
+    A bounded LRU cache of LakeOutputs by output folder, safe to use from the threads of a Dash server.
+    A lake is loaded on its first request, by one thread while the others asking for it wait, and the least
+    recently used lake is dropped when there are more than max_lakes.
+    Each server process has its own cache.
+    """
+
+    def __init__(self, max_lakes: int = DEFAULT_MAX_LAKES):
+        self.max_lakes = max_lakes
+        self.lakes = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading_locks = {}
+
+    def get(self, output_file_dir: str) -> LakeOutputs:
+        with self.lock:
+            if output_file_dir in self.lakes:
+                self.lakes.move_to_end(output_file_dir)
+                return self.lakes[output_file_dir]
+            loading_lock = self.loading_locks.setdefault(output_file_dir, threading.Lock())
+        with loading_lock:
+            with self.lock:
+                if output_file_dir in self.lakes:
+                    self.lakes.move_to_end(output_file_dir)
+                    return self.lakes[output_file_dir]
+            lake = LakeOutputs(output_file_dir)
+            with self.lock:
+                self.lakes[output_file_dir] = lake
+                while len(self.lakes) > self.max_lakes:
+                    self.lakes.popitem(last=False)
+                self.loading_locks.pop(output_file_dir, None)
+            return lake
+
+    def invalidate(self, output_file_dir: str, older_than: float = None) -> None:
+        """Drops a lake, so it's loaded again on its next request. Only if it was loaded before older_than if given"""
+        with self.lock:
+            lake = self.lakes.get(output_file_dir)
+            if lake is not None and (older_than is None or lake.loaded_at < older_than):
+                del self.lakes[output_file_dir]
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.lakes)
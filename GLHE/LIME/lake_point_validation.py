@@ -5,6 +5,11 @@ import json
 from dash import dcc
 from pathlib import Path
 
+# Set here instead of in GLHE.LIME, so only the map pays for reading the token
+px.set_mapbox_access_token(
+    open(os.path.join(Path(__file__).parent, "LocalData", ".mapbox_token")).read()
+)
+
 
 class LakePointDisplay:
     nwm_point_df: gpd.GeoDataFrame
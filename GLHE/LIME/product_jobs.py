@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import psutil
+
+# One job at a time, jobs of a lake rewrite the same output files
+PRODUCT_JOB_WORKERS = 1
+JOB_FOLDER_NAME = "product_jobs"
+
+executor = None
+executor_lock = threading.Lock()
+# job_id -> Future of the jobs submitted by this process
+submitted_jobs = {}
+
+
+def job_path(output_file_dir: str, job_id: str) -> str:
+    return os.path.join(output_file_dir, JOB_FOLDER_NAME, job_id + ".json")
+
+
+def write_job(job: dict) -> None:
+    """
+    Writes the state of a job next to the lake's outputs, replacing the file so readers never see half of it
+    """
+    path = job_path(job["output_file_dir"], job["job_id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(job, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def read_job(output_file_dir: str, job_id: str) -> dict:
+    with open(job_path(output_file_dir, job_id), "r") as f:
+        return json.load(f)
+
+
+def update_job(output_file_dir: str, job_id: str, **changes) -> dict:
+    job = read_job(output_file_dir, job_id)
+    job.update(changes)
+    write_job(job)
+    return job
+
+
+def list_jobs(output_file_dir: str) -> list[dict]:
+    """
+    The jobs of a lake, oldest first. Jobs that were queued when the server that submitted them stopped, or
+    running when their worker stopped, are reported as interrupted.
+    """
+    folder = os.path.join(output_file_dir, JOB_FOLDER_NAME)
+    if not os.path.exists(folder):
+        return []
+    jobs = []
+    for filename in os.listdir(folder):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(folder, filename), "r") as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if job["job_id"] not in submitted_jobs and (
+            (job["status"] == "queued" and not psutil.pid_exists(job["server_pid"]))
+            or (job["status"] == "running" and not psutil.pid_exists(job["pid"]))
+        ):
+            job["status"] = "interrupted"
+        jobs.append(job)
+    return sorted(jobs, key=lambda job: job["submitted"])
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """The process pool of the jobs, started on the first job. Spawned, so the workers don't share the server's
+    threads"""
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ProcessPoolExecutor(
+                max_workers=PRODUCT_JOB_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return executor
+
+
+def run_product_job(output_file_dir: str, job_id: str) -> None:
+    """
+    Runs in a worker process: sets the driver up from the lake's outputs and runs the product of the job,
+    adding its outputs to the lake's outputs
+    """
+    import GLHE.CLAY.globals
+    from GLHE.CLAY import CLAY_driver, lake_extraction
+
+    job = update_job(
+        output_file_dir, job_id, status="running", started=time.time(), pid=os.getpid()
+    )
+    try:
+        # Outputs go back into the folder LIME is showing
+        GLHE.CLAY.globals.config["DIRECTORIES"]["LAKE_OUTPUT_FOLDER"] = os.path.dirname(
+            os.path.abspath(output_file_dir)
+        )
+        driver = CLAY_driver.CLAY_driver()
+        driver.set_up_logging()
+        driver.restore_lake(job["hylak_id"], lake_extraction.LakeExtraction())
+        driver.run_product(job["product"], incremental=True)
+        if not driver.data_products[job["product"]]["loaded"]:
+            raise RuntimeError(
+                "Data Product: {} not available for this lake".format(job["product"])
+            )
+        update_job(output_file_dir, job_id, status="finished", finished=time.time())
+    except Exception:
+        update_job(
+            output_file_dir,
+            job_id,
+            status="failed",
+            finished=time.time(),
+            error=traceback.format_exc(),
+        )
+
+
+def submit_product_job(output_file_dir: str, hylak_id: int, product: str) -> dict:
+    """
+    Queues a product run for a lake on the job process pool and returns the job, its state is kept in
+    <output_file_dir>/product_jobs/<job_id>.json
+    """
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "output_file_dir": output_file_dir,
+        "hylak_id": hylak_id,
+        "product": product,
+        "status": "queued",
+        "submitted": time.time(),
+        "started": None,
+        "finished": None,
+        "server_pid": os.getpid(),
+        "pid": None,
+        "error": None,
+    }
+    write_job(job)
+    future = get_executor().submit(run_product_job, output_file_dir, job["job_id"])
+    submitted_jobs[job["job_id"]] = future
+
+    def job_done(done_future):
+        # The worker records its own failures, this catches the ones that kill it
+        if done_future.exception() is not None:
+            update_job(
+                output_file_dir,
+                job["job_id"],
+                status="failed",
+                finished=time.time(),
+                error=repr(done_future.exception()),
+            )
+
+    future.add_done_callback(job_done)
+    return job
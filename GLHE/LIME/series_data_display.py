@@ -1,28 +1,129 @@
+import math
+import numpy as np
 import pandas as pd
 import os
 import json
-from dash import dash_table, dcc
+from dash import dash_table, dcc, html
 import dash_bootstrap_components as dbc
 from pathlib import Path
 
 
+def read_series_data(file_path: str, columns: list = None) -> pd.DataFrame:
+    """
+    Reads the series data CLAY wrote as parquet, arrow or csv, with only the time and the given columns.
+    All columns if columns is None.
+    """
+    extension = os.path.splitext(file_path)[1]
+    if columns is not None:
+        columns = ['time'] + [col for col in columns if col != 'time']
+    if extension == '.parquet':
+        # The time index is stored in the parquet metadata, so it isn't part of the projection
+        df = pd.read_parquet(file_path, columns=None if columns is None else columns[1:])
+        return df.reset_index()
+    if extension == '.arrow':
+        return pd.read_feather(file_path, columns=columns)
+    return pd.read_csv(file_path, usecols=columns, parse_dates=['time'])
+
+
+def downsample_lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: the indices of n_out points that keep the shape of the line through x, y.
+    The first and last points are always kept, every index if there are n_out points or fewer.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # n - 2 points split into n_out - 2 buckets, the first and last points are their own buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # The average of the next bucket is the third point of the triangle
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        indices[bucket + 1] = previous
+    return indices
+
+
 class SeriesDataDisplay:
     df: pd.DataFrame
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, columns: list = None):
 
-        self.df = pd.read_csv(config["SERIES_DATA"])
+        self.df = read_series_data(config["SERIES_DATA"], columns)
         self.df = self.df.rename(columns={'time': 'Date'})
 
-    def generate_series_data_table(self) -> dash_table.DataTable:
+    def generate_series_data_table(self, page_size: int = 10) -> dash_table.DataTable:
         """
         Given a config file, the function returns a DASH Data table.
+        The table is paged and sorted on the server, only the first page is sent here, the rest is sent by
+        get_series_data_page from a callback on page_current, page_size & sort_by. The table only has a page,
+        so the whole series data is downloaded with get_series_data_download instead of the table's export.
         """
-        table = dash_table.DataTable(data=self.df.to_dict('records'),
-                                     export_format='xlsx',
-                                     export_headers='display', page_size=10)
+        table = dash_table.DataTable(id="series_data_table",
+                                     columns=[{'name': col, 'id': col} for col in self.df.columns],
+                                     data=self.get_series_data_page(0, page_size, []),
+                                     page_current=0,
+                                     page_size=page_size,
+                                     page_count=max(1, math.ceil(len(self.df) / page_size)),
+                                     page_action='custom',
+                                     sort_action='custom',
+                                     sort_mode='single',
+                                     sort_by=[])
         return table
 
+    def generate_series_data_download(self) -> html.Div:
+        """
+        The button downloading all the series data, and the Download it's sent to
+        """
+        return html.Div([dbc.Button("Download Series Data", id="series_data_download_button"),
+                         dcc.Download(id="series_data_download")])
+
+    def get_series_data_download(self, filename: str) -> dict:
+        """
+        All the series data as a csv for the dcc.Download of generate_series_data_download
+        """
+        return dcc.send_data_frame(self.df.to_csv, filename, index=False)
+
+    def get_series_data_page(self, page_current: int, page_size: int, sort_by: list) -> list[dict]:
+        """
+        The records of one page of the table, sorted by the DataTable's sort_by
+        """
+        df = self.df
+        if sort_by:
+            df = df.sort_values(sort_by[0]['column_id'],
+                                ascending=sort_by[0]['direction'] == 'asc',
+                                na_position='last')
+        page = df.iloc[page_current * page_size:(page_current + 1) * page_size]
+        return page.to_dict('records')
+
+    def get_columnar_series_data(self, max_points_per_line: int) -> dict:
+        """
+        The series data in a compact columnar form for the browser, {column: {'x': dates, 'y': values}}.
+        Each column drops its missing values and is downsampled to at most max_points_per_line with LTTB.
+        """
+        columnar = {}
+        for col in self.df.columns:
+            if col == 'Date':
+                continue
+            series = self.df[['Date', col]].dropna()
+            dates = pd.to_datetime(series['Date'])
+            keep = downsample_lttb(dates.to_numpy().astype('int64'), series[col].to_numpy(), max_points_per_line)
+            columnar[col] = {'x': dates.iloc[keep].dt.strftime('%Y-%m-%d').tolist(),
+                             'y': series[col].iloc[keep].tolist()}
+        return columnar
+
     def get_df(self) -> pd.DataFrame:
         """
         Simple getter for the df
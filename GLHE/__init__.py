@@ -1,3 +1,15 @@
-from . import CLAY
-from . import CALCITE
-from . import LIME
+import importlib
+
+# The subpackages are imported when they are first used (PEP 562), so a batch worker that only needs CLAY
+# doesn't import LIME's dash & plotly
+__all__ = ["CALCITE", "CLAY", "LIME"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,5 +1,22 @@
-from GLHE.CLAY.data_access import ERA5_Land, NWM, CRUTS, data_check
+from GLHE.CLAY.data_access import (
+    ERA5_Land,
+    NWM,
+    NWM_mirror,
+    CRUTS,
+    data_check,
+    downloader,
+)
+import hashlib
+import io
+import json
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
 import pytest
+import xarray as xr
 import shapely.geometry
 import GLHE.CLAY.lake_extraction as lake_extraction
 import GLHE
@@ -81,3 +98,298 @@ class TestNWM:
         nwm = NWM.NWM()
         nwm_data = nwm.product_driver(self.lake_polygon, debug=False, run_cleanly=False)
         assert nwm_data != None
+
+
+def test_NWM_lake_index(tmp_path):
+    lakeout_file_name = os.path.join(tmp_path, "LAKEOUT.nc")
+    xr.Dataset(
+        {
+            "latitude": ("feature_id", np.array([38.0, 41.0, 35.0])),
+            "longitude": ("feature_id", np.array([-119.0, -112.5, -100.0])),
+        },
+        coords={"feature_id": [10, 20, 30]},
+    ).to_netcdf(lakeout_file_name)
+    lake_index = NWM.NWMLakeIndex(
+        lakeout_file_name, os.path.join(tmp_path, "index.pickle")
+    )
+    dist, feature_index = lake_index.query(-112.4, 41.1)
+    assert feature_index == 1
+    assert lake_index.feature_is_in_lake(
+        shapely.geometry.box(-113, 40, -112, 42), dist, feature_index
+    )
+    distances, feature_indices = lake_index.query_many(
+        np.array([-119.01, -100.0]), np.array([38.0, 35.5])
+    )
+    assert list(feature_indices) == [0, 2]
+
+
+def test_NWM_hylak_feature_table_concurrent_updates(tmp_path):
+    lakeout_file_name = os.path.join(tmp_path, "LAKEOUT.nc")
+    with open(lakeout_file_name, "w") as f:
+        f.write("lakeout")
+    table_file_name = os.path.join(tmp_path, "table.json")
+    with open(table_file_name, "w") as f:
+        f.write('{"source_stamp": ')
+    # A half written table is ignored instead of crashing the lake
+    assert NWM.load_hylak_feature_table(table_file_name, lakeout_file_name) == {}
+
+    def update(hylak_id):
+        NWM.update_hylak_feature_table(
+            {str(hylak_id): None}, table_file_name, lakeout_file_name
+        )
+
+    threads = [threading.Thread(target=update, args=(hylak_id,)) for hylak_id in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    table = NWM.load_hylak_feature_table(table_file_name, lakeout_file_name)
+    assert sorted(table, key=int) == [str(hylak_id) for hylak_id in range(16)]
+    # No lock or temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == ["LAKEOUT.nc", "table.json"]
+
+
+def test_NWM_mirror(tmp_path, monkeypatch):
+    lakeout_store = os.path.join(tmp_path, "lakeout.zarr")
+    mirror_store = os.path.join(tmp_path, "mirror.zarr")
+    time = pd.date_range("1979-02-01", periods=480, freq="h")
+    flow = np.random.rand(len(time), 3)
+    xr.Dataset(
+        {
+            "inflow": (("time", "feature_id"), flow),
+            "outflow": (("time", "feature_id"), flow / 2),
+            "water_sfc_elev": (("time", "feature_id"), flow),
+            "crs": ((), 0),
+        },
+        coords={
+            "time": time,
+            "feature_id": [10, 20, 30],
+            "latitude": ("feature_id", np.array([38.0, 41.0, 35.0])),
+            "longitude": ("feature_id", np.array([-119.0, -112.5, -100.0])),
+        },
+        attrs={"proj4": "+proj=longlat +datum=WGS84 +no_defs"},
+    ).chunk({"time": 48, "feature_id": 3}).to_zarr(lakeout_store)
+
+    assert NWM_mirror.sync_nwm_mirror([20, 10], lakeout_store, mirror_store) == [
+        20,
+        10,
+    ]
+    assert NWM_mirror.sync_nwm_mirror([30, 10], lakeout_store, mirror_store) == [30]
+    assert NWM_mirror.sync_nwm_mirror([30], lakeout_store, mirror_store) == []
+    with xr.open_zarr(mirror_store) as mirror:
+        assert list(mirror.feature_id.values) == [20, 10, 30]
+        assert mirror.inflow.encoding["chunks"] == (len(time), 1)
+
+    monkeypatch.setattr(NWM_mirror, "NWM_MIRROR_STORE", mirror_store)
+    nwm = NWM.NWM()
+    dataset = nwm.zarr_lakeout_process([30])
+    assert nwm.lakeout_dataset is None
+    assert np.allclose(dataset.inflow.values[:, 0], flow[:, 2])
+    assert dataset.latitude.values[0] == 35.0
+
+    batched = nwm.process_lakeout_features([10, 30])
+    assert list(batched.feature_id.values) == [10, 30]
+    single = nwm.process_lakeout_features([30]).isel(feature_id=0)
+    assert np.allclose(
+        batched.sel(feature_id=30).inflow.values, single.inflow.values
+    )
+    assert batched.inflow.attrs["units"] == "m3/month"
+
+
+class FileServer(BaseHTTPRequestHandler):
+    """Serves FileServer.files, with range requests unless the path starts with /stream/, and the ETags of
+    FileServer.etags"""
+
+    files = {}
+    etags = {}
+    requested_ranges = []
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        data = self.files.get(self.path.split("/")[-1])
+        if data is None:
+            self.send_error(404)
+            return
+        takes_ranges = not self.path.startswith("/stream/")
+        range_header = self.headers.get("Range")
+        if takes_ranges and range_header is not None:
+            start, end = (int(x) for x in range_header[6:].split("-"))
+            self.requested_ranges.append(start)
+            body = data[start : end + 1]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(data))
+            )
+        else:
+            body = data
+            self.send_response(200)
+        if takes_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(len(body)))
+        if self.path.split("/")[-1] in self.etags:
+            self.send_header("ETag", self.etags[self.path.split("/")[-1]])
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def file_server():
+    FileServer.files = {}
+    FileServer.etags = {}
+    FileServer.requested_ranges = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FileServer)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+
+
+def test_download_in_parallel_and_resume(file_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "DOWNLOAD_SEGMENT_BYTES", 1000)
+    data = os.urandom(10500)
+    FileServer.files["data.nc"] = data
+    filepath = os.path.join(tmp_path, "data.nc")
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    # A download that stopped after the first 3 segments
+    with open(filepath + ".part", "wb") as f:
+        f.write(data[:3000] + bytes(len(data) - 3000))
+    with open(filepath + ".part.json", "w") as f:
+        f.write('{"size": 10500, "done": [0, 1000, 2000]}')
+    stats = downloader.download_file(
+        file_server + "/data.nc", filepath, len(data), sha256
+    )
+    assert sorted(FileServer.requested_ranges) == list(range(3000, 10500, 1000))
+    assert stats["bytes"] == len(data) - 3000
+    with open(filepath, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(filepath + ".part")
+
+    with pytest.raises(ValueError):
+        downloader.download_file(
+            file_server + "/data.nc", filepath + "2", len(data), "0" * 64
+        )
+    assert not os.path.exists(filepath + "2")
+
+
+def test_download_restarts_when_file_changed(file_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "DOWNLOAD_SEGMENT_BYTES", 1000)
+    data = os.urandom(5000)
+    FileServer.files["data.nc"] = data
+    FileServer.etags["data.nc"] = '"v2"'
+    filepath = os.path.join(tmp_path, "data.nc")
+
+    # Segments of the version of the file before
+    with open(filepath + ".part", "wb") as f:
+        f.write(bytes(len(data)))
+    with open(filepath + ".part.json", "w") as f:
+        json.dump({"size": 5000, "etag": '"v1"', "done": [0, 1000]}, f)
+    downloader.download_file(file_server + "/data.nc", filepath, len(data))
+    assert sorted(FileServer.requested_ranges) == list(range(0, 5000, 1000))
+    with open(filepath, "rb") as f:
+        assert f.read() == data
+
+
+def test_failed_stream_is_cleaned_up(file_server, tmp_path, monkeypatch):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("lakes/lakes.shp", b"lake" * 5000, zipfile.ZIP_DEFLATED)
+    FileServer.files["lakes.zip"] = archive.getvalue()
+    folder = os.path.join(tmp_path, "lakes_shp")
+
+    def add(self, num_bytes):
+        raise ConnectionError("Connection dropped")
+
+    monkeypatch.setattr(downloader.DownloadProgress, "add", add)
+    with pytest.raises(ConnectionError):
+        downloader.download_file(
+            file_server + "/stream/lakes.zip", folder + ".zip", extract_to=folder
+        )
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_extracts_zip_while_streaming(file_server, tmp_path):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("lakes/lakes.dbf", os.urandom(5000), zipfile.ZIP_STORED)
+        zip_file.writestr("lakes/lakes.shp", b"lake" * 5000, zipfile.ZIP_DEFLATED)
+    FileServer.files["lakes.zip"] = archive.getvalue()
+    folder = os.path.join(tmp_path, "lakes_shp")
+
+    extractor = downloader.ZipStreamExtractor(folder + "_check")
+    for start in range(0, len(archive.getvalue()), 100):
+        extractor.feed(archive.getvalue()[start : start + 100])
+    assert extractor.supported and extractor.complete
+    extractor.discard()
+
+    downloader.download_file(
+        file_server + "/stream/lakes.zip", folder + ".zip", extract_to=folder
+    )
+    with open(os.path.join(folder, "lakes", "lakes.shp"), "rb") as f:
+        assert f.read() == b"lake" * 5000
+    assert not os.path.exists(folder + ".zip")
+    assert not os.path.exists(folder + ".extracting")
+
+
+def test_local_data_manifest(tmp_path, monkeypatch):
+    data = os.urandom(2000)
+    input_data_config = os.path.join(tmp_path, "input_data.json")
+    with open(input_data_config, "w") as f:
+        json.dump(
+            {
+                "data_products": [
+                    {
+                        "name": "Test",
+                        "access_code": "local",
+                        "local_remote_storage_filename": "test.nc",
+                        "dropbox_download_link": "",
+                        "size_bytes": len(data),
+                        "sha256": hashlib.sha256(data).hexdigest(),
+                    }
+                ]
+            },
+            f,
+        )
+    monkeypatch.setattr(data_check, "LOCAL_DATA_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(data_check, "INPUT_DATA_CONFIG", input_data_config)
+    monkeypatch.setattr(
+        data_check, "MANIFEST_PATH", os.path.join(tmp_path, "manifest.json")
+    )
+    downloads = []
+
+    def download_local_data(product):
+        downloads.append(product["name"])
+        with open(os.path.join(tmp_path, "test.nc"), "wb") as f:
+            f.write(data)
+
+    monkeypatch.setattr(data_check, "download_local_data", download_local_data)
+
+    data_check.check_data_and_download_missing_data_or_files()
+    assert downloads == ["Test"]
+    assert data_check.manifest_is_current(data_check.load_manifest())
+
+    # Unchanged data is only stat-ed
+    def checksum_local_data(path):
+        raise AssertionError("Unchanged data was checksummed")
+
+    with monkeypatch.context() as m:
+        m.setattr(data_check, "checksum_local_data", checksum_local_data)
+        data_check.check_data_and_download_missing_data_or_files()
+
+    # A truncated file is downloaded again
+    with open(os.path.join(tmp_path, "test.nc"), "wb") as f:
+        f.write(data[:1000])
+    assert not data_check.manifest_is_current(data_check.load_manifest())
+    data_check.check_data_and_download_missing_data_or_files()
+    assert downloads == ["Test", "Test"]
+    data_check.check_data_and_download_missing_data_or_files(verify=True)
+    assert downloads == ["Test", "Test"]
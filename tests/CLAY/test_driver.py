@@ -1,6 +1,170 @@
+import json
+import os
+import time
+import numpy as np
 import pytest
+import xarray as xr
+import shapely.geometry
+import pandas as pd
 import GLHE.CLAY.lake_extraction
-from GLHE.CLAY import CLAY_driver
+from GLHE.CALCITE import events, pubsub
+from GLHE.CLAY import CLAY_driver, combined_data_functions, helpers, product_cache, product_scheduler, xarray_helpers
+from GLHE.CLAY.data_access import data_access_parent_class
+
+
+class SleepingProduct(data_access_parent_class.DataAccess):
+    """Stand in product that sleeps as if it were reading data"""
+
+    def __init__(self, name, seconds):
+        self.name = name
+        self.seconds = seconds
+        self.README_default_information = name
+        super().__init__()
+
+    def verify_inputs(self) -> bool:
+        return True
+
+    def attach_geodata(self) -> str:
+        return "complete"
+
+    def product_driver(self, polygon, debug=False, run_cleanly=False) -> list:
+        time.sleep(self.seconds)
+        self.send_data_product_event(events.TestEvent(self.name))
+        return [self.name]
+
+
+class CachedProduct(data_access_parent_class.DataAccess):
+    """Stand in product that goes through the product cache and the cell weights like the gridded products"""
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+        self.README_default_information = name
+        super().__init__()
+
+    def verify_inputs(self) -> bool:
+        return True
+
+    def attach_geodata(self) -> str:
+        return "complete"
+
+    def product_driver(self, polygon, debug=False, run_cleanly=False) -> list:
+        key = product_cache.product_cache_key(self.name, polygon, [], 1)
+        dataset = product_cache.read_cached_product(key)
+        if dataset is None:
+            dataset = product_cache.write_cached_product(
+                key,
+                xr.Dataset(
+                    {"tp": (("time", "lat", "lon"), np.full((12, 4, 4), self.value))},
+                    coords={"time": np.arange(12), "lat": np.arange(4.0), "lon": np.arange(4.0)},
+                    attrs={"product_name": self.name},
+                ).chunk({"time": 3}),
+            )
+        weights = xarray_helpers.get_lake_cell_weights(dataset, polygon)
+        total = float((dataset["tp"] * weights).sum(["lat", "lon"]).mean())
+        self.send_data_product_event(events.TestEvent(self.name))
+        return [total]
+
+
+class SeriesProduct(data_access_parent_class.DataAccess):
+    """Stand in product returning one monthly series per single letter code, scaled by Hylak_id"""
+
+    def __init__(self, name, single_letter_codes):
+        self.name = name
+        self.single_letter_codes = single_letter_codes
+        self.README_default_information = name + " description"
+        self.hylak_id = None
+        super().__init__()
+
+    def verify_inputs(self) -> bool:
+        return True
+
+    def attach_geodata(self) -> str:
+        return "complete"
+
+    def mv_series(self, hylak_id) -> list:
+        times = pd.date_range("2000-01-01", periods=12, freq="MS", name="time")
+        return [
+            helpers.MVSeries(
+                pd.Series(np.arange(12.0) * hylak_id, index=times), "mm", slc, self.name, slc, None
+            )
+            for slc in self.single_letter_codes
+        ]
+
+    def product_driver(self, polygon, debug=False, run_cleanly=False) -> list:
+        self.send_data_product_event(
+            events.DataProductRunEvent(self.name, self.README_default_information)
+        )
+        return self.mv_series(self.hylak_id or 1)
+
+    def product_driver_many(self, polygons, debug=False, run_cleanly=False) -> dict:
+        self.send_data_product_event(
+            events.DataProductRunEvent(self.name, self.README_default_information)
+        )
+        return {hylak_id: self.mv_series(hylak_id) for hylak_id in polygons}
+
+    def select_lake(self, hylak_id) -> None:
+        self.hylak_id = hylak_id
+        super().select_lake(hylak_id)
+
+
+class StubLakeExtraction:
+    """Stand in for LakeExtraction, lake <Hylak_id> is a small box"""
+
+    def extract_lake_information(self, hylak_id):
+        self.hylak_id = hylak_id
+
+    def get_lake_name(self):
+        return "Lake_{}".format(self.hylak_id)
+
+    def get_lake_polygon(self):
+        return shapely.geometry.box(self.hylak_id, 0, self.hylak_id + 0.1, 0.1)
+
+
+@pytest.fixture
+def stub_products(tmp_path, monkeypatch):
+    """Points the lake outputs at tmp_path and replaces the data products of the drivers with SeriesProducts"""
+    monkeypatch.setitem(
+        GLHE.CLAY.globals.config["DIRECTORIES"], "LAKE_OUTPUT_FOLDER", str(tmp_path)
+    )
+    monkeypatch.setitem(
+        GLHE.CLAY.globals.config["DIRECTORIES"],
+        "LOGGING_DIRECTORY",
+        GLHE.CLAY.globals.config["DIRECTORIES"]["LOGGING_DIRECTORY"],
+    )
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(GLHE.CLAY.globals.config, "SERIES_DATA_FORMATS", ["csv"])
+    monkeypatch.setitem(GLHE.CLAY.globals.config, "DEBUG", True)
+    products = {
+        "p.A": (["p", "e"], True),
+        "o.B": (["o"], False),
+    }
+
+    def load_data_product_list(self, instantiate=True):
+        self.data_products = {
+            key: {
+                "module_name": None,
+                "class_name": None,
+                "run_on_start": run_on_start,
+                "loaded": False,
+                "object": self.make_data_product_object(key) if instantiate else None,
+                "output_datasets": [],
+            }
+            for key, (single_letter_codes, run_on_start) in products.items()
+        }
+        return self.data_products
+
+    monkeypatch.setattr(CLAY_driver.CLAY_driver, "load_data_product_list", load_data_product_list)
+    monkeypatch.setattr(
+        CLAY_driver.CLAY_driver,
+        "make_data_product_object",
+        lambda self, key: SeriesProduct(key.split(".")[1], products[key][0]),
+    )
+    monkeypatch.setattr(
+        CLAY_driver.data_check, "check_data_and_download_missing_data_or_files", lambda: None
+    )
+    monkeypatch.setattr(CLAY_driver.lake_extraction, "LakeExtraction", StubLakeExtraction)
+    return tmp_path
 
 
 class TestDriver:
@@ -22,6 +186,165 @@ class TestDriver:
         lake_extraction.extract_lake_information(Mono_Hylak_ID)
         assert lake_extraction.get_lake_name() == "Mono_Lake"
 
+    def test_hydrolakes_index_lookup(self, tmp_path):
+        index_path = os.path.join(tmp_path, "index.sqlite")
+        polygon = shapely.geometry.box(-119.2, 37.9, -118.9, 38.1)
+        GLHE.CLAY.lake_extraction.write_hydrolakes_index(
+            index_path,
+            [({"Hylak_id": 798, "Lake_name": "Mono Lake"}, polygon.wkb)],
+            "stamp",
+        )
+        lake = GLHE.CLAY.lake_extraction.read_lake_from_hydrolakes_index(
+            798, index_path
+        )
+        assert lake["properties"]["Lake_name"] == "Mono Lake"
+        assert shapely.geometry.shape(lake["geometry"]).equals(polygon)
+        assert (
+            GLHE.CLAY.lake_extraction.read_lake_from_hydrolakes_index(1, index_path)
+            is None
+        )
+
+    def test_subset_box_wraps_around_seam(self):
+        lat = np.arange(60, 39.9, -0.5)
+        lon = np.arange(0, 360, 0.5)
+        dataset = xr.Dataset(
+            {"tp": (("lat", "lon"), np.zeros((len(lat), len(lon))))},
+            coords={"lat": lat, "lon": lon},
+            attrs={"product_name": "Test"},
+        )
+        polygon = shapely.geometry.box(-0.6, 51.2, 0.3, 51.7)
+        subset = GLHE.CLAY.lake_extraction.subset_box(
+            dataset, polygon, 1, long_type_180=True
+        )
+        assert list(subset.lon.values) == [-1.0, -0.5, 0.0, 0.5]
+        assert np.all(np.diff(xarray_helpers.cell_edges(subset.lon.values)) == 0.5)
+        assert list(subset.lat.values) == [52.0, 51.5, 51.0]
+
+    def test_products_run_concurrently(self, monkeypatch):
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_WORKERS", 3)
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_TIMEOUT_SECONDS", 1)
+        received = []
+        subscription = pubsub.EventBus.Subscribe(
+            pubsub.EventBus, "TestEvent", lambda msg: received.append(msg.name)
+        )
+        products = {
+            "slow": SleepingProduct("slow", 0.5),
+            "fast": SleepingProduct("fast", 0.0),
+            "stuck": SleepingProduct("stuck", 3),
+            "medium": SleepingProduct("medium", 0.5),
+        }
+        start = time.perf_counter()
+        results = product_scheduler.run_products_concurrently(products, None)
+        assert time.perf_counter() - start < 2
+        pubsub.EventBus.topics["TestEvent"].remove(subscription)
+        assert list(results) == ["slow", "fast", "stuck", "medium"]
+        assert results["slow"] == (["slow"], None)
+        assert results["stuck"][0] is None
+        assert received == ["slow", "fast", "medium"]
+
+    def test_product_timeout_counts_from_its_start(self, monkeypatch):
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_WORKERS", 1)
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_TIMEOUT_SECONDS", 1)
+        products = {
+            "first": SleepingProduct("first", 0.6),
+            "second": SleepingProduct("second", 0.6),
+        }
+        results = product_scheduler.run_products_concurrently(products, None)
+        assert results == {"first": (["first"], None), "second": (["second"], None)}
+
+    def test_products_queued_behind_a_stuck_product(self, monkeypatch):
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_WORKERS", 1)
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_TIMEOUT_SECONDS", 0.5)
+        products = {
+            "stuck": SleepingProduct("stuck", 2),
+            "fast": SleepingProduct("fast", 0.0),
+        }
+        start = time.perf_counter()
+        results = product_scheduler.run_products_concurrently(products, None)
+        assert time.perf_counter() - start < 1.5
+        assert isinstance(results["stuck"][1], TimeoutError)
+        assert isinstance(results["fast"][1], TimeoutError)
+        assert products["stuck"].held_events == []
+
+    def test_cached_products_run_concurrently(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "CACHE_DIRECTORY", str(tmp_path)
+        )
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_WORKERS", 2)
+        # Every write evicts, the entries the other product is using have to be kept
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_CACHE_SIZE_LIMIT_MB", 0)
+        polygons = [shapely.geometry.box(0.5, 0.5, size, size) for size in (1.5, 2.5, 3.5)]
+        expected = [
+            xarray_helpers.compute_lake_cell_weights(np.arange(4.0), np.arange(4.0), polygon).sum()
+            for polygon in polygons
+        ]
+        hits = []
+        for _ in range(2):
+            hits.append(product_cache.cache_statistics["hits"])
+            for polygon, weight in zip(polygons, expected):
+                results = product_scheduler.run_products_concurrently(
+                    {"first": CachedProduct("First", 1.0), "second": CachedProduct("Second", 2.0)},
+                    polygon,
+                )
+                assert results["first"][1] is None and results["second"][1] is None
+                assert np.isclose(results["first"][0][0], weight)
+                assert np.isclose(results["second"][0][0], 2 * weight)
+        # The second round read the products from the cache, and no lock or temporary files are left
+        assert product_cache.cache_statistics["hits"] - hits[1] == 6
+        assert len(product_cache.list_cache_entries()) == 12
+        assert sorted(os.listdir(tmp_path)) == ["cell_weights", "products"]
+        assert not [
+            name
+            for folder in ["cell_weights", "products"]
+            for name in os.listdir(tmp_path / folder)
+            if name.endswith(".writing")
+        ]
+
+    def test_add_product_to_restored_lake(self, stub_products):
+        driver = CLAY_driver.CLAY_driver()
+        driver.set_up_logging()
+        driver.run_lake(1, StubLakeExtraction())
+        output_directory = stub_products / "Lake_1"
+        driver = CLAY_driver.CLAY_driver()
+        driver.set_up_logging()
+        driver.restore_lake(1, StubLakeExtraction())
+        assert driver.data_products["p.A"]["loaded"]
+        assert not driver.data_products["o.B"]["loaded"]
+        driver.run_product("o.B", incremental=True)
+
+        series_data = combined_data_functions.read_compiled_data("Lake_1_Data")
+        assert list(series_data.columns) == ["p.A", "e.A", "o.B"]
+        with open(output_directory / "CONFIG.json") as f:
+            config = json.load(f)
+        assert config["HYLAK_ID"] == 1
+        assert config["SERIES_DATA"].endswith("Lake_1_Data.csv")
+        assert os.path.exists(config["BLEEPBLEEP"])
+        with open(config["BLEEPBLEEP"]) as f:
+            assert json.load(f)["o.B"]["loaded"]
+        with open(output_directory / "Lake_1_README.json") as f:
+            read_me = json.load(f)
+        assert "Lake_1_Data.csv" in read_me["Output_File"]
+        assert "Lake_1_products_plot.png" in read_me["Output_File"]
+        assert read_me["Data_Product"] == {"A": "A description", "B": "B description"}
+
+    def test_run_many(self, stub_products):
+        driver = CLAY_driver.CLAY_driver()
+        output_directories = driver.run_many([1, 2])
+        assert list(output_directories) == [1, 2]
+        for hylak_id in [1, 2]:
+            lake_name = "Lake_{}".format(hylak_id)
+            assert output_directories[hylak_id] == str(stub_products / lake_name)
+            series_data = pd.read_csv(
+                stub_products / lake_name / (lake_name + "_Data.csv"), index_col=0
+            )
+            assert list(series_data.columns) == ["p.A", "e.A"]
+            assert list(series_data["p.A"]) == list(np.arange(12.0) * hylak_id)
+            with open(stub_products / lake_name / (lake_name + "_README.json")) as f:
+                read_me = json.load(f)
+            assert read_me["Data_Product"] == {"A": "A description"}
+            assert lake_name + "_Data.csv" in read_me["Output_File"]
+        assert list(driver.pandas_panel.index.get_level_values(0).unique()) == [1, 2]
+
     def test_data_access_initialization_handler(self):
         clay_driver = CLAY_driver.CLAY_driver()
         data_products = clay_driver.load_data_product_list()
@@ -0,0 +1,432 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import shapely.geometry
+import xarray as xr
+import GLHE.CLAY.globals
+from GLHE.CLAY import helpers, product_cache, ureg, xarray_helpers
+
+
+class TestXarrayHelpers:
+
+    def test_lake_cell_weights(self):
+        lat = np.array([38.5, 38.0, 37.5])
+        lon = np.array([240.0, 240.5, 241.0])
+        polygon = shapely.geometry.box(-120.1, 37.9, -119.6, 38.1)
+        weights = xarray_helpers.compute_lake_cell_weights(lat, lon, polygon)
+        expected = np.zeros((3, 3))
+        expected[1, 0] = 0.7 * 0.4
+        expected[1, 1] = 0.3 * 0.4
+        assert np.allclose(weights, expected)
+
+    def test_cached_lake_cell_weights(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "CACHE_DIRECTORY", str(tmp_path)
+        )
+        monkeypatch.setattr(xarray_helpers, "cell_weight_cache", OrderedDict())
+        monkeypatch.setattr(xarray_helpers, "CELL_WEIGHT_CACHE_SIZE", 1)
+        dataset = xr.Dataset(
+            coords={"lat": [38.5, 38.0, 37.5], "lon": [240.0, 240.5, 241.0]},
+            attrs={"product_name": "Test"},
+        )
+        polygons = [
+            shapely.geometry.box(-120.1, 37.9, -119.6, 38.1),
+            shapely.geometry.box(-120.1, 37.4, -119.1, 38.6),
+        ]
+        expected = [
+            xarray_helpers.get_lake_cell_weights(dataset, polygon).values
+            for polygon in polygons
+        ]
+        assert len(xarray_helpers.cell_weight_cache) == 1
+        cache_files = sorted(os.listdir(xarray_helpers.get_cell_weight_directory()))
+        assert len(cache_files) == 2
+        # The files count towards the cache size limit
+        assert sorted(
+            os.path.basename(entry[0]) for entry in product_cache.list_cache_entries()
+        ) == cache_files
+        # A half written file from another worker is computed again
+        with open(
+            os.path.join(xarray_helpers.get_cell_weight_directory(), cache_files[0]), "wb"
+        ) as f:
+            f.write(b"\x93NUMPY")
+        xarray_helpers.cell_weight_cache.clear()
+        for polygon, weights in zip(polygons, expected):
+            assert np.allclose(
+                xarray_helpers.get_lake_cell_weights(dataset, polygon).values, weights
+            )
+
+    def test_lake_cell_weights_across_seam(self):
+        lat = np.array([0.25, -0.25])
+        lon = np.array([359.25, 359.75, 0.25, 0.75])
+        polygon = shapely.geometry.box(-0.6, -0.6, 0.6, 0.6)
+        weights = xarray_helpers.compute_lake_cell_weights(lat, lon, polygon)
+        assert np.allclose(weights, [[0.2, 1, 1, 0.2]] * 2)
+        # Same lake on a [-180,180] grid crossing the antimeridian
+        lon = np.array([179.25, 179.75, -179.75, -179.25])
+        polygon = shapely.geometry.box(179.4, -0.6, 180.6, 0.6)
+        weights = xarray_helpers.compute_lake_cell_weights(lat, lon, polygon)
+        assert np.allclose(weights, [[0.2, 1, 1, 0.2]] * 2)
+
+    def test_positive_stays_lazy(self):
+        dataset = xr.Dataset(
+            {"e": (("time",), -np.arange(1.0, 25.0), {"units": "mm/month"})},
+            coords={"time": pd.date_range("2000-01-01", periods=24, freq="MS")},
+            attrs={"product_name": "Test"},
+        ).chunk({"time": 6})
+        positive = xarray_helpers.make_sure_xarray_dataset_is_positive(dataset, "e")
+        assert positive["e"].chunks is not None
+        assert positive["e"].attrs["units"] == "mm/month"
+        assert float(xarray_helpers.compute_xarray_dataset(positive)["e"].min()) == 1
+        # Each chunk is made positive from its own chunk only, without a reduction over the variable
+        data = positive["e"].data
+        chunk_graph = data.__dask_graph__().cull({(data.name, 0)})
+        source_name = dataset["e"].data.name
+        assert [key for key in chunk_graph if key[0] == source_name] == [(source_name, 0)]
+
+
+    def test_rechunk_to_zarr_round_trip(self, tmp_path):
+        time = pd.date_range("2000-01-01", periods=4, freq="MS")
+        dataset = xr.Dataset(
+            {
+                "tp": (("time", "lat", "lon"), np.arange(4 * 5 * 3.0).reshape(4, 5, 3)),
+                "time_bnds": (("time", "nv"), np.stack([time, time + pd.Timedelta(days=1)], 1)),
+            },
+            coords={"time": time, "lat": np.arange(5.0), "lon": np.arange(3.0)},
+        ).chunk({"time": 2})
+        store_path = str(tmp_path / "data.zarr")
+        source = [["data.nc", 1, 2]]
+        xarray_helpers.rechunk_xarray_dataset_to_zarr(dataset, store_path, 2, source)
+        with product_cache.open_source_zarr_store(store_path, source) as store:
+            assert store["tp"].chunks == ((4,), (2, 2, 1), (2, 1))
+            xr.testing.assert_equal(store, dataset.compute())
+        assert product_cache.open_source_zarr_store(store_path, [["data.nc", 1, 3]]) is None
+
+
+class TestUnitConversion:
+
+    def test_rate_to_calendar_month(self):
+        index = pd.date_range("2000-01-01", periods=3, freq="MS")
+        series = helpers.MVSeries(
+            pd.Series(np.ones(3), index=index),
+            ureg.parse_units("m/day"),
+            "p",
+            "Test",
+            "tp",
+            None,
+        )
+        (converted,) = helpers.convert_MVSeries_units(
+            [series], ureg.parse_units("mm/month")
+        )
+        assert list(converted.dataset.values) == [31000.0, 29000.0, 31000.0]
+
+    def test_monthly_input_is_unchanged(self):
+        assert helpers.get_unit_conversion_plan("mm/month", "mm/month") == (1, False)
+
+
+class TestProductCache:
+
+    def test_round_trip_and_eviction(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "CACHE_DIRECTORY", str(tmp_path)
+        )
+        dataset = xr.Dataset(
+            {"tp": (("time", "lat", "lon"), np.random.rand(12, 4, 4))},
+            coords={
+                "time": pd.date_range("2000-01-01", periods=12, freq="MS"),
+                "lat": np.arange(4.0),
+                "lon": np.arange(4.0),
+            },
+            attrs={"product_name": "Test"},
+        )
+        first_key = product_cache.product_cache_key(
+            "Test", shapely.geometry.box(0, 0, 1, 1), [], 1
+        )
+        second_key = product_cache.product_cache_key(
+            "Test", shapely.geometry.box(0, 0, 2, 2), [], 1
+        )
+        assert first_key != second_key
+        assert product_cache.read_cached_product(first_key) is None
+        product_cache.write_cached_product(first_key, dataset)
+        cached = product_cache.read_cached_product(first_key)
+        assert np.allclose(cached["tp"].values, dataset["tp"].values)
+        cached.close()
+
+    def test_least_recently_used_entry_is_evicted(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "CACHE_DIRECTORY", str(tmp_path)
+        )
+        dataset = xr.Dataset({"tp": (("time",), np.random.rand(12))})
+        keys = [
+            product_cache.product_cache_key(
+                "Test", shapely.geometry.box(0, 0, size, size), [], 1
+            )
+            for size in (1, 2, 3)
+        ]
+        for last_use, key in enumerate(keys):
+            product_cache.write_cached_product(key, dataset).close()
+            os.utime(product_cache.get_entry_path(key), (last_use, last_use))
+        # Reading the oldest entry makes it the most recently used
+        product_cache.read_cached_product(keys[0]).close()
+        entry_size = product_cache.get_entry_size(product_cache.get_entry_path(keys[0]))
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config,
+            "PRODUCT_CACHE_SIZE_LIMIT_MB",
+            2.5 * entry_size / 1024**2,
+        )
+        assert product_cache.enforce_cache_size_limit() == [
+            product_cache.get_entry_path(keys[1])
+        ]
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config,
+            "PRODUCT_CACHE_SIZE_LIMIT_MB",
+            1.5 * entry_size / 1024**2,
+        )
+        assert product_cache.enforce_cache_size_limit() == [
+            product_cache.get_entry_path(keys[2])
+        ]
+        assert [entry[0] for entry in product_cache.list_cache_entries()] == [
+            product_cache.get_entry_path(keys[0])
+        ]
+
+    def test_entries_in_use_are_not_evicted(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "CACHE_DIRECTORY", str(tmp_path)
+        )
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "PRODUCT_CACHE_SIZE_LIMIT_MB", 0)
+        dataset = xr.Dataset({"tp": (("time",), np.random.rand(12))})
+        open_key, recent_key = [
+            product_cache.product_cache_key(
+                "Test", shapely.geometry.box(0, 0, size, size), [], 1
+            )
+            for size in (1, 2)
+        ]
+        cached = product_cache.write_cached_product(open_key, dataset)
+        product_cache.write_cached_product(recent_key, dataset).close()
+        os.utime(product_cache.get_entry_path(open_key), (0, 0))
+        # Open in this process, and used by another one a moment ago
+        assert product_cache.enforce_cache_size_limit() == []
+        cached.close()
+        del cached
+        assert product_cache.enforce_cache_size_limit() == [
+            product_cache.get_entry_path(open_key)
+        ]
+
+    def test_removed_entries_are_left_out_of_the_listing(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "CACHE_DIRECTORY", str(tmp_path)
+        )
+        dataset = xr.Dataset({"tp": (("time",), np.random.rand(12))})
+        keys = [
+            product_cache.product_cache_key(
+                "Test", shapely.geometry.box(0, 0, size, size), [], 1
+            )
+            for size in (1, 2)
+        ]
+        for key in keys:
+            product_cache.write_cached_product(key, dataset).close()
+        get_entry_size = product_cache.get_entry_size
+
+        def get_entry_size_after_another_eviction(entry_path):
+            # Another process evicts the entry between the listing and the stat
+            if entry_path == product_cache.get_entry_path(keys[0]):
+                product_cache.remove_entry(entry_path)
+            return get_entry_size(entry_path)
+
+        monkeypatch.setattr(
+            product_cache, "get_entry_size", get_entry_size_after_another_eviction
+        )
+        assert [entry[0] for entry in product_cache.list_cache_entries()] == [
+            product_cache.get_entry_path(keys[1])
+        ]
+
+    def test_write_many_in_one_pass(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "CACHE_DIRECTORY", str(tmp_path)
+        )
+        dataset = xr.Dataset(
+            {"tp": (("time", "lat", "lon"), np.random.rand(12, 4, 4))},
+            coords={
+                "time": pd.date_range("2000-01-01", periods=12, freq="MS"),
+                "lat": np.arange(4.0),
+                "lon": np.arange(4.0),
+            },
+        ).chunk({"time": 6})
+        lakes = {
+            product_cache.product_cache_key(
+                "Test", shapely.geometry.box(0, 0, size, size), [], 1
+            ): dataset.isel(lat=slice(0, size), lon=slice(0, size))
+            for size in (1, 2, 3)
+        }
+        cached = product_cache.write_cached_products(lakes)
+        for key, lake_dataset in lakes.items():
+            assert np.allclose(cached[key]["tp"].values, lake_dataset["tp"].values)
+            cached[key].close()
+            with product_cache.read_cached_product(key) as read:
+                assert read is not None
+
+
+class TestCombinedData:
+
+    @staticmethod
+    def slc_dict(*series):
+        datasets_dict = {key: [] for key in GLHE.CLAY.globals.SLC_MAPPING_REVERSE_NAMES}
+        for slc, product, values in series:
+            datasets_dict[slc].append(
+                helpers.MVSeries(values, "mm", slc, product, "var", None)
+            )
+        return datasets_dict
+
+    def test_merge_matches_outer_merge(self):
+        from GLHE.CLAY import combined_data_functions
+
+        times = pd.date_range("2000-01-01", periods=24, freq="MS", name="time")
+        datasets_dict = self.slc_dict(
+            ("p", "ERA5", pd.Series(np.arange(24.0), index=times)),
+            ("e", "CRUTS", pd.Series(np.arange(12.0), index=times[6:18])),
+            ("p", "CRUTS", pd.Series(np.arange(6.0), index=times[18:])),
+        )
+        expected = pd.DataFrame()
+        for key in GLHE.CLAY.globals.SLC_MAPPING_REVERSE_NAMES:
+            for ds in datasets_dict[key]:
+                expected = pd.merge(
+                    expected,
+                    ds.dataset.rename(ds.single_letter_code + "." + ds.product_name),
+                    how="outer",
+                    left_index=True,
+                    right_index=True,
+                )
+        merged = combined_data_functions.merge_mv_series_into_pandas_dataframe(
+            datasets_dict
+        )
+        pd.testing.assert_frame_equal(merged, expected, check_freq=False)
+
+        panel = combined_data_functions.merge_mv_series_into_panel(
+            {
+                1: datasets_dict,
+                2: self.slc_dict(("e", "CRUTS", pd.Series([1.0, 2.0], index=times[:2]))),
+            }
+        )
+        assert list(panel.columns) == list(merged.columns)
+        assert panel.index.names == ["lake", "time"]
+        pd.testing.assert_frame_equal(
+            panel.loc[1], merged, check_freq=False, check_names=False
+        )
+        assert panel.loc[2]["e.CRUTS"].tolist() == [1.0, 2.0]
+        assert panel.loc[2]["p.ERA5"].isna().all()
+
+    def test_series_data_formats(self, tmp_path, monkeypatch):
+        from GLHE.CLAY import combined_data_functions
+
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "OUTPUT_DIRECTORY", str(tmp_path)
+        )
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config, "SERIES_DATA_FORMATS", ["csv", "parquet", "arrow"]
+        )
+        times = pd.date_range("2000-01-01", periods=12, freq="MS", name="time")
+        dataset = pd.DataFrame(
+            {"p.ERA5": np.arange(12.0), "e.CRUTS": np.arange(12.0) / 2}, index=times
+        )
+        combined_data_functions.output_all_compiled_data("Lake_Data", dataset)
+
+        parquet = pd.read_parquet(tmp_path / "Lake_Data.parquet", columns=["e.CRUTS"])
+        pd.testing.assert_frame_equal(parquet, dataset[["e.CRUTS"]], check_freq=False)
+        arrow = pd.read_feather(tmp_path / "Lake_Data.arrow")
+        assert arrow["time"].dtype == "datetime64[ns]"
+        assert (tmp_path / "Lake_Data.csv").exists()
+        assert combined_data_functions.fastest_series_data_file(
+            str(tmp_path / "Lake_Data.csv"), None, str(tmp_path / "Lake_Data.parquet")
+        ).endswith(".parquet")
+
+        # Formats no longer configured are deleted, so they aren't read in place of the new data
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "SERIES_DATA_FORMATS", ["csv"])
+        combined_data_functions.output_all_compiled_data("Lake_Data", dataset * 2)
+        assert not (tmp_path / "Lake_Data.parquet").exists()
+        assert not (tmp_path / "Lake_Data.arrow").exists()
+        pd.testing.assert_frame_equal(
+            combined_data_functions.read_compiled_data("Lake_Data"),
+            dataset * 2,
+            check_freq=False,
+        )
+
+    def test_gridded_time_stack(self, tmp_path, monkeypatch):
+        import zipfile
+        import rasterio.io
+        from GLHE.CLAY import combined_data_functions
+
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "OUTPUT_DIRECTORY", str(tmp_path)
+        )
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "LAKE_NAME", "Lake")
+        times = pd.date_range("2000-01-01", periods=12, freq="MS")
+        variable = xr.DataArray(
+            np.random.rand(12, 3, 4).astype("float32"),
+            coords={"time": times, "lat": [2.0, 1.0, 0.0], "lon": np.arange(4.0)},
+            dims=("time", "lat", "lon"),
+        )
+        mvs = helpers.MVSeries(None, "mm", "p", "Test", "tp", variable)
+
+        combined_data_functions.present_mv_series_as_geospatial_time_stack(
+            pd.Timestamp("2000-03-01"), None, mvs
+        )
+        with zipfile.ZipFile(tmp_path / "Lake_gridded_data_layers_20000301-end.zip") as zf:
+            assert zf.namelist() == ["p_Test_Lake_20000301-20001201.tif"]
+            tif = zf.read("p_Test_Lake_20000301-20001201.tif")
+        with rasterio.io.MemoryFile(tif) as memory_file, memory_file.open() as src:
+            assert src.count == 10
+            assert src.descriptions[0] == "2000-03-01"
+            assert np.allclose(src.read(), variable.values[2:])
+
+        combined_data_functions.present_mv_series_as_geospatial_at_date_time(
+            pd.Timestamp("2000-05-03"), mvs
+        )
+        with zipfile.ZipFile(tmp_path / "Lake_gridded_data_layers_on_20000503.zip") as zf:
+            tif = zf.read("p_Test_Lake_20000503.tif")
+        with rasterio.io.MemoryFile(tif) as memory_file, memory_file.open() as src:
+            assert np.allclose(src.read(1), variable.values[4])
+
+    def test_incremental_outputs(self, tmp_path, monkeypatch):
+        import zipfile
+        from GLHE.CLAY import combined_data_functions
+
+        monkeypatch.setitem(
+            GLHE.CLAY.globals.config["DIRECTORIES"], "OUTPUT_DIRECTORY", str(tmp_path)
+        )
+        monkeypatch.setitem(GLHE.CLAY.globals.config, "LAKE_NAME", "Lake")
+        times = pd.date_range("2000-01-01", periods=12, freq="MS", name="time")
+        combined_data_functions.output_all_compiled_data(
+            "Lake_Data",
+            pd.DataFrame(
+                {"p.ERA5": np.arange(12.0), "e.CRUTS": np.arange(12.0)}, index=times
+            ),
+        )
+        combined = combined_data_functions.append_compiled_data(
+            "Lake_Data",
+            pd.DataFrame({"p.NWM": np.arange(6.0)}, index=times[6:]),
+        )
+        assert list(combined.columns) == ["p.ERA5", "p.NWM", "e.CRUTS"]
+        written = combined_data_functions.read_compiled_data("Lake_Data")
+        pd.testing.assert_frame_equal(written, combined, check_freq=False)
+        assert written["p.NWM"].isna().sum() == 6
+
+        variable = xr.DataArray(
+            np.random.rand(12, 3, 4),
+            coords={"time": times, "lat": [2.0, 1.0, 0.0], "lon": np.arange(4.0)},
+            dims=("time", "lat", "lon"),
+        )
+        first = helpers.MVSeries(None, "mm", "p", "First", "tp", variable)
+        second = helpers.MVSeries(None, "mm", "p", "Second", "tp", variable)
+        date = pd.Timestamp("2000-05-01")
+        combined_data_functions.present_mv_series_as_geospatial_at_date_time(date, first)
+        combined_data_functions.present_mv_series_as_geospatial_at_date_time(
+            date, second, append=True
+        )
+        combined_data_functions.present_mv_series_as_geospatial_at_date_time(
+            date, first, append=True
+        )
+        with zipfile.ZipFile(tmp_path / "Lake_gridded_data_layers_on_20000501.zip") as zf:
+            assert sorted(zf.namelist()) == [
+                "p_First_Lake_20000501.tif",
+                "p_Second_Lake_20000501.tif",
+            ]
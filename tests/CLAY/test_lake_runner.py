@@ -0,0 +1,60 @@
+import os
+import time
+import GLHE.CLAY.globals
+from GLHE.CLAY import lake_runner
+
+FAILING_LAKE = 4
+DYING_LAKE = 5
+
+
+class StubDriver:
+    """Stand in for CLAY_driver in the workers, returns when it ran the lake instead of running it"""
+
+    def set_up_logging(self):
+        pass
+
+    def run_lake(self, hylak_id, lake_extraction_object):
+        if hylak_id == FAILING_LAKE:
+            raise ValueError("No lake {}".format(hylak_id))
+        if hylak_id == DYING_LAKE:
+            os._exit(1)
+        start = time.time()
+        time.sleep(0.3)
+        return start, time.time()
+
+
+def run_lakes(monkeypatch, hylak_ids, num_workers):
+    monkeypatch.setattr(
+        lake_runner.data_check, "check_data_and_download_missing_data_or_files", lambda: None
+    )
+    monkeypatch.setattr(lake_runner, "WORKER_POLL_SECONDS", 0.2)
+    return lake_runner.run_lakes_in_process_pool(hylak_ids, num_workers, StubDriver)
+
+
+def test_results_errors_and_dead_workers(monkeypatch):
+    results = run_lakes(monkeypatch, [1, FAILING_LAKE, DYING_LAKE, 2, 3], 2)
+    assert list(results) == [1, FAILING_LAKE, DYING_LAKE, 2, 3]
+    for hylak_id in [1, 2, 3]:
+        assert results[hylak_id]["error"] is None
+        assert results[hylak_id]["output_directory"] is not None
+    assert "No lake 4" in results[FAILING_LAKE]["error"]
+    assert "stopped" in results[DYING_LAKE]["error"]
+    assert results[DYING_LAKE]["output_directory"] is None
+
+
+def test_all_workers_dying(monkeypatch):
+    results = run_lakes(monkeypatch, [DYING_LAKE, 1], 1)
+    assert "stopped" in results[DYING_LAKE]["error"]
+    assert results[1]["error"] == "No lake workers left to run the lake"
+
+
+def test_lakes_wait_for_memory(monkeypatch):
+    monkeypatch.setitem(
+        GLHE.CLAY.globals.config, "LAKE_RUNNER_MIN_AVAILABLE_MEMORY_MB", 1000
+    )
+    monkeypatch.setattr(lake_runner, "available_memory_mb", lambda: 0)
+    results = run_lakes(monkeypatch, [1, 2, 3], 3)
+    runs = sorted(result["output_directory"] for result in results.values())
+    # Without memory to spare only one lake runs at a time
+    for (_, end), (start, _) in zip(runs, runs[1:]):
+        assert end <= start
@@ -0,0 +1,53 @@
+import os
+import zipfile
+import numpy as np
+from GLHE.CLAY import combined_data_functions
+from GLHE.LIME import gridded_data_validation
+
+
+def test_read_points_frame_of_time_stack(tmp_path):
+    data = np.arange(3 * 2 * 2, dtype=float).reshape(3, 2, 2)
+    data[1, 0, 0] = np.nan
+    zip_path = str(tmp_path / "Lake_gridded_data_layers.zip")
+    with zipfile.ZipFile(zip_path, "w") as zf:
+        combined_data_functions.write_geotiff_into_zip(
+            zf,
+            "p_ERA5_Lake_20000101-20000301.tif",
+            data,
+            np.array([1.0, 0.0]),
+            np.array([10.0, 11.0]),
+            ["2000-01-01", "2000-02-01", "2000-03-01"],
+        )
+    points = gridded_data_validation.read_points_frame(
+        zip_path, os.path.getmtime(zip_path), "p_ERA5_Lake_20000101-20000301.tif", "2000-02-10"
+    )
+    # The nearest band is February, without its nodata cell
+    assert sorted(points["z"]) == [5.0, 6.0, 7.0]
+    assert list(points.columns) == ["x", "y", "z", "easting", "northing"]
+
+    # Callers get their own copy of the memoized frame
+    points["z"] = 0
+    again = gridded_data_validation.read_points_frame(
+        zip_path, os.path.getmtime(zip_path), "p_ERA5_Lake_20000101-20000301.tif", "2000-02-10"
+    )
+    assert sorted(again["z"]) == [5.0, 6.0, 7.0]
+
+
+def test_missing_layers_are_left_out(tmp_path, caplog):
+    zip_path = str(tmp_path / "Lake_gridded_data_layers.zip")
+    with zipfile.ZipFile(zip_path, "w") as zf:
+        combined_data_functions.write_geotiff_into_zip(
+            zf,
+            "p_CRUTS_Lake_20000101.tif",
+            np.ones((1, 2, 2)),
+            np.array([1.0, 0.0]),
+            np.array([10.0, 11.0]),
+            ["2000-01-01"],
+        )
+    gridded_data = gridded_data_validation.GriddedDataDisplay({"GRIDDED_DATA_FOLDER": zip_path})
+    # Listed when the lake was loaded, gone from the zip a job rewrote since
+    gridded_data.tif_file_paths["p.ERA5-Land"] = "p_ERA5-Land_Lake_20000101.tif"
+    frames = gridded_data.get_available_points_frames(["p.CRUTS", "p.ERA5-Land", "e.ERA5-Land"])
+    assert list(frames) == ["p.CRUTS"]
+    assert len(frames["p.CRUTS"]) == 4
+    assert "No p.ERA5-Land layer" in caplog.text
@@ -0,0 +1,63 @@
+import threading
+import time
+import pytest
+from GLHE.LIME import lake_output_cache
+
+
+class StubLakeOutputs:
+    """Stand in for LakeOutputs that counts its loads instead of reading a CLAY output folder"""
+
+    loads = []
+
+    def __init__(self, output_file_dir):
+        StubLakeOutputs.loads.append(output_file_dir)
+        time.sleep(0.1)
+        self.output_file_dir = output_file_dir
+        self.loaded_at = time.time()
+
+
+@pytest.fixture
+def stub_lake_outputs(monkeypatch):
+    StubLakeOutputs.loads = []
+    monkeypatch.setattr(lake_output_cache, "LakeOutputs", StubLakeOutputs)
+    return StubLakeOutputs
+
+
+def test_least_recently_used_lake_is_dropped(stub_lake_outputs):
+    cache = lake_output_cache.LakeOutputCache(max_lakes=2)
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")
+    cache.get("c")
+    assert list(cache.lakes) == ["a", "c"]
+    cache.get("a")
+    cache.get("b")
+    assert stub_lake_outputs.loads == ["a", "b", "c", "b"]
+    assert len(cache) == 2
+
+
+def test_lake_is_loaded_once_by_many_threads(stub_lake_outputs):
+    cache = lake_output_cache.LakeOutputCache(max_lakes=2)
+    lakes = []
+    threads = [
+        threading.Thread(target=lambda: lakes.append(cache.get("a"))) for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stub_lake_outputs.loads == ["a"]
+    assert all(lake is lakes[0] for lake in lakes)
+
+
+def test_invalidate_older_than(stub_lake_outputs):
+    cache = lake_output_cache.LakeOutputCache()
+    loaded_at = cache.get("a").loaded_at
+    cache.invalidate("a", older_than=loaded_at)
+    assert len(cache) == 1
+    cache.invalidate("a", older_than=loaded_at + 1)
+    assert len(cache) == 0
+    cache.get("a")
+    cache.invalidate("a")
+    assert stub_lake_outputs.loads == ["a", "a"]
+    assert len(cache) == 0
@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from GLHE.LIME import product_jobs
+
+
+@pytest.fixture
+def thread_executor(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(product_jobs, "get_executor", lambda: executor)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_submit_product_job(tmp_path, thread_executor, monkeypatch):
+    def run_product_job(output_file_dir, job_id):
+        product_jobs.update_job(output_file_dir, job_id, status="finished", finished=time.time())
+
+    monkeypatch.setattr(product_jobs, "run_product_job", run_product_job)
+    job = product_jobs.submit_product_job(str(tmp_path), 798, "p.NWM")
+    assert job["status"] == "queued"
+    product_jobs.submitted_jobs[job["job_id"]].result()
+    jobs = product_jobs.list_jobs(str(tmp_path))
+    assert [(job["product"], job["hylak_id"], job["status"]) for job in jobs] == [
+        ("p.NWM", 798, "finished")
+    ]
+
+
+def test_failed_worker_is_recorded(tmp_path, thread_executor, monkeypatch):
+    def run_product_job(output_file_dir, job_id):
+        raise MemoryError("worker died")
+
+    monkeypatch.setattr(product_jobs, "run_product_job", run_product_job)
+    job = product_jobs.submit_product_job(str(tmp_path), 798, "p.NWM")
+    thread_executor.shutdown(wait=True)
+    job = product_jobs.read_job(str(tmp_path), job["job_id"])
+    assert job["status"] == "failed"
+    assert "worker died" in job["error"]
+    assert job["finished"] is not None
+
+
+def test_update_job(tmp_path):
+    job = {
+        "job_id": "a",
+        "output_file_dir": str(tmp_path),
+        "product": "p.NWM",
+        "status": "running",
+        "error": None,
+    }
+    product_jobs.write_job(job)
+    product_jobs.update_job(str(tmp_path), "a", status="failed", error="Traceback")
+    assert product_jobs.read_job(str(tmp_path), "a") == dict(
+        job, status="failed", error="Traceback"
+    )
+
+
+def test_list_jobs_marks_interrupted(tmp_path):
+    pid = dead_pid()
+    for submitted, (job_id, status, server_pid, worker_pid) in enumerate(
+        [
+            ("queued_dead_server", "queued", pid, None),
+            ("running_dead_worker", "running", 0, pid),
+            ("queued_live_server", "queued", os.getpid(), None),
+            ("failed", "failed", pid, pid),
+        ]
+    ):
+        product_jobs.write_job(
+            {
+                "job_id": job_id,
+                "output_file_dir": str(tmp_path),
+                "status": status,
+                "submitted": submitted,
+                "server_pid": server_pid,
+                "pid": worker_pid,
+            }
+        )
+    jobs = product_jobs.list_jobs(str(tmp_path))
+    assert [(job["job_id"], job["status"]) for job in jobs] == [
+        ("queued_dead_server", "interrupted"),
+        ("running_dead_worker", "interrupted"),
+        ("queued_live_server", "queued"),
+        ("failed", "failed"),
+    ]
@@ -0,0 +1,22 @@
+import numpy as np
+from GLHE.LIME import series_data_display
+
+
+def test_downsample_lttb():
+    x = np.arange(1000)
+    y = np.sin(x / 50)
+    y[500] = 10
+    keep = series_data_display.downsample_lttb(x, y, 100)
+    assert keep.shape == (100,)
+    assert keep[0] == 0 and keep[-1] == 999
+    assert np.all(np.diff(keep) > 0)
+    # The spike is the largest triangle of its bucket
+    assert 500 in keep
+
+
+def test_downsample_lttb_keeps_short_lines():
+    x = np.arange(10)
+    assert list(series_data_display.downsample_lttb(x, x, 10)) == list(range(10))
+    assert list(series_data_display.downsample_lttb(x, x, 50)) == list(range(10))
+    assert list(series_data_display.downsample_lttb(x, x, 2)) == list(range(10))
+    assert len(series_data_display.downsample_lttb(x, x, 3)) == 3
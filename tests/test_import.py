@@ -0,0 +1,37 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+# Cold `import GLHE.CLAY` has to stay under this, it's paid by every batch worker & script
+IMPORT_TIME_BUDGET_SECONDS = 0.5
+HEAVY_MODULES = ["dash", "holoviews", "plotly", "pint", "xarray", "osgeo", "boto3"]
+
+
+def cold_import(statement: str) -> dict:
+    """Runs an import in a fresh interpreter, returning how long it took & which heavy modules it loaded"""
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "{}\n"
+        "seconds = time.perf_counter() - start\n"
+        "print(json.dumps({{'seconds': seconds, 'heavy': [m for m in {} if m in sys.modules]}}))\n"
+    ).format(statement, HEAVY_MODULES)
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=Path(__file__).parents[1],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_import_GLHE_CLAY_is_cheap():
+    runs = [cold_import("import GLHE.CLAY") for _ in range(3)]
+    assert runs[0]["heavy"] == []
+    assert min(run["seconds"] for run in runs) < IMPORT_TIME_BUDGET_SECONDS
+
+
+def test_import_GLHE_is_cheap():
+    assert cold_import("import GLHE")["heavy"] == []